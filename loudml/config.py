@@ -68,12 +68,38 @@ class Config:
             self._training['batch_size'] = 64
         if 'epochs' not in self._training:
             self._training['epochs'] = 100
+        if 'data_cache_max_mb' not in self._training:
+            self._training['data_cache_max_mb'] = 1024
+        if 'data_cache_settle' not in self._training:
+            self._training['data_cache_settle'] = '5m'
 
         self._inference = data.get('inference', {})
         if 'num_cpus' not in self._inference:
             self._inference['num_cpus'] = 1
         if 'num_gpus' not in self._inference:
             self._inference['num_gpus'] = 0
+        if 'mc_memory_mb' not in self._inference:
+            self._inference['mc_memory_mb'] = 64
+        if 'backend' not in self._inference:
+            self._inference['backend'] = 'keras'
+        if 'precision' not in self._inference:
+            self._inference['precision'] = 'float32'
+        if 'model_cache_size' not in self._inference:
+            self._inference['model_cache_size'] = 8
+        if 'model_cache_max_rss_mb' not in self._inference:
+            self._inference['model_cache_max_rss_mb'] = 0
+
+        self._hooks = data.get('hooks', {})
+        if 'outbox' not in self._hooks:
+            self._hooks['outbox'] = True
+        if 'batch_size' not in self._hooks:
+            self._hooks['batch_size'] = 100
+        if 'max_attempts' not in self._hooks:
+            self._hooks['max_attempts'] = 10
+        if 'retry_delay' not in self._hooks:
+            self._hooks['retry_delay'] = 1
+        if 'max_retry_delay' not in self._hooks:
+            self._hooks['max_retry_delay'] = 300
 
         self._server = data.get('server', {})
         if 'listen' not in self._server:
@@ -135,6 +161,11 @@ class Config:
         # XXX: return a copy to prevent modification by the caller
         return copy.deepcopy(self._inference)
 
+    @property
+    def hooks(self):
+        # XXX: return a copy to prevent modification by the caller
+        return copy.deepcopy(self._hooks)
+
     @property
     def metrics(self):
         return copy.deepcopy(self._metrics)
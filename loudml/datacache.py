@@ -0,0 +1,350 @@
+"""
+Loud ML training data cache
+
+Time series fetched from buckets for training are kept on disk, under the
+storage path, so that training the same model again or training models
+that share a series only queries the buckets for the missing time ranges.
+
+A series is identified by the bucket settings, the bucket interval and
+the feature definitions. It is stored as a contiguous range of buckets:
+one row of feature values per bucket interval, and a flag telling whether
+the bucket returned the row. Arrays are memory-mapped when read.
+
+Recent buckets may still receive data written late: the buckets of the
+last `settle` seconds are never cached and are always fetched again.
+"""
+
+import json
+import logging
+import math
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+import numpy as np
+
+from .misc import (
+    hash_dict,
+    make_ts,
+    ts_to_str,
+)
+
+
+def _feature_key(feature):
+    return {
+        'agg_id': feature.agg_id,
+        'metric': feature.metric,
+        'field': feature.field,
+        'script': feature.script,
+    }
+
+
+def _get_dir_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for filename in files:
+            try:
+                size += os.stat(os.path.join(root, filename)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class DataCache:
+    """
+    On-disk cache of bucket time series
+
+    `settle` is the delay in seconds after which a bucket is not expected
+    to change anymore. More recent buckets are not cached.
+
+    `max_size_mb` is the maximum size of the cache on disk. Least recently
+    used series are removed first. 0 means no limit.
+    """
+
+    def __init__(self, path, settle=0, max_size_mb=0):
+        self.path = path
+        self.settle = settle
+        self.max_size_mb = max_size_mb
+        os.makedirs(self.path, exist_ok=True)
+
+    def get_key(self, bucket, bucket_interval, features):
+        """
+        Identify a series
+        """
+        return hash_dict({
+            'bucket': bucket.cfg,
+            'bucket_interval': bucket_interval,
+            'features': [_feature_key(feature) for feature in features],
+        })
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key)
+
+    def _load(self, key):
+        """
+        Load a cached series. Return None if missing
+        """
+        entry_path = self._entry_path(key)
+        meta_path = os.path.join(entry_path, 'meta.json')
+        try:
+            with open(meta_path) as meta_file:
+                meta = json.load(meta_file)
+            data_path = os.path.join(entry_path, meta['data'])
+            values = np.load(data_path + '.values.npy', mmap_mode='r')
+            present = np.load(data_path + '.present.npy', mmap_mode='r')
+        except (OSError, ValueError, KeyError):
+            return None
+
+        # last use, for eviction
+        try:
+            os.utime(meta_path)
+        except OSError:
+            pass
+
+        return meta, values, present
+
+    def _save(self, key, meta, values, present):
+        entry_path = self._entry_path(key)
+        os.makedirs(entry_path, exist_ok=True)
+
+        meta = dict(meta, data=uuid.uuid4().hex)
+        data_path = os.path.join(entry_path, meta['data'])
+        # Data files are never modified: readers that mapped the previous
+        # ones keep a consistent view
+        np.save(data_path + '.values.npy', values)
+        np.save(data_path + '.present.npy', present)
+
+        meta_path = os.path.join(entry_path, 'meta.json')
+        tmp_fd, tmp_path = tempfile.mkstemp(prefix=meta_path + ".")
+        with os.fdopen(tmp_fd, 'w') as meta_file:
+            json.dump(meta, meta_file)
+        os.rename(tmp_path, meta_path)
+
+        for filename in os.listdir(entry_path):
+            if filename.endswith('.npy') and \
+               not filename.startswith(meta['data']):
+                try:
+                    os.unlink(os.path.join(entry_path, filename))
+                except OSError:
+                    pass
+
+        self._evict(keep=key)
+
+    def _evict(self, keep=None):
+        if not self.max_size_mb:
+            return
+
+        max_size = self.max_size_mb * 2**20
+        entries = []
+        total = 0
+        for key in os.listdir(self.path):
+            entry_path = self._entry_path(key)
+            size = _get_dir_size(entry_path)
+            total += size
+            try:
+                mtime = os.stat(os.path.join(entry_path, 'meta.json')).st_mtime
+            except OSError:
+                mtime = 0
+            entries.append((mtime, key, size))
+
+        for _, key, size in sorted(entries):
+            if total <= max_size:
+                break
+            if key == keep:
+                continue
+            logging.info("evicting cached series %s", key)
+            shutil.rmtree(self._entry_path(key), ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        """
+        Remove all cached series
+        """
+        for key in os.listdir(self.path):
+            shutil.rmtree(self._entry_path(key), ignore_errors=True)
+
+    def _fetch(self, bucket, bucket_interval, features, from_ts, to_ts):
+        """
+        Fetch a range of buckets from the bucket
+        """
+        nb_buckets = int((to_ts - from_ts) / bucket_interval)
+        values = np.full((nb_buckets, len(features)), np.nan, dtype=float)
+        present = np.full((nb_buckets,), False, dtype=bool)
+
+        logging.info(
+            "fetching %s-%s from bucket %s",
+            ts_to_str(from_ts), ts_to_str(to_ts), bucket.name,
+        )
+        data = bucket.get_times_data(
+            bucket_interval=bucket_interval,
+            features=features,
+            from_date=from_ts,
+            to_date=to_ts,
+        )
+        for _, val, timeval in data:
+            i = int((make_ts(timeval) - from_ts) // bucket_interval)
+            if 0 <= i < nb_buckets:
+                values[i] = val
+                present[i] = True
+
+        return values, present
+
+    def get_times_data(
+        self,
+        bucket,
+        bucket_interval,
+        features,
+        from_date=None,
+        to_date=None,
+        settle=0,
+    ):
+        """
+        Get data points in the time range [from_date, to_date[
+
+        Same interface as `Bucket.get_times_data()`. Only the time ranges
+        that are not in the cache are fetched from the bucket. `settle`
+        extends the uncached delay of the cache, e.g. to the model offset.
+        """
+        if from_date is None or to_date is None:
+            return bucket.get_times_data(
+                bucket_interval=bucket_interval,
+                features=features,
+                from_date=from_date,
+                to_date=to_date,
+            )
+
+        from_ts = make_ts(from_date)
+        to_ts = make_ts(to_date)
+        if from_ts % bucket_interval or to_ts % bucket_interval:
+            # Only date ranges aligned on bucket_interval are cached
+            return bucket.get_times_data(
+                bucket_interval=bucket_interval,
+                features=features,
+                from_date=from_ts,
+                to_date=to_ts,
+            )
+
+        # The current bucket is not complete yet and the settle window may
+        # still change: they are not cached
+        settle = max(self.settle, settle)
+        settled_ts = math.floor(
+            (time.time() - settle) / bucket_interval) * bucket_interval
+
+        key = self.get_key(bucket, bucket_interval, features)
+        entry = self._load(key)
+        if entry is not None:
+            meta, values, present = entry
+            if meta['to_ts'] > settled_ts:
+                # Cached with a shorter settle delay, fetch the tail again
+                nb_settled = max(0, int(
+                    (settled_ts - meta['from_ts']) / bucket_interval))
+                values = values[:nb_settled]
+                present = present[:nb_settled]
+                meta = dict(
+                    meta,
+                    to_ts=meta['from_ts'] + nb_settled * bucket_interval,
+                )
+            if to_ts < meta['from_ts'] or from_ts > meta['to_ts']:
+                # Keep the cached range contiguous
+                entry = None
+
+        if entry is None:
+            meta = {
+                'bucket': bucket.name,
+                'bucket_interval': bucket_interval,
+                'from_ts': from_ts,
+                'to_ts': from_ts,
+            }
+            values = np.full((0, len(features)), np.nan, dtype=float)
+            present = np.full((0,), False, dtype=bool)
+        else:
+            logging.info("using cached series %s", key)
+
+        head = tail = None
+        if from_ts < meta['from_ts']:
+            head = self._fetch(
+                bucket, bucket_interval, features, from_ts, meta['from_ts'])
+        if to_ts > meta['to_ts']:
+            tail = self._fetch(
+                bucket, bucket_interval, features, meta['to_ts'], to_ts)
+
+        if head is not None or tail is not None:
+            parts = [part for part in [head, (values, present), tail]
+                     if part is not None]
+            values = np.concatenate([part[0] for part in parts])
+            present = np.concatenate([part[1] for part in parts])
+            range_from = min(from_ts, meta['from_ts'])
+            range_to = max(to_ts, meta['to_ts'])
+            cached_to = min(range_to, settled_ts)
+            nb_cached = int((cached_to - range_from) / bucket_interval)
+            if nb_cached > 0:
+                try:
+                    self._save(key, dict(
+                        meta,
+                        from_ts=range_from,
+                        to_ts=cached_to,
+                    ), values[:nb_cached], present[:nb_cached])
+                except OSError as exn:
+                    logging.error("cannot save cached series: %s", exn)
+        else:
+            range_from = meta['from_ts']
+
+        start = int((from_ts - range_from) / bucket_interval)
+        end = int((to_ts - range_from) / bucket_interval)
+        return self._format(
+            from_ts,
+            bucket_interval,
+            values[start:end],
+            present[start:end],
+        )
+
+    def _format(self, from_ts, bucket_interval, values, present):
+        """
+        Build bucket data points. Buckets that follow the last one
+        returned by the bucket are dropped, as the bucket would do.
+        """
+        found = np.flatnonzero(present)
+        if len(found) == 0:
+            return []
+
+        result = []
+        for i in range(found[-1] + 1):
+            ts = from_ts + i * bucket_interval
+            result.append((i * bucket_interval, values[i], ts_to_str(ts)))
+
+        return result
+
+
+class CachedBucket:
+    """
+    Bucket wrapper that gets training data through a DataCache
+
+    The buckets of the last `settle` seconds are not cached, in addition to
+    the settle delay of the cache. Other methods are forwarded to the bucket.
+    """
+
+    def __init__(self, bucket, cache, settle=0):
+        self._bucket = bucket
+        self._cache = cache
+        self._settle = settle
+
+    def __getattr__(self, name):
+        return getattr(self._bucket, name)
+
+    def get_times_data(
+        self,
+        bucket_interval,
+        features,
+        from_date=None,
+        to_date=None,
+    ):
+        return self._cache.get_times_data(
+            self._bucket,
+            bucket_interval=bucket_interval,
+            features=features,
+            from_date=from_date,
+            to_date=to_date,
+            settle=self._settle,
+        )
@@ -16,6 +16,7 @@ from .model import (
 from .misc import (
     DateRange,
     datetime_to_str,
+    hash_dict,
     list_from_np,
     make_datetime,
     make_ts,
@@ -25,6 +26,7 @@ from .misc import (
 )
 from . import (
     errors,
+    npdonut,
     schemas,
 )
 from voluptuous import (
@@ -35,6 +37,7 @@ from voluptuous import (
     Range,
 )
 from hyperopt import (
+    base,
     fmin,
     STATUS_OK,
     STATUS_FAIL,
@@ -43,29 +46,38 @@ from hyperopt import (
 )
 from hyperopt import space_eval
 from hyperopt import hp
-import h5py  # Read training_config.optimizer_config
-from tensorflow.contrib.keras.api.keras import regularizers
-from tensorflow.contrib.keras.api.keras.losses import mean_squared_error
-from tensorflow.contrib.keras.api.keras.models import Model as _Model
-from tensorflow.contrib.keras.api.keras.layers import Lambda, Input, Dense
-from tensorflow.contrib.keras.api.keras.callbacks import EarlyStopping
-from tensorflow.contrib.keras.api.keras.models import load_model
-from tensorflow.python.keras.utils import generic_utils
-from tensorflow.contrib.keras.api.keras import backend as K
-import tensorflow as tf
+import contextlib
 import datetime
+import hashlib
 import json
 import logging
+import multiprocessing
 import os
 import sys
 import random
 import numpy as np
 import itertools
 import math
+import tempfile
+import time
 from scipy.stats import norm
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
-tf.logging.set_verbosity(tf.logging.ERROR)
+
+# TensorFlow and Keras are imported on first use by _import_tensorflow().
+# The NumPy inference engine does not need them.
+tf = None
+K = None
+regularizers = None
+mean_squared_error = None
+_Model = None
+Lambda = None
+Input = None
+Dense = None
+EarlyStopping = None
+LambdaCallback = None
+load_model = None
+generic_utils = None
 
 
 DEFAULT_SEASONALITY = {
@@ -90,13 +102,59 @@ g_mc_count = 1000
 g_mc_batch_size = 256
 g_lambda = 0.01
 
+# Number of hyperparameter search trials saved in the model state
+MAX_TRIALS_HISTORY = 100
+
+# Memory budget (MB) of one batch of Monte Carlo samples
+g_mc_memory_mb = 64
+
+# Scale drift of incremental training data reported as an anomaly: shift of
+# the mean, in standard deviations, and ratio of standard deviations
+MAX_MEAN_SHIFT = 1.0
+MAX_STD_RATIO = 2.0
+
+
+def _import_tensorflow():
+    """
+    Import TensorFlow and Keras on first use
+    """
+    global tf, K, regularizers, mean_squared_error, _Model, Lambda, Input
+    global Dense, EarlyStopping, LambdaCallback, load_model, generic_utils
+
+    if tf is not None:
+        return
+
+    try:
+        import tensorflow
+        from tensorflow.contrib.keras.api import keras
+        from tensorflow.python.keras.utils import generic_utils as _utils
+    except ImportError:
+        raise errors.LoudMLException(
+            "TensorFlow is required to train or load Keras models")
+
+    tensorflow.logging.set_verbosity(tensorflow.logging.ERROR)
+
+    K = keras.backend
+    regularizers = keras.regularizers
+    mean_squared_error = keras.losses.mean_squared_error
+    _Model = keras.models.Model
+    Lambda = keras.layers.Lambda
+    Input = keras.layers.Input
+    Dense = keras.layers.Dense
+    EarlyStopping = keras.callbacks.EarlyStopping
+    LambdaCallback = keras.callbacks.LambdaCallback
+    load_model = keras.models.load_model
+    generic_utils = _utils
+    tf = tensorflow
+
 
 def set_seed():
     if os.environ.get('RANDOM_SEED'):
         s = int(os.environ.get('RANDOM_SEED'))
         np.random.seed(s)
         random.seed(s)
-        tf.random.set_random_seed(s)
+        if tf is not None:
+            tf.random.set_random_seed(s)
 
 
 # reparameterization trick
@@ -163,19 +221,240 @@ def _get_decoder(_keras_model):
     return new_model
 
 
+def _mc_moments(encoder, decoder, x, missing, mc_count, memory_mb):
+    """
+    Batched Monte Carlo integration
+
+    Draw `mc_count` latent samples for each window in `x` and return the
+    mean and the sum of squared deviations (M2) of the last decoded point
+    of each window.
+
+    Windows and their samples are stacked into chunks sized to fit in
+    `memory_mb` so that the encoder and decoder run once per chunk
+    instead of once per window.
+    """
+    nb_windows, W = x.shape
+    # input, missing flags and decoded output are held for each sample
+    sample_size = W * (2 * x.itemsize + missing.itemsize)
+    chunk_len = max(1, int(memory_mb * 1024 * 1024 / (sample_size * mc_count)))
+
+    mean = np.empty((nb_windows,), dtype=x.dtype)
+    m2 = np.empty((nb_windows,), dtype=x.dtype)
+    for i in range(0, nb_windows, chunk_len):
+        j = min(nb_windows, i + chunk_len)
+        batch_x = np.repeat(x[i:j], mc_count, axis=0)
+        batch_missing = np.repeat(missing[i:j], mc_count, axis=0)
+        _, _, Z = encoder.predict(
+            [batch_x, batch_missing],
+            batch_size=len(batch_x),
+        )
+        x_decoded = decoder.predict(Z, batch_size=len(batch_x))
+        samples = x_decoded[:, -1].reshape((j - i, mc_count))
+        mean[i:j] = np.mean(samples, axis=1)
+        m2[i:j] = np.var(samples, axis=1) * mc_count
+
+    return mean, m2
+
+
+def _mc_std(encoder, decoder, x, missing, mc_count, memory_mb):
+    """
+    Return the standard deviation of the last decoded point of each window
+    over `mc_count` latent samples
+    """
+    _, m2 = _mc_moments(encoder, decoder, x, missing, mc_count, memory_mb)
+    return np.sqrt(m2 / mc_count)
+
+
+def _mc_std_adaptive(
+    encoder,
+    decoder,
+    x,
+    missing,
+    min_samples,
+    max_samples,
+    tolerance,
+    memory_mb,
+):
+    """
+    Adaptive Monte Carlo integration
+
+    Samples are drawn by increments of `min_samples` for the windows that
+    did not converge yet. A window converges when the relative change of
+    its standard deviation after an increment is below `tolerance`, or
+    when `max_samples` are drawn.
+
+    Return the standard deviation and the number of samples of each window.
+    """
+    nb_windows = len(x)
+    count = np.zeros((nb_windows,), dtype=int)
+    mean = np.zeros((nb_windows,), dtype=x.dtype)
+    m2 = np.zeros((nb_windows,), dtype=x.dtype)
+    std = np.zeros((nb_windows,), dtype=x.dtype)
+    active = np.arange(nb_windows)
+
+    drawn = 0
+    while len(active):
+        step = min(min_samples, max_samples - drawn)
+        b_mean, b_m2 = _mc_moments(
+            encoder, decoder, x[active], missing[active], step, memory_mb)
+
+        # merge moments (Chan et al.)
+        total = drawn + step
+        delta = b_mean - mean[active]
+        mean[active] += delta * step / total
+        m2[active] += b_m2 + delta ** 2 * drawn * step / total
+        count[active] = total
+
+        prev_std = std[active]
+        std[active] = np.sqrt(m2[active] / total)
+        if total >= max_samples:
+            break
+        if drawn > 0:
+            change = np.abs(std[active] - prev_std)
+            active = active[change > tolerance * std[active]]
+        drawn = total
+
+    return std, count
+
+
+def _ut_std(encoder, decoder, x, missing, kappa=1.0):
+    """
+    Unscented transform
+
+    Propagate the posterior Q(z|X) of each window in `x` through the
+    decoder using 2L+1 sigma points, where L is the latent dimension, and
+    return the standard deviation of the last decoded point of each window.
+    """
+    z_mean, z_log_var, _ = encoder.predict([x, missing], batch_size=len(x))
+    nb_windows, L = z_mean.shape
+
+    # sigma points: mean, mean +/- sqrt((L + kappa) * var) along each axis
+    spread = np.sqrt((L + kappa) * np.exp(z_log_var))
+    offsets = np.zeros((nb_windows, 2 * L + 1, L), dtype=z_mean.dtype)
+    axes = np.arange(L)
+    offsets[:, 1 + axes, axes] = spread
+    offsets[:, 1 + L + axes, axes] = -spread
+    points = (z_mean[:, np.newaxis, :] + offsets).reshape((-1, L))
+
+    x_decoded = decoder.predict(points, batch_size=len(points))
+    y = x_decoded[:, -1].reshape((nb_windows, 2 * L + 1))
+
+    weights = np.full((2 * L + 1,), 0.5 / (L + kappa))
+    weights[0] = kappa / (L + kappa)
+    mean = np.dot(y, weights)
+    var = np.dot((y - mean[:, np.newaxis]) ** 2, weights)
+    return np.sqrt(var).astype(x.dtype)
+
+
+def _forecast_particles(encoder, decoder, x, forecast_len, particles, noise):
+    """
+    Particle-based forecast
+
+    `particles` sample paths start from the window `x` and are advanced
+    together: each step runs the encoder and the decoder once on the whole
+    batch, with latent variables sampled from Q(z|X). The new point of each
+    path is initialized with its previous value before being decoded.
+
+    Return the mean and the standard deviation of the paths for each step.
+    """
+    W = len(x)
+    paths = np.tile(x, (particles, 1))
+    missing = np.full(paths.shape, False, dtype=bool)
+    missing[:, -1] = True
+
+    mean = np.empty((forecast_len,), dtype=x.dtype)
+    std = np.empty((forecast_len,), dtype=x.dtype)
+    for j in range(forecast_len):
+        if W > 1:
+            paths[:, -1] = paths[:, -2]
+        _, _, Z = encoder.predict([paths, missing], batch_size=particles)
+        x_decoded = decoder.predict(Z, batch_size=particles)
+        paths[:, -1] = x_decoded[:, -1]
+
+        # uncertainty is modeled using a random uniform noise distribution
+        # that increases over time
+        if noise > 0:
+            paths *= 1 + np.random.uniform(-noise * j, noise * j, paths.shape)
+
+        mean[j] = np.mean(paths[:, -1])
+        std[j] = np.std(paths[:, -1])
+        paths = np.roll(paths, -1, axis=1)
+
+    return mean, std
+
+
+def _find_spans(x, min_span, max_span, count=3):
+    """
+    Propose window sizes from the autocorrelation peaks of a series
+
+    The autocorrelation is computed by FFT. Missing values count as the
+    mean. Returns up to `count` lags in [min_span, max_span) that are
+    significant peaks, best correlated first.
+    """
+    x = np.asarray(x, dtype=float)
+    n = len(x)
+    if n < 3 or np.all(np.isnan(x)):
+        return []
+
+    x = np.nan_to_num(x - np.nanmean(x))
+    size = 2 ** int(math.ceil(math.log2(2 * n - 1)))
+    spectrum = np.fft.rfft(x, size)
+    acf = np.fft.irfft(spectrum * np.conj(spectrum), size)[:n]
+    if acf[0] <= 0:
+        return []
+    acf /= acf[0]
+
+    lags = np.arange(max(min_span, 1), min(max_span, n - 1))
+    peaks = lags[
+        (acf[lags] > acf[lags - 1]) &
+        (acf[lags] >= acf[lags + 1]) &
+        # 95% confidence bound for white noise
+        (acf[lags] > 2 / math.sqrt(n))
+    ]
+    best = peaks[np.argsort(-acf[peaks], kind='stable')][:count]
+    return [int(lag) for lag in best]
+
+
 def _get_index(d, from_date, step):
     return int((make_ts(d) - make_ts(from_date)) / step)
 
 
 def _format_windows(from_date, to_date, step, windows):
     size = _get_index(to_date, from_date, step)
-    abnormal = np.full((size,), False, dtype=bool)
-    for _from, _to in windows:
-        x = _get_index(_from, from_date, step)
-        y = _get_index(_to, from_date, step)
-        abnormal[min(size, max(0, x)):max(0, min(y, size))] = True
+    # +1 at the start of each window, -1 at its end. Buckets covered by
+    # at least one window have a positive running sum.
+    delta = np.zeros((size + 1,), dtype=int)
+    if len(windows):
+        bounds = np.array([
+            [
+                _get_index(_from, from_date, step),
+                _get_index(_to, from_date, step),
+            ]
+            for _from, _to in windows
+        ])
+        start = np.clip(bounds[:, 0], 0, size)
+        end = np.clip(bounds[:, 1], 0, size)
+        valid = start < end
+        np.add.at(delta, start[valid], 1)
+        np.add.at(delta, end[valid], -1)
+
+    return np.cumsum(delta[:size]) > 0
+
+
+def _sliding_windows(x, W):
+    """
+    Return a read-only view of the windows of length W of an array
 
-    return abnormal
+    Windows are not copied: row i of the (len(x) - W + 1, W) result
+    shares memory with x[i:i + W]. Indexing rows materializes them.
+    """
+    x = np.ascontiguousarray(x)
+    return np.lib.stride_tricks.as_strided(
+        x,
+        shape=(max(len(x) - W + 1, 0), W),
+        strides=(x.strides[0], x.strides[0]),
+        writeable=False,
+    )
 
 
 def _get_scores(y, _mean, _std):
@@ -215,62 +494,161 @@ class HyperParameters:
             setattr(self, key, value)
 
 
-def _serialize_keras_model(keras_model):
-    """
-    Serialize Keras model
+def _cross_val_trial(
+    settings,
+    dataset_path,
+    abnormal_path,
+    params,
+    train_size,
+    batch_size,
+    num_epochs,
+    rungs=None,
+):
     """
+    Evaluate hyperparameters in a trial process of a parallel search
 
-    import base64
-    import tempfile
+    `rungs` are the losses reported by the previous trials when successive
+    halving is enabled
+    """
+    model = DonutModel(settings)
+    dataset = np.load(dataset_path, mmap_mode='r')
+    abnormal = None
+    if abnormal_path is not None:
+        abnormal = np.load(abnormal_path, mmap_mode='r')
+
+    halving = None
+    if rungs is not None:
+        halving = SuccessiveHalving(
+            model.halving_min_epochs,
+            model.halving_eta,
+            rungs,
+        )
 
-    fd, path = tempfile.mkstemp()
     try:
-        keras_model.save(path)
-        with os.fdopen(fd, 'rb') as tmp:
-            model_b64 = base64.b64encode(tmp.read())
-    finally:
-        os.remove(path)
-
-    return model_b64.decode('utf-8')
+        score, _ = model._cross_val_model(
+            dataset,
+            HyperParameters(params),
+            train_size=train_size,
+            batch_size=batch_size,
+            num_epochs=num_epochs,
+            abnormal=abnormal,
+            halving=halving,
+        )
+        return {
+            'loss': nan_to_none(score),
+            'status': STATUS_OK,
+            'batches_per_sec': model.batches_per_sec,
+            'epoch_time': model.epoch_time,
+            'windows': model.nb_windows,
+            'halving': model.halving_trial,
+        }
+    except Exception as exn:
+        logging.warning("iteration failed: %s", exn)
+        return {'loss': None, 'status': STATUS_FAIL}
 
 
-def _load_keras_model(model_b64):
-    import tempfile
-    import base64
+def _build_keras_model(W, intermediate_dim, latent_dim, optimizer='adam'):
+    """
+    Build and compile the Keras Donut model
+    """
+    # expected input data shape: (batch_size, timesteps,)
+    # network parameters
+    input_shape = (W, )
+
+    # VAE model = encoder + decoder
+    # build encoder model
+    main_input = Input(shape=input_shape)
+    # bool vector to flag missing data points
+    aux_input = Input(shape=input_shape)
+    aux_output = Lambda(lambda x: x)(aux_input)
+    x = Dense(intermediate_dim,
+              kernel_regularizer=regularizers.l2(0.001),
+              activation='relu', name='encoder_dense_0')(main_input)
+    x = Dense(intermediate_dim,
+              kernel_regularizer=regularizers.l2(0.001),
+              activation='relu', name='encoder_dense_1')(x)
+    z_mean = Dense(latent_dim, name='z_mean')(x)
+    z_log_var = Dense(latent_dim, name='z_log_var')(x)
+
+    # use reparameterization trick to push the sampling out as input
+    # note that "output_shape" isn't necessary with the TensorFlow backend
+    z = Lambda(sampling, output_shape=(latent_dim,),
+               name='z')([z_mean, z_log_var])
+
+    # build decoder model
+    x = Dense(intermediate_dim,
+              kernel_regularizer=regularizers.l2(0.001),
+              activation='relu', name='decoder_dense_0')(z)
+    x = Dense(intermediate_dim,
+              kernel_regularizer=regularizers.l2(0.001),
+              activation='relu', name='decoder_dense_1')(x)
+    main_output = Dense(W, activation='linear', name='decoder_dense_2')(x)
+
+    # instantiate Donut model
+    keras_model = _Model([main_input, aux_input], [
+                         main_output, aux_output], name='donut')
+    add_loss(keras_model, W)
+    optimizer_cls = None
+    if optimizer == 'adam':
+        optimizer_cls = tf.keras.optimizers.Adam(clipnorm=10.)
+
+    keras_model.compile(
+        optimizer=optimizer_cls,
+    )
+    return keras_model
 
-    fd, path = tempfile.mkstemp()
-    try:
-        with os.fdopen(fd, 'wb') as tmp:
-            tmp.write(base64.b64decode(model_b64.encode('utf-8')))
-            tmp.close()
-    finally:
-        keras_model = load_model(path, compile=False)
-        opened_new_file = not isinstance(path, h5py.File)
-        if opened_new_file:
-            f = h5py.File(path, mode='r')
-        else:
-            f = path
-        training_config = f.attrs.get('training_config')
-        optimizer_cls = None
-        if training_config is None:
-            optimizer_cls = tf.keras.optimizers.Adam(clipnorm=10.)
-        else:
-            training_config = json.loads(training_config.decode('utf-8'))
-            optimizer_config = training_config['optimizer_config']
-            optimizer_cls = tf.keras.optimizers.deserialize(optimizer_config)
-
-        if opened_new_file:
-            f.close()
-        os.remove(path)
-        _, W = keras_model.inputs[0].get_shape()
-        add_loss(keras_model, int(W))
-        keras_model.compile(
-            optimizer=optimizer_cls,
-        )
 
+def _load_keras_model(params, weights):
+    """
+    Rebuild Keras model from its hyper-parameters and its weights
+    """
+    _import_tensorflow()
+
+    keras_model = _build_keras_model(
+        int(params['span']),
+        int(params['intermediate_dim']),
+        int(params['latent_dim']),
+        params.get('optimizer', 'adam'),
+    )
+    _set_keras_weights(keras_model, weights)
     return keras_model
 
 
+def _set_keras_weights(keras_model, weights):
+    """
+    Set the Dense layer weights of a Keras Donut model
+    """
+    for name in npdonut.ENCODER_LAYERS + npdonut.LATENT_LAYERS + \
+            npdonut.DECODER_LAYERS:
+        keras_model.get_layer(name).set_weights([
+            weights[name + '/kernel'],
+            weights[name + '/bias'],
+        ])
+
+
+def _fingerprint(dataset, abnormal, **params):
+    """
+    Hash training data and parameters
+    """
+    ctx = hashlib.sha1()
+    ctx.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+    for array in [dataset, abnormal]:
+        array = np.ascontiguousarray(array)
+        ctx.update(str((array.dtype.str, array.shape)).encode('utf-8'))
+        ctx.update(array.tobytes())
+    return ctx.hexdigest()
+
+
+def _params_to_json(params):
+    """
+    Convert hyperparameters to JSON serializable values
+    """
+    return {
+        key: val.item() if isinstance(val, np.generic) else val
+        for key, val in params.items()
+    }
+
+
 class TimeSeriesPrediction:
     """
     Time-series prediction
@@ -284,11 +662,12 @@ class TimeSeriesPrediction:
         self.upper = upper
         self.lower = lower
         self.anomaly_indices = None
-        self.stats = None
+        self.anomaly_mask = None
         self.constraint = None
         self.scores = None
         self.mses = None
         self.mse = None
+        self.mc_samples = None
 
     def get_schema(
         self,
@@ -318,6 +697,41 @@ class TimeSeriesPrediction:
 
         return data_schema
 
+    @property
+    def stats(self):
+        """
+        Anomaly detection results of each bucket, None if anomaly detection
+        has not been performed
+        """
+        if self.anomaly_mask is None:
+            return None
+        return [self.get_bucket_stats(i) for i in range(len(self.timestamps))]
+
+    def get_bucket_stats(self, i):
+        """
+        Format the anomaly detection results of one bucket
+        """
+        feature = self.model.features[0]
+        score = max(0, self.scores[i])
+        is_anomaly = bool(self.anomaly_mask[i])
+        anomalies = {}
+        if is_anomaly:
+            observed = self.observed[i]
+            anomalies[feature.name] = {
+                'type': 'low' if observed < self.predicted[i] else 'high',
+                'score': score,
+            }
+
+        stats = {
+            'mse': nan_to_none(self.mses[i]),
+            'score': score,
+            'anomaly': is_anomaly,
+            'anomalies': anomalies,
+        }
+        if self.mc_samples is not None:
+            stats['mc_samples'] = int(self.mc_samples[i])
+        return stats
+
     def get_anomalies(self):
         """
         Return anomalies
@@ -353,6 +767,8 @@ class TimeSeriesPrediction:
         }
         if self.stats is not None:
             result['stats'] = self.stats
+        if self.mc_samples is not None:
+            result['mc_samples'] = [int(n) for n in self.mc_samples]
         if self.constraint is not None:
             result['constraint'] = self.constraint
         return result
@@ -397,8 +813,10 @@ class TimeSeriesPrediction:
 
         bucket = self.format_bucket_data(i)
         bucket['timestamp'] = self.timestamps[i]
-        if self.stats:
-            bucket['stats'] = self.stats[i]
+        if self.anomaly_mask is not None:
+            bucket['stats'] = self.get_bucket_stats(i)
+        elif self.mc_samples is not None:
+            bucket['stats'] = {'mc_samples': int(self.mc_samples[i])}
         return bucket
 
     def format_buckets(self):
@@ -446,25 +864,254 @@ class TimeSeriesPrediction:
         plt.show()
 
 
-def generator(x, missing, batch_size, model):
-    batch_x = np.zeros((batch_size, x.shape[1]))
-    batch_missing = np.zeros((batch_size, x.shape[1]))
+def generator(
+    x,
+    missing,
+    batch_size,
+    model,
+    memory_mb=None,
+    steps_per_epoch=None,
+):
+    """
+    Yield training batches with missing points imputed by MCMC
+
+    Batches are sampled and imputed by chunks that fit in `memory_mb`:
+    each MCMC iteration is one predict() call over the whole chunk instead
+    of one call per batch. Imputation uses the weights of the model at the
+    start of the chunk, so chunks are capped at `steps_per_epoch` batches
+    to impute again with the weights of each new epoch.
+    """
+    if memory_mb is None:
+        memory_mb = g_mc_memory_mb
+
+    W = x.shape[1]
+    # windows and missing flags, float64
+    steps = max(1, int(memory_mb * 2**20 / (16 * W * batch_size)))
+    if steps_per_epoch is not None:
+        steps = max(1, min(steps, steps_per_epoch))
+    size = steps * batch_size
     while True:
-        abnormal = np.random.binomial(1, g_lambda, x.shape[1])
-        for i in range(batch_size):
-            index = random.randint(0, len(x)-1)
-            batch_x[i] = x[index]
-            batch_missing[i] = np.maximum(
-                abnormal,
-                missing[index],
-            )
+        index = np.random.randint(0, len(x), size=size)
+        chunk_x = x[index].astype(float, copy=False)
+        # a different set of injected missing points per batch
+        abnormal = np.random.binomial(1, g_lambda, (steps, W))
+        chunk_missing = np.maximum(
+            np.repeat(abnormal, batch_size, axis=0),
+            missing[index],
+        ).astype(float)
+        is_missing = chunk_missing > 0
 
         for _ in range(g_mcmc_count):
             x_decoded, _ = model.predict(
-                [batch_x, batch_missing], batch_size=g_mc_batch_size)
-            batch_x[batch_missing > 0] = x_decoded[batch_missing > 0]
+                [chunk_x, chunk_missing], batch_size=g_mc_batch_size)
+            chunk_x[is_missing] = x_decoded[is_missing]
+
+        for i in range(0, size, batch_size):
+            yield ([
+                chunk_x[i:i + batch_size],
+                chunk_missing[i:i + batch_size],
+            ], None)
 
-        yield ([batch_x, batch_missing], None)
+
+class TrainingThroughput:
+    """
+    Measure the training throughput in batches per second, and the
+    duration of epochs in seconds, validation included
+
+    `epoch_cb(batches_per_sec, epoch_time)` is called at the end of each
+    epoch.
+    """
+
+    def __init__(self, epoch_cb=None):
+        self.epoch_cb = epoch_cb
+        self.batches = 0
+        self.elapsed = 0.0
+        self.epochs = 0
+        self.epochs_elapsed = 0.0
+        self._epoch_batches = 0
+        self._start = None
+        self._last = None
+
+    @property
+    def batches_per_sec(self):
+        if self.elapsed <= 0:
+            return None
+        return self.batches / self.elapsed
+
+    @property
+    def epoch_time(self):
+        if self.epochs == 0:
+            return None
+        return self.epochs_elapsed / self.epochs
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._start = self._last = time.perf_counter()
+        self._epoch_batches = 0
+
+    def on_batch_end(self, batch, logs=None):
+        self._last = time.perf_counter()
+        self._epoch_batches += 1
+
+    def on_epoch_end(self, epoch, logs=None):
+        epoch_time = time.perf_counter() - self._start
+        self.epochs += 1
+        self.epochs_elapsed += epoch_time
+
+        # validation time is not included
+        elapsed = self._last - self._start
+        self.batches += self._epoch_batches
+        self.elapsed += elapsed
+        if self.epoch_cb is not None and elapsed > 0:
+            self.epoch_cb(self._epoch_batches / elapsed, epoch_time)
+
+    def callback(self):
+        """
+        Return a Keras callback
+        """
+        return LambdaCallback(
+            on_epoch_begin=self.on_epoch_begin,
+            on_batch_end=self.on_batch_end,
+            on_epoch_end=self.on_epoch_end,
+        )
+
+
+class SuccessiveHalving:
+    """
+    Asynchronous successive halving of hyperparameter search trials
+
+    Trials report their validation loss at rungs of `min_epochs * eta^k`
+    epochs. A trial is stopped at a rung if its loss is not in the best
+    1/eta of the losses reported at this rung so far.
+    """
+
+    def __init__(self, min_epochs, eta=3, rungs=None):
+        self.min_epochs = min_epochs
+        self.eta = eta
+        # losses reported at each rung, indexed by number of epochs
+        self.rungs = rungs or {}
+
+    def is_rung(self, epochs):
+        rung = self.min_epochs
+        while rung < epochs:
+            rung *= self.eta
+        return rung == epochs
+
+    def report(self, epochs, loss):
+        """
+        Report the loss of a trial at a rung. Return False if the trial
+        must be stopped
+        """
+        losses = self.rungs.setdefault(epochs, [])
+        losses.append(loss)
+        nb_kept = len(losses) // self.eta
+        if nb_kept == 0:
+            return True
+        return loss <= sorted(losses)[nb_kept - 1]
+
+    def merge(self, rungs):
+        """
+        Add losses reported to another instance
+        """
+        for epochs, losses in rungs.items():
+            self.rungs.setdefault(epochs, []).extend(losses)
+
+    def callback(self, keras_model):
+        """
+        Return a Keras callback that stops the training of pruned trials,
+        and a dict that tells whether the trial was pruned and holds the
+        losses it reported
+        """
+        trial = {'pruned': False, 'rungs': {}}
+
+        def on_epoch_end(epoch, logs=None):
+            epochs = epoch + 1
+            loss = (logs or {}).get('val_loss')
+            if loss is None or not self.is_rung(epochs):
+                return
+            trial['rungs'][epochs] = [float(loss)]
+            if not self.report(epochs, float(loss)):
+                trial['pruned'] = True
+                keras_model.stop_training = True
+
+        return LambdaCallback(on_epoch_end=on_epoch_end), trial
+
+
+class RunningStats:
+    """
+    Running count, mean and sum of squared differences from the mean (M2)
+    of each feature, updated batch by batch with the parallel variant of
+    Welford's algorithm. Missing values are ignored.
+    """
+
+    def __init__(self, count, mean, m2):
+        self.count = np.array(count, dtype=float)
+        self.mean = np.array(mean, dtype=float)
+        self.m2 = np.array(m2, dtype=float)
+
+    @classmethod
+    def from_dataset(cls, dataset):
+        """
+        Compute the statistics of a dataset
+        """
+        count = np.sum(~np.isnan(dataset), axis=0)
+        total = np.nansum(dataset, axis=0)
+        mean = np.divide(
+            total, count, out=np.zeros_like(total), where=count > 0)
+        m2 = np.nansum((dataset - mean) ** 2, axis=0)
+        return cls(np.atleast_1d(count), np.atleast_1d(mean),
+                   np.atleast_1d(m2))
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['count'], data['mean'], data['m2'])
+
+    def to_dict(self):
+        return {
+            'count': self.count.tolist(),
+            'mean': self.mean.tolist(),
+            'm2': self.m2.tolist(),
+        }
+
+    @property
+    def std(self):
+        return np.sqrt(np.divide(
+            self.m2, self.count,
+            out=np.zeros_like(self.m2), where=self.count > 0))
+
+    def update(self, dataset):
+        """
+        Add the values of a dataset
+        """
+        other = RunningStats.from_dataset(dataset)
+        count = self.count + other.count
+        ratio = np.divide(
+            other.count, count, out=np.zeros_like(count), where=count > 0)
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * ratio
+        self.m2 = self.m2 + other.m2 + delta ** 2 * self.count * ratio
+        self.count = count
+
+    def drift(self, means, stds):
+        """
+        Compare the statistics with the reference scale of a model.
+
+        Returns the largest shift of the means, in reference standard
+        deviations, and the largest ratio of standard deviations, or its
+        inverse if it is lower than 1
+        """
+        valid = self.count > 0
+        if not np.any(valid):
+            return None
+
+        std = self.std[valid]
+        std[std == 0] = 1.0
+        stds = np.asarray(stds)[valid]
+        shift = np.abs(self.mean[valid] - np.asarray(means)[valid]) / stds
+        ratio = np.maximum(std / stds, stds / std)
+        return {
+            'mean_shift': float(np.max(shift)),
+            'std_ratio': float(np.max(ratio)),
+        }
 
 
 def convert_to_generator_like(data,
@@ -507,6 +1154,21 @@ class DonutModel(Model):
         Optional('seasonality', default=DEFAULT_SEASONALITY): schemas.seasonality,
         Optional('forecast'): Any(None, "auto", All(int, Range(min=1))),
         Optional('grace_period', default=0): schemas.TimeDelta(min=0, min_included=True),
+        Optional('forecast_particles', default=0): All(int, Range(min=0)),
+        Optional('bounds', default='mc'): Any('mc', 'unscented'),
+        Optional('mc_tolerance', default=0): All(
+            Any(float, int), Range(min=0)),
+        Optional('mc_min_samples', default=100): All(int, Range(min=1)),
+        Optional('mc_max_samples', default=g_mc_count): All(
+            int, Range(min=1)),
+        Optional('warm_max_evals'): All(int, Range(min=1)),
+        Optional('halving_min_epochs', default=0): All(int, Range(min=0)),
+        Optional('halving_eta', default=3): All(int, Range(min=2)),
+        Optional('span_candidates', default=3): All(int, Range(min=0)),
+        Optional('window_stride', default=1): All(int, Range(min=1)),
+        Optional('max_windows', default=0): All(int, Range(min=0)),
+        Optional('max_missing_ratio', default=1.0): All(
+            Any(float, int), Range(min=0, max=1)),
     })
 
     def __init__(self, settings, state=None):
@@ -524,10 +1186,22 @@ class DonutModel(Model):
 
         self.means = None
         self.stds = None
+        self.stats = None
         self.scores = None
         self._keras_model = None
         self._encoder_model = None
         self._decoder_model = None
+        self._graph = None
+        self._session = None
+        self._trials_history = []
+        self.halving_min_epochs = settings.get('halving_min_epochs')
+        self.halving_eta = settings.get('halving_eta')
+        self.span_candidates = settings.get('span_candidates')
+        self.window_stride = settings.get('window_stride')
+        self.max_windows = settings.get('max_windows')
+        self.max_missing_ratio = settings.get('max_missing_ratio')
+        self.nb_windows = None
+        self.span_scores = None
 
         if self.span is None or self.span == "auto":
             self.min_span = settings.get('min_span') or _hp_span_min
@@ -538,6 +1212,12 @@ class DonutModel(Model):
 
         self.grace_period = parse_timedelta(
             settings['grace_period']).total_seconds()
+        self.forecast_particles = settings['forecast_particles']
+        self.bounds = settings['bounds']
+        self.mc_tolerance = settings['mc_tolerance']
+        self.mc_min_samples = settings['mc_min_samples']
+        self.mc_max_samples = max(
+            settings['mc_min_samples'], settings['mc_max_samples'])
 
         self.current_eval = None
         if len(self.features) > 1:
@@ -559,9 +1239,11 @@ class DonutModel(Model):
     def W(self):
         return self.span
 
-    def get_hp_span(self, label):
+    def get_hp_span(self, label, spans=None):
         if (self.max_span - self.min_span) <= 0:
             space = self.span
+        elif spans:
+            space = hp.choice(label, spans)
         else:
             space = self.min_span + \
                 hp.randint(label, (self.max_span - self.min_span))
@@ -616,11 +1298,12 @@ class DonutModel(Model):
         """
         Scale dataset values
         """
-
+        # keep the precision of the dataset
+        dtype = np.result_type(dataset.dtype, np.float32)
         out = _get_scores(
             dataset,
-            _mean=self.means[0],
-            _std=self.stds[0],
+            _mean=dtype.type(self.means[0]),
+            _std=dtype.type(self.stds[0]),
         )
 
         return out
@@ -632,11 +1315,11 @@ class DonutModel(Model):
         """
         Revert scaling dataset values
         """
-
+        dtype = np.result_type(dataset.dtype, np.float32)
         out = _revert_scores(
             dataset,
-            _mean=self.means[0],
-            _std=self.stds[0],
+            _mean=dtype.type(self.means[0]),
+            _std=dtype.type(self.stds[0]),
         )
 
         return out
@@ -648,6 +1331,34 @@ class DonutModel(Model):
         self.means = np.array([np.nanmean(dataset, axis=0)])
         self.stds = np.array([np.nanstd(dataset, axis=0)])
         self.stds[self.stds == 0] = 1.0
+        self.stats = RunningStats.from_dataset(dataset)
+
+    def update_stats(self, dataset):
+        """
+        Add new data to the running statistics, keeping the reference
+        scale. Returns the scale drift of the new data, see
+        `RunningStats.drift()`
+        """
+        # The history would hide a recent drift in the cumulative stats
+        batch = RunningStats.from_dataset(dataset)
+        if self.stats is None:
+            self.stats = batch
+        else:
+            self.stats.update(dataset)
+
+        drift = batch.drift(self.means, self.stds)
+        if drift is not None:
+            drift['detected'] = drift['mean_shift'] > MAX_MEAN_SHIFT or \
+                drift['std_ratio'] > MAX_STD_RATIO
+            if drift['detected']:
+                logging.warning(
+                    "model %s: scale drift detected: mean shift=%f std "
+                    "ratio=%f, the model should be trained again",
+                    self.name,
+                    drift['mean_shift'],
+                    drift['std_ratio'],
+                )
+        return drift
 
     def set_auto_threshold(self):
         """
@@ -657,7 +1368,8 @@ class DonutModel(Model):
         self.min_threshold = 68
         self.max_threshold = 99.7
 
-    def _set_xpu_config(self, num_cpus, num_gpus):
+    def _get_xpu_config(self, num_cpus, num_gpus):
+        _import_tensorflow()
         if os.environ.get('PYTHONHASHSEED'):
             config = tf.ConfigProto(
                 intra_op_parallelism_threads=1,
@@ -672,10 +1384,319 @@ class DonutModel(Model):
             config.gpu_options.allow_growth = True
             config.log_device_placement = True
 
+        return config
+
+    def _set_xpu_config(self, num_cpus, num_gpus):
+        config = self._get_xpu_config(num_cpus, num_gpus)
         sess = tf.Session(graph=tf.get_default_graph(), config=config)
         set_seed()
         K.set_session(sess)
 
+    @contextlib.contextmanager
+    def _keras_scope(self):
+        """
+        Make the graph and the session of the loaded model the default ones
+        """
+        if self._graph is None:
+            yield
+            return
+
+        with self._graph.as_default(), self._session.as_default():
+            yield
+
+    def _cross_val_model(
+        self,
+        dataset,
+        params,
+        train_size=0.67,
+        batch_size=64,
+        num_epochs=250,
+        num_cpus=1,
+        num_gpus=0,
+        abnormal=None,
+        epoch_cb=None,
+        halving=None,
+        initial_weights=None,
+        initial_epoch=0,
+        checkpoint_cb=None,
+    ):
+        """
+        Train a model with the given hyperparameters on a scaled dataset
+
+        Returns the validation loss and the Keras model. The training
+        throughput is saved in `batches_per_sec`, the mean duration of
+        epochs in `epoch_time` and the number of training windows in
+        `nb_windows`. If `halving` is set, the
+        trial may be pruned: see `SuccessiveHalving`. The outcome is saved
+        in `halving_trial`.
+
+        An interrupted training is continued from `initial_weights` saved
+        after `initial_epoch` epochs. The optimizer state is not restored.
+        `checkpoint_cb(epochs, keras_model)` is called at the end of each
+        epoch.
+        """
+        _import_tensorflow()
+
+        keras_model = None
+        # Destroys the current TF graph and creates a new one.
+        # Useful to avoid clutter from old models / layers.
+        K.clear_session()
+        self._set_xpu_config(num_cpus, num_gpus)
+
+        self.span = W = params.span
+        (X_miss, X_train), (X_miss_val, X_test) = self.train_test_split(
+            dataset,
+            train_size=train_size,
+            abnormal=abnormal,
+        )
+        if len(X_train) == 0:
+            raise errors.NoData("insufficient training data")
+        if len(X_test) == 0:
+            raise errors.NoData("insufficient validation data")
+
+        self.nb_windows = len(X_train)
+        logging.info(
+            "span=%d: %d training windows, %d validation windows",
+            W, len(X_train), len(X_test),
+        )
+
+        keras_model = _build_keras_model(
+            W,
+            params.intermediate_dim,
+            params.latent_dim,
+            params.optimizer,
+        )
+        if initial_weights is not None:
+            _set_keras_weights(keras_model, initial_weights)
+
+        _stop = EarlyStopping(
+            monitor='val_loss',
+            patience=5,
+            verbose=_verbose,
+            mode='auto',
+        )
+        throughput = TrainingThroughput(epoch_cb)
+        callbacks = [_stop, throughput.callback()]
+        self.halving_trial = None
+        if halving is not None:
+            halving_cb, self.halving_trial = halving.callback(keras_model)
+            callbacks.append(halving_cb)
+        if checkpoint_cb is not None:
+            callbacks.append(LambdaCallback(
+                on_epoch_end=lambda epoch, logs: checkpoint_cb(
+                    epoch + 1, keras_model),
+            ))
+        steps_per_epoch = int(math.ceil(len(X_train) / batch_size))
+        keras_model.fit_generator(
+            generator(
+                X_train,
+                X_miss,
+                batch_size,
+                keras_model,
+                steps_per_epoch=steps_per_epoch,
+            ),
+            epochs=num_epochs,
+            initial_epoch=initial_epoch,
+            steps_per_epoch=steps_per_epoch,
+            verbose=_verbose,
+            validation_data=convert_to_generator_like(
+                (X_test, X_miss_val),
+                batch_size=batch_size,
+                epochs=num_epochs,
+                shuffle=False,
+            ),
+            validation_steps=int(math.ceil(len(X_test) / batch_size)),
+            callbacks=callbacks,
+            workers=0,  # https://github.com/keras-team/keras/issues/5511
+        )
+        self.batches_per_sec = throughput.batches_per_sec
+        self.epoch_time = throughput.epoch_time
+
+        # How well did it do?
+        score = keras_model.evaluate(
+            [X_test, X_miss_val],
+            batch_size=batch_size,
+            verbose=_verbose,
+        )
+
+        return score, keras_model
+
+    def _parallel_search(
+        self,
+        objective,
+        space,
+        dataset,
+        trials,
+        max_evals,
+        num_jobs,
+        rstate,
+        train_size=0.67,
+        batch_size=64,
+        num_epochs=250,
+        trial_cb=None,
+        abnormal=None,
+        halving=None,
+    ):
+        """
+        Run the hyperparameter search with `num_jobs` trials in flight
+
+        TPE suggests one point per call, so a batch is built by suggesting
+        repeatedly: pending trials have no loss yet and the next suggestion
+        is drawn from the other points. Each trial is trained in its own
+        process and TensorFlow session. The scaled dataset is written once
+        and memory-mapped read-only by the trial processes.
+
+        With successive halving, trials are pruned using the losses of the
+        previous batches.
+
+        `max_evals` trials are added to `trials`. `trial_cb(params, result)`
+        is called after each successful trial. Returns the best point, as
+        `fmin()` does
+        """
+        domain = base.Domain(objective, space)
+
+        with tempfile.TemporaryDirectory(prefix='loudml-') as tmpdir:
+            dataset_path = os.path.join(tmpdir, 'dataset.npy')
+            np.save(dataset_path, dataset)
+            abnormal_path = None
+            if abnormal is not None:
+                abnormal_path = os.path.join(tmpdir, 'abnormal.npy')
+                np.save(abnormal_path, abnormal)
+
+            # Forking a process that has already used TensorFlow is unsafe
+            ctx = multiprocessing.get_context('spawn')
+            with ctx.Pool(num_jobs) as pool:
+                nb_trials = len(trials) + max_evals
+                while len(trials) < nb_trials:
+                    docs = []
+                    for _ in range(min(num_jobs, nb_trials - len(trials))):
+                        new_docs = tpe.suggest(
+                            trials.new_trial_ids(1),
+                            domain,
+                            trials,
+                            rstate.randint(2 ** 31 - 1),
+                        )
+                        trials.insert_trial_docs(new_docs)
+                        trials.refresh()
+                        # Inserted documents are copies
+                        docs += trials.trials[-len(new_docs):]
+
+                    params = [
+                        space_eval(space, base.spec_from_misc(doc['misc']))
+                        for doc in docs
+                    ]
+                    results = [
+                        pool.apply_async(_cross_val_trial, (
+                            self.settings,
+                            dataset_path,
+                            abnormal_path,
+                            doc_params,
+                            train_size,
+                            batch_size,
+                            num_epochs,
+                            None if halving is None else halving.rungs,
+                        ))
+                        for doc_params in params
+                    ]
+
+                    # Results are recorded in suggestion order so that the
+                    # search is reproducible
+                    for doc, doc_params, result in zip(docs, params, results):
+                        doc['result'] = result.get()
+                        doc['state'] = base.JOB_STATE_DONE
+                        if doc['result']['status'] == STATUS_OK:
+                            if halving is not None:
+                                halving.merge(
+                                    doc['result']['halving']['rungs'])
+                            if trial_cb is not None:
+                                trial_cb(doc_params, doc['result'])
+
+                    trials.refresh()
+
+        return trials.argmin
+
+    def _load_trials(self, trials, history, latent_dims, neurons, spans=None):
+        """
+        Add the trials of previous trainings to a Trials object
+
+        Points that are not in the current search space are ignored
+        """
+        for entry in history[-MAX_TRIALS_HISTORY:]:
+            params = entry['params']
+            if entry.get('loss') is None:
+                continue
+            try:
+                vals = {
+                    'case': [0],
+                    'latent_dim': [latent_dims.index(params['latent_dim'])],
+                    'i1': [neurons.index(params['intermediate_dim'])],
+                    'optimizer': [['adam'].index(params['optimizer'])],
+                }
+            except (KeyError, ValueError):
+                continue
+
+            if (self.max_span - self.min_span) > 0 and spans:
+                if params.get('span') not in spans:
+                    continue
+                vals['span'] = [spans.index(params['span'])]
+            elif (self.max_span - self.min_span) > 0:
+                offset = params.get('span', 0) - self.min_span
+                if not 0 <= offset < (self.max_span - self.min_span):
+                    continue
+                vals['span'] = [offset]
+            elif params.get('span') != self.span:
+                continue
+
+            tid, = trials.new_trial_ids(1)
+            docs = trials.new_trial_docs(
+                [tid],
+                [None],
+                [{'loss': entry['loss'], 'status': STATUS_OK}],
+                [{
+                    'tid': tid,
+                    'cmd': ('domain_attachment', 'FMinIter_Domain'),
+                    'workdir': None,
+                    'idxs': {key: [tid] for key in vals},
+                    'vals': vals,
+                }],
+            )
+            docs[0]['state'] = base.JOB_STATE_DONE
+            trials.insert_trial_docs(docs)
+
+        trials.refresh()
+
+    def _dump_trials(self, trials, space, limit=MAX_TRIALS_HISTORY):
+        """
+        Return the last `limit` successful trials among the trial documents
+        of a search, to be saved in the state
+        """
+        history = []
+        for trial in trials:
+            result = trial['result']
+            if result.get('status') != STATUS_OK or result['loss'] is None:
+                continue
+            vals = {
+                key: val[0]
+                for key, val in trial['misc']['vals'].items() if val
+            }
+            history.append({
+                'params': _params_to_json(space_eval(space, vals)),
+                'loss': float(result['loss']),
+            })
+        return history[-limit:] if limit else history
+
+    def _get_span_scores(self, trials, space, spans):
+        """
+        Return the best loss of each candidate span among the trial
+        documents of a search
+        """
+        losses = {span: None for span in spans}
+        for entry in self._dump_trials(trials, space, limit=None):
+            span = entry['params']['span']
+            if losses[span] is None or entry['loss'] < losses[span]:
+                losses[span] = entry['loss']
+        return [{'span': span, 'loss': losses[span]} for span in spans]
+
     def _train_on_dataset(
         self,
         dataset,
@@ -687,138 +1708,148 @@ class DonutModel(Model):
         max_evals=None,
         progress_cb=None,
         abnormal=None,
+        checkpoint=None,
     ):
+        """
+        Search the best hyperparameters and train the model
+
+        With a `checkpoint`, the progress of the search is saved after each
+        trial and each epoch. A search saved in the checkpoint is resumed:
+        completed trials are not run again, and the running trial continues
+        from its last epoch. The weights of the best trial are used instead
+        of training the model again at the end of the search.
+        """
+        _import_tensorflow()
+
+        history = []
+        if self._state is not None:
+            history = self._state.get('trials', [])
+
         if max_evals is None:
             # latent_dim*intermediate_dim
             max_evals = self.settings.get('max_evals', 21)
+            space_evals = max_evals
+            warm_max_evals = self.settings.get('warm_max_evals')
+            if history and warm_max_evals:
+                max_evals = min(max_evals, warm_max_evals)
+        else:
+            space_evals = max_evals
 
         self.current_eval = 0
 
         self.stat_dataset(dataset)
         dataset = self.scale_dataset(dataset)
 
-        def cross_val_model(params):
-            keras_model = None
-            # Destroys the current TF graph and creates a new one.
-            # Useful to avoid clutter from old models / layers.
-            K.clear_session()
-            self._set_xpu_config(num_cpus, num_gpus)
-
-            self.span = W = params.span
-            (X_miss, X_train), (X_miss_val, X_test) = self.train_test_split(
-                dataset,
-                train_size=train_size,
-                abnormal=abnormal,
-            )
-            if len(X_train) == 0:
-                raise errors.NoData("insufficient training data")
-            if len(X_test) == 0:
-                raise errors.NoData("insufficient validation data")
-
-            # expected input data shape: (batch_size, timesteps,)
-            # network parameters
-            input_shape = (W, )
-            intermediate_dim = params.intermediate_dim
-            latent_dim = params.latent_dim
-
-            # VAE model = encoder + decoder
-            # build encoder model
-            main_input = Input(shape=input_shape)
-            # bool vector to flag missing data points
-            aux_input = Input(shape=input_shape)
-            aux_output = Lambda(lambda x: x)(aux_input)
-            x = Dense(intermediate_dim,
-                      kernel_regularizer=regularizers.l2(0.001),
-                      activation='relu')(main_input)
-            x = Dense(intermediate_dim,
-                      kernel_regularizer=regularizers.l2(0.001),
-                      activation='relu')(x)
-            z_mean = Dense(latent_dim, name='z_mean')(x)
-            z_log_var = Dense(latent_dim, name='z_log_var')(x)
-
-            # use reparameterization trick to push the sampling out as input
-            # note that "output_shape" isn't necessary with the TensorFlow backend
-            z = Lambda(sampling, output_shape=(latent_dim,),
-                       name='z')([z_mean, z_log_var])
-
-            # build decoder model
-            x = Dense(intermediate_dim,
-                      kernel_regularizer=regularizers.l2(0.001),
-                      activation='relu', name='decoder_dense_0')(z)
-            x = Dense(intermediate_dim,
-                      kernel_regularizer=regularizers.l2(0.001),
-                      activation='relu', name='decoder_dense_1')(x)
-            main_output = Dense(W, activation='linear', name='decoder_dense_2')(x)
-
-            # instantiate Donut model
-            keras_model = _Model([main_input, aux_input], [
-                                 main_output, aux_output], name='donut')
-            add_loss(keras_model, W)
-            optimizer_cls = None
-            if params.optimizer == 'adam':
-                optimizer_cls = tf.keras.optimizers.Adam(clipnorm=10.)
-
-            keras_model.compile(
-                optimizer=optimizer_cls,
-            )
-
-            _stop = EarlyStopping(
-                monitor='val_loss',
-                patience=5,
-                verbose=_verbose,
-                mode='auto',
-            )
-            keras_model.fit_generator(
-                generator(X_train, X_miss, batch_size, keras_model),
-                epochs=num_epochs,
-                steps_per_epoch=int(math.ceil(len(X_train) / batch_size)),
-                verbose=_verbose,
-                validation_data=convert_to_generator_like(
-                    (X_test, X_miss_val),
-                    batch_size=batch_size,
-                    epochs=num_epochs,
-                    shuffle=False,
-                ),
-                validation_steps=int(math.ceil(len(X_test) / batch_size)),
-                callbacks=[_stop],
-                workers=0,  # https://github.com/keras-team/keras/issues/5511
+        halving = None
+        self.nb_pruned = 0
+        if self.halving_min_epochs > 0:
+            halving = SuccessiveHalving(
+                self.halving_min_epochs,
+                self.halving_eta,
             )
 
-            # How well did it do?
-            score = keras_model.evaluate(
-                [X_test, X_miss_val],
-                batch_size=batch_size,
-                verbose=_verbose,
-            )
+        def report_progress(batches_per_sec, epoch_time, windows):
+            kwargs = {
+                'batches_per_sec': batches_per_sec,
+                'epoch_time': epoch_time,
+                'windows': windows,
+            }
+            if halving is not None:
+                kwargs['pruned'] = self.nb_pruned
+            progress_cb(self.current_eval, max_evals, **kwargs)
 
+        def trial_cb(params, result, weights=None):
             self.current_eval += 1
+            if result.get('halving') and result['halving']['pruned']:
+                self.nb_pruned += 1
+            if checkpoint is not None:
+                checkpoint.add_trial(
+                    _params_to_json(params), result['loss'], weights)
             if progress_cb is not None:
-                progress_cb(self.current_eval, max_evals)
-
-            return score, keras_model
-
-        hyperparameters = HyperParameters()
+                report_progress(
+                    result.get('batches_per_sec'),
+                    result.get('epoch_time'),
+                    result.get('windows'),
+                )
 
-        # Parameter search space
-        def objective(args):
-            hyperparameters.assign(args)
+        epoch_cb = None
+        if progress_cb is not None:
+            def epoch_cb(batches_per_sec, epoch_time):
+                report_progress(batches_per_sec, epoch_time, self.nb_windows)
+
+        def run_trial(params, initial_weights=None, initial_epoch=0):
+            checkpoint_cb = None
+            if checkpoint is not None:
+                params_json = _params_to_json(params)
+
+                def checkpoint_cb(epochs, keras_model):
+                    checkpoint.add_epoch(
+                        params_json,
+                        epochs,
+                        npdonut.export_weights(keras_model),
+                    )
 
             try:
-                score, _ = cross_val_model(hyperparameters)
-                return {'loss': nan_to_none(score), 'status': STATUS_OK}
+                score, keras_model = self._cross_val_model(
+                    dataset,
+                    HyperParameters(params),
+                    train_size=train_size,
+                    batch_size=batch_size,
+                    num_epochs=num_epochs,
+                    num_cpus=num_cpus,
+                    num_gpus=num_gpus,
+                    abnormal=abnormal,
+                    epoch_cb=epoch_cb,
+                    halving=halving,
+                    initial_weights=initial_weights,
+                    initial_epoch=initial_epoch,
+                    checkpoint_cb=checkpoint_cb,
+                )
             except Exception as exn:
                 logging.warning("iteration failed: %s", exn)
                 return {'loss': None, 'status': STATUS_FAIL}
 
+            result = {
+                'loss': nan_to_none(score),
+                'status': STATUS_OK,
+                'batches_per_sec': self.batches_per_sec,
+                'epoch_time': self.epoch_time,
+                'windows': self.nb_windows,
+                'halving': self.halving_trial,
+            }
+            weights = None
+            pruned = self.halving_trial and self.halving_trial['pruned']
+            if checkpoint is not None and not pruned:
+                weights = npdonut.export_weights(keras_model)
+            trial_cb(params, result, weights)
+            return result
+
+        # Parameter search space
+        def objective(args):
+            return run_trial(args)
+
         latent_dims = [3, 5, 8]
-        if max_evals > len(latent_dims) and self.span != 'auto':
+        if space_evals > len(latent_dims) and self.span != 'auto':
             neurons = [21, 34, 55, 89, 144, 233]
         else:
             neurons = [100]
 
+        spans = None
+        if self.span_candidates > 0 and (self.max_span - self.min_span) > 0:
+            spans = _find_spans(
+                dataset,
+                self.min_span,
+                self.max_span,
+                self.span_candidates,
+            )
+            if spans:
+                logging.info("candidate spans: %s", spans)
+            else:
+                logging.info("no periodicity found, searching all spans")
+
         space = hp.choice('case', [
             {
-                'span': self.get_hp_span('span'),
+                'span': self.get_hp_span('span', spans),
                 'latent_dim': hp.choice('latent_dim', latent_dims),
                 'intermediate_dim': hp.choice('i1', neurons),
                 'optimizer': hp.choice('optimizer', ['adam']),
@@ -827,6 +1858,45 @@ class DonutModel(Model):
 
         # The Trials object will store details of each iteration
         trials = Trials()
+        self._load_trials(trials, history, latent_dims, neurons, spans)
+        nb_loaded = len(trials)
+        if nb_loaded:
+            logging.info("resuming search with %d previous trials", nb_loaded)
+
+        running = None
+        if checkpoint is not None:
+            self._load_trials(
+                trials,
+                checkpoint.progress['trials'],
+                latent_dims,
+                neurons,
+                spans,
+            )
+            running = checkpoint.progress['running']
+            self.current_eval = len(trials) - nb_loaded
+            if self.current_eval or running:
+                logging.info(
+                    "resuming training job: %d trials done",
+                    self.current_eval,
+                )
+
+        if running is not None and self.current_eval < max_evals and \
+           'running' in checkpoint.weights:
+            result = run_trial(
+                running['params'],
+                initial_weights=checkpoint.weights['running'],
+                initial_epoch=running['epochs'],
+            )
+            if result['status'] == STATUS_OK:
+                self._load_trials(trials, [{
+                    'params': running['params'],
+                    'loss': result['loss'],
+                }], latent_dims, neurons, spans)
+
+        remaining = max_evals - self.current_eval
+
+        # GPU memory cannot be shared between trial processes
+        num_jobs = min(num_cpus, remaining) if num_gpus == 0 else 1
 
         # Run the hyperparameter search using the tpe algorithm
         try:
@@ -834,23 +1904,72 @@ class DonutModel(Model):
             if os.environ.get('RANDOM_SEED'):
                 fmin_state = np.random.RandomState(
                     int(os.environ.get('RANDOM_SEED')))
-            best = fmin(
-                objective,
-                space,
-                algo=tpe.suggest,
-                max_evals=max_evals,
-                trials=trials,
-                rstate=fmin_state,
-            )
+            if remaining <= 0:
+                best = trials.argmin
+            elif num_jobs > 1:
+                if fmin_state is None:
+                    fmin_state = np.random.RandomState()
+                best = self._parallel_search(
+                    objective,
+                    space,
+                    dataset,
+                    trials,
+                    max_evals=remaining,
+                    num_jobs=num_jobs,
+                    rstate=fmin_state,
+                    train_size=train_size,
+                    batch_size=batch_size,
+                    num_epochs=num_epochs,
+                    trial_cb=trial_cb,
+                    abnormal=abnormal,
+                    halving=halving,
+                )
+            else:
+                best = fmin(
+                    objective,
+                    space,
+                    algo=tpe.suggest,
+                    max_evals=len(trials) + remaining,
+                    trials=trials,
+                    rstate=fmin_state,
+                )
         except ValueError:
             raise errors.NoData(
                 "training failed, try to increase the time range")
 
+        self._trials_history = self._dump_trials(trials.trials, space)
+
+        self.span_scores = None
+        if spans:
+            self.span_scores = self._get_span_scores(
+                trials.trials[nb_loaded:], space, spans)
+
         # Get the values of the optimal parameters
         best_params = space_eval(space, best)
-        score, self._keras_model = cross_val_model(
-            HyperParameters(best_params)
-        )
+        best_trial = None
+        if checkpoint is not None and 'best' in checkpoint.weights:
+            best_trial = checkpoint.progress['best']
+
+        if best_trial is not None and \
+           best_trial['params'] == _params_to_json(best_params):
+            logging.info("using the weights of the best trial")
+            K.clear_session()
+            self._set_xpu_config(num_cpus, num_gpus)
+            self._keras_model = _load_keras_model(
+                best_params, checkpoint.weights['best'])
+            score = best_trial['loss']
+        else:
+            score, self._keras_model = self._cross_val_model(
+                dataset,
+                HyperParameters(best_params),
+                train_size=train_size,
+                batch_size=batch_size,
+                num_epochs=num_epochs,
+                num_cpus=num_cpus,
+                num_gpus=num_gpus,
+                abnormal=abnormal,
+                epoch_cb=epoch_cb,
+            )
         self.span = best_params['span']
         return (best_params, score)
 
@@ -864,14 +1983,17 @@ class DonutModel(Model):
         abnormal=None,
     ):
         self.current_eval = 0
-        self.stat_dataset(dataset)
-
+        # The weights were trained with the reference scale
         dataset = self.scale_dataset(dataset)
 
         (X_miss, X_train), (X_miss_val, X_test) = self.train_test_split(
             dataset,
             train_size=train_size,
         )
+        if len(X_train) == 0:
+            raise errors.NoData("insufficient training data")
+        if len(X_test) == 0:
+            raise errors.NoData("insufficient validation data")
 
         _stop = EarlyStopping(
             monitor='val_loss',
@@ -900,46 +2022,48 @@ class DonutModel(Model):
         """
         Compute scores and mean squared error
         """
+        scores, mses = self.compute_scores(
+            np.array([y_true], dtype=float),
+            np.array([y_pred], dtype=float),
+            np.array([y_low], dtype=float),
+            np.array([y_high], dtype=float),
+        )
+        return scores[0], mses[0]
+
+    def compute_scores(self, observed, predicted, low, high):
+        """
+        Compute timeseries scores and MSE
+
+        Buckets are scored in a few array operations. The [low, high]
+        range is a 3-sigma interval. Buckets with an undefined score, e.g.
+        missing observed values, score 100, as they always did.
+        """
         feature = self.features[0]
 
-        diff = y_true - y_pred
+        observed = np.asarray(observed, dtype=float)
+        diff = observed - predicted
         ano_type = feature.anomaly_type
-        mu = (y_low + y_high) / 2.0
-        std = (y_high - mu) / 3.0
-        score = 2 * norm.cdf(abs(y_true - mu), loc=0, scale=std) - 1
+        mu = (low + high) / 2.0
+        std = (high - mu) / 3.0
+        score = 2 * norm.cdf(np.abs(observed - mu), loc=0, scale=std) - 1
         # Required to handle the 'low' condition
-        if diff < 0:
-            score *= -1
+        score = np.where(diff < 0, -score, score)
 
         if ano_type == 'low':
-            score = -min(score, 0)
+            score = np.where(score > 0, 0.0, -score)
         elif ano_type == 'high':
-            score = max(score, 0)
+            score = np.where(score < 0, 0.0, score)
         else:
-            score = abs(score)
-
-        score = 100 * max(0, min(1, score))
-
-        mse = np.nanmean((diff ** 2), axis=None)
-        return score, mse
-
-    def compute_scores(self, observed, predicted, low, high):
-        """
-        Compute timeseries scores and MSE
-        """
-
-        nb_buckets = len(observed)
-        scores = np.empty((nb_buckets,), dtype=float)
-        mses = np.empty((nb_buckets), dtype=float)
-
-        for i in range(nb_buckets):
-            scores[i], mses[i] = self.compute_bucket_scores(
-                observed[i],
-                predicted[i],
-                low[i],
-                high[i],
-            )
+            score = np.abs(score)
 
+        # clip to [0, 1]. Zeros are positive, NaN is 1
+        score = np.where(
+            np.isnan(score),
+            1.0,
+            np.where(score > 0, np.minimum(score, 1.0), 0.0),
+        )
+        scores = 100 * score
+        mses = diff * diff
         return scores, mses
 
     def _format_dataset(self, x, accept_missing=True, abnormal=None):
@@ -962,38 +2086,85 @@ class DonutModel(Model):
         ]
 
         Buckets with missing values are flagged in the missing array.
+
+        Both arrays are read-only sliding window views: the masks are
+        computed once over the whole series and windows are materialized
+        by batches when rows are indexed. They are copies when
+        `accept_missing` is False.
         """
-        missing = []
-        data_x = []
-        for i in range(len(x) - self.W + 1):
-            j = i + self.W
-            if accept_missing or not np.isnan(x[i:j]).any():
-                # arxiv.org/abs/1802.03903
-                # set user defined abnormal data points to zero
-                if abnormal is None:
-                    is_nan = np.isnan(x[i:j])
-                else:
-                    is_nan = np.logical_or(
-                        np.isnan(x[i:j]),
-                        abnormal[i:j],
-                    )
+        x = np.asarray(x)
+        W = self.W
+        is_nan = np.isnan(x)
+        if abnormal is None:
+            missing = is_nan
+        else:
+            # arxiv.org/abs/1802.03903
+            # set user defined abnormal data points to zero
+            missing = np.logical_or(is_nan, abnormal[:len(x)])
 
-                missing.append(is_nan)
-                _x = np.copy(x[i:j])
-                # set missing points to zero
-                _x[is_nan] = 0.0
-                data_x.append(_x)
+        # set missing points to zero
+        filled = np.copy(x)
+        filled[missing] = 0.0
 
-        return np.array(missing), np.array(data_x)
+        missing = _sliding_windows(missing, W)
+        data_x = _sliding_windows(filled, W)
+
+        if not accept_missing:
+            nb_nan = np.concatenate([[0], np.cumsum(is_nan)])
+            complete = (nb_nan[W:] - nb_nan[:len(data_x)]) == 0
+            missing = missing[complete]
+            data_x = data_x[complete]
+
+        return missing, data_x
+
+    def _sample_windows(self, missing, x, max_windows=0):
+        """
+        Select windows according to `window_stride`, `max_missing_ratio`
+        and `max_windows`
+
+        `missing` and `x` are sliding windows returned by _format_dataset().
+        With `max_windows`, one window is drawn at random in each of
+        `max_windows` equal parts of the time range.
+        """
+        index = np.arange(0, len(x), self.window_stride)
+
+        if self.max_missing_ratio < 1 and len(index) > 0:
+            # missing flags of the series, counted with a running sum
+            W = missing.shape[1]
+            flags = np.concatenate([missing[0], missing[1:, -1]])
+            nb_missing = np.concatenate([[0], np.cumsum(flags)])
+            ratio = (nb_missing[index + W] - nb_missing[index]) / W
+            index = index[ratio <= self.max_missing_ratio]
+
+        if max_windows and len(index) > max_windows:
+            bounds = (np.arange(max_windows + 1) * len(index)) // max_windows
+            offsets = np.random.random_sample(max_windows) * \
+                (bounds[1:] - bounds[:-1])
+            index = index[bounds[:-1] + offsets.astype(int)]
+
+        strided = slice(None, None, self.window_stride)
+        if len(index) == len(x[strided]):
+            # nothing filtered out: windows are still views
+            return missing[strided], x[strided]
+        return missing[index], x[index]
 
     def train_test_split(self, dataset, abnormal=None, train_size=0.67):
         """
         Splits data to training and testing parts
         """
         ntrn = round(len(dataset) * train_size)
-        X_train_missing, X_train = self._format_dataset(
-            dataset[0:ntrn], abnormal=abnormal)
-        X_test_missing, X_test = self._format_dataset(dataset[ntrn:])
+        X_train_missing, X_train = self._sample_windows(
+            *self._format_dataset(dataset[0:ntrn], abnormal=abnormal),
+            max_windows=self.max_windows,
+        )
+        max_test_windows = 0
+        if self.max_windows:
+            max_test_windows = max(1, round(
+                self.max_windows * (1 - train_size) / train_size))
+        X_test_missing, X_test = self._sample_windows(
+            *self._format_dataset(dataset[ntrn:]),
+            max_windows=max_test_windows,
+        )
         return (X_train_missing, X_train), (X_test_missing, X_test)
 
     def train(
@@ -1010,15 +2181,49 @@ class DonutModel(Model):
         progress_cb=None,
         incremental=False,
         windows=[],
+        checkpoint=None,
+        force=False,
     ):
         """
         Train model
-        """
-        self.means, self.stds = None, None
-        self.scores = None
 
+        The progress of a hyperparameter search is saved in `checkpoint`,
+        a `TrainingCheckpoint`. If it holds the progress of a search with
+        the same model settings and parameters, the search is resumed.
+
+        The training is skipped if the model was trained with the same
+        data and parameters, unless `force` is set.
+
+        Incremental training only fetches the buckets that follow the data
+        of the previous training, and the last `span - 1` buckets before
+        them. The model keeps its scale: new data is added to running
+        statistics, and a large drift from the scale is reported.
+        """
         period = DateRange.build_date_range(
             from_date, to_date, self.bucket_interval)
+
+        trained_until = None
+        stats_from = 0
+        if incremental:
+            if not self.is_trained:
+                raise errors.ModelNotTrained()
+            trained_until = self._state.get('trained_until')
+
+        if trained_until is not None:
+            if trained_until >= period.to_ts:
+                logging.info("no data since last training, training skipped")
+                return {'skipped': 'unchanged'}
+
+            # The first windows end with the first new buckets
+            W = int(self._state['best_params']['span'])
+            new_from_ts = max(period.from_ts, trained_until)
+            from_ts = max(
+                period.from_ts,
+                new_from_ts - (W - 1) * self.bucket_interval,
+            )
+            stats_from = int((new_from_ts - from_ts) / self.bucket_interval)
+            period = DateRange(from_ts, period.to_ts)
+
         logging.info(
             "train(%s) range=%s train_size=%f batch_size=%d epochs=%d)",
             self.name,
@@ -1062,22 +2267,65 @@ class DonutModel(Model):
             dataset = np.resize(dataset, (nb_buckets_found,))
 
         logging.info("found %d time periods", nb_buckets_found)
+
+        fingerprint = _fingerprint(
+            dataset,
+            abnormal,
+            settings=self.settings,
+            bucket=bucket.name,
+            from_ts=period.from_ts,
+            train_size=train_size,
+            batch_size=batch_size,
+            num_epochs=num_epochs,
+            max_evals=max_evals,
+            incremental=incremental,
+        )
+        if not force and self._state is not None and \
+           self._state.get('fingerprint') == fingerprint:
+            logging.info("training data unchanged, training skipped")
+            return {'skipped': 'unchanged'}
+
+        self.means, self.stds = None, None
+        self.stats = None
+        self.scores = None
+        self.span_scores = None
+        drift = None
+
+        if incremental:
+            checkpoint = None
+        elif checkpoint is not None:
+            job = {
+                'settings': hash_dict(self.settings),
+                'from_ts': period.from_ts,
+                'to_ts': period.to_ts,
+                'max_evals': max_evals,
+                'num_epochs': num_epochs,
+            }
+            if checkpoint.progress is not None and \
+               checkpoint.progress['job'] == job:
+                logging.info("resuming training job")
+            else:
+                checkpoint.start(job)
+
         if progress_cb is not None:
             progress_cb(0, max_evals)
 
         if incremental:
             best_params = self._state.get('best_params', dict())
+            self._trials_history = self._state.get('trials', [])
             # Destroys the current TF graph and creates a new one.
             # Useful to avoid clutter from old models / layers.
             self.load(num_cpus, num_gpus)
-            score = self._train_ckpt_on_dataset(
-                dataset,
-                train_size,
-                batch_size,
-                num_epochs,
-                progress_cb=progress_cb,
-                abnormal=abnormal,
-            )
+            drift = self.update_stats(dataset[stats_from:])
+            with self._keras_scope():
+                score = self._train_ckpt_on_dataset(
+                    dataset,
+                    train_size,
+                    batch_size,
+                    num_epochs,
+                    progress_cb=progress_cb,
+                    abnormal=abnormal,
+                )
         else:
             best_params, score = self._train_on_dataset(
                 dataset,
@@ -1089,6 +2337,7 @@ class DonutModel(Model):
                 max_evals,
                 progress_cb=progress_cb,
                 abnormal=abnormal,
+                checkpoint=checkpoint,
             )
         self.current_eval = None
 
@@ -1098,14 +2347,22 @@ class DonutModel(Model):
                not isinstance(val, float):
                 best_params[key] = np.asscalar(val)
 
-        model_b64 = _serialize_keras_model(self._keras_model)
+        with self._keras_scope():
+            weights = npdonut.export_weights(self._keras_model)
 
         self._state = {
-            'h5py': model_b64,
+            'weights': weights,
             'best_params': best_params,
             'means': self.means.tolist(),
             'stds': self.stds.tolist(),
             'loss': nan_to_none(score),
+            'trials': self._trials_history,
+            'fingerprint': fingerprint,
+            'stats': self.stats.to_dict(),
+            'trained_until': max(
+                period.from_ts + nb_buckets_found * self.bucket_interval,
+                trained_until or period.from_ts,
+            ),
         }
         self.unload()
         # prediction = self.predict(
@@ -1117,9 +2374,14 @@ class DonutModel(Model):
         # )
         # prediction.stat()
 
-        return {
+        result = {
             'loss': nan_to_none(score),
         }
+        if self.span_scores is not None:
+            result['spans'] = self.span_scores
+        if drift is not None:
+            result['drift'] = drift
+        return result
 
     def unload(self):
         """
@@ -1128,34 +2390,95 @@ class DonutModel(Model):
         self._keras_model = None
         self._encoder_model = None
         self._decoder_model = None
-        K.clear_session()
+        if self._session is not None:
+            self._session.close()
+        self._graph = None
+        self._session = None
+        if tf is not None:
+            K.clear_session()
 
-    def load(self, num_cpus, num_gpus):
+    def _get_weights(self):
         """
-        Load current model
+        Return the model weights as a dict of numpy arrays
+
+        States written by older versions are converted: the weights are
+        read from the base64 encoded npz archive or HDF5 file, and are
+        stored in the new format the next time the state is saved.
+        """
+        weights = self._state.get('weights')
+        if isinstance(weights, str):
+            weights = npdonut.deserialize_weights(weights)
+        elif weights is None:
+            model_b64 = self._state.get('h5py')
+            if model_b64 is None:
+                raise errors.ModelNotTrained()
+            weights = npdonut.import_h5_weights(model_b64)
+
+        self._state.pop('h5py', None)
+        self._state['weights'] = weights
+        return weights
+
+    def _load_numpy(self):
+        """
+        Load the NumPy inference engine
+        """
+        if isinstance(self._encoder_model, npdonut.Encoder):
+            # Already loaded
+            return
+
+        weights = self._get_weights()
+        self._encoder_model = npdonut.Encoder(weights)
+        self._decoder_model = npdonut.Decoder(weights)
+
+    def _load_keras(self, num_cpus, num_gpus):
+        """
+        Load the Keras model
+
+        The model gets its own graph and session, so that several loaded
+        models can live in the same process. Use _keras_scope() to run it.
         """
-        if not self.is_trained:
-            raise errors.ModelNotTrained()
         if self._keras_model:
             # Already loaded
             return
 
-        K.clear_session()
-        self._set_xpu_config(num_cpus, num_gpus)
+        weights = self._get_weights()
+
+        config = self._get_xpu_config(num_cpus, num_gpus)
+        self._graph = tf.Graph()
+        self._session = tf.Session(graph=self._graph, config=config)
 
-        if self._state.get('h5py', None) is not None:
-            self._keras_model = _load_keras_model(self._state.get('h5py'))
+        with self._keras_scope():
+            set_seed()
+            self._keras_model = _load_keras_model(
+                self._state['best_params'],
+                weights,
+            )
             # instantiate encoder model
             self._encoder_model = _get_encoder(self._keras_model)
             # instantiate decoder model
             self._decoder_model = _get_decoder(self._keras_model)
-        else:
+
+    def load(self, num_cpus=1, num_gpus=0, backend='keras'):
+        """
+        Load current model
+
+        backend -- 'keras' or 'numpy'. The NumPy engine runs inference
+                   without TensorFlow.
+        """
+        if not self.is_trained:
             raise errors.ModelNotTrained()
 
+        if backend == 'numpy':
+            self._load_numpy()
+        else:
+            self._load_keras(num_cpus, num_gpus)
+
         if 'means' in self._state:
             self.means = np.array(self._state['means'])
         if 'stds' in self._state:
             self.stds = np.array(self._state['stds'])
+        if 'stats' in self._state:
+            self.stats = RunningStats.from_dict(self._state['stats'])
         if 'scores' in self._state:
             self.scores = np.array(self._state['scores'])
         if self.min_threshold == 0 and self.max_threshold == 0:
@@ -1191,10 +2514,14 @@ class DonutModel(Model):
         to_date,
         num_cpus=1,
         num_gpus=0,
+        mc_memory_mb=None,
+        backend='keras',
+        precision='float32',
     ):
         global g_mcmc_count
         global g_mc_count
         global g_mc_batch_size
+        global g_mc_memory_mb
 
         period = DateRange.build_date_range(
             from_date, to_date, self.bucket_interval)
@@ -1205,7 +2532,7 @@ class DonutModel(Model):
 
         logging.info("predict(%s) range=%s", self.name, period)
 
-        self.load(num_cpus, num_gpus)
+        self.load(num_cpus, num_gpus, backend)
 
         # Build history time range
         # Extra data are required to predict first buckets
@@ -1218,6 +2545,8 @@ class DonutModel(Model):
 
         # Prepare dataset
         nb_buckets = int((hist.to_ts - hist.from_ts) / self.bucket_interval)
+        # Raw values are kept in double precision: series with a large
+        # offset would lose their variations in single precision
         dataset = np.full((nb_buckets,), np.nan, dtype=float)
         X = []
 
@@ -1254,57 +2583,82 @@ class DonutModel(Model):
 
         logging.info("found %d time periods", nb_buckets_found)
 
-        real = np.copy(dataset)
+        return self._predict_dataset(
+            dataset[:X_until],
+            X[_window:],
+            predict_len,
+            mc_memory_mb,
+            precision,
+        )
 
-        norm_dataset = self.scale_dataset(dataset)
-        missing, X_test = self._format_dataset(norm_dataset[:X_until])
+    def _predict_dataset(
+        self,
+        dataset,
+        timestamps,
+        predict_len,
+        mc_memory_mb=None,
+        precision='float32',
+    ):
+        """
+        Predict the buckets of the dataset that follow the first W-1 ones
+
+        Only the scaled values are processed in `precision`
+        """
+        global g_mcmc_count
+        global g_mc_count
+        global g_mc_batch_size
+        global g_mc_memory_mb
+
+        _window = self._window - 1
+        real = np.array(dataset, dtype=float)
+
+        norm_dataset = self.scale_dataset(real).astype(precision)
+        missing, X_test = self._format_dataset(norm_dataset)
         if len(X_test) == 0:
             raise errors.LoudMLException("not enough data for prediction")
 
         # force last col to missing
+        missing = missing.copy()
         missing[:, -1] = True
 
         logging.info("generating prediction")
         x_ = X_test.copy()
-        # MCMC
-        for _ in range(g_mcmc_count):
-            z_mean, _, _ = self._encoder_model.predict(
-                [x_, missing], batch_size=g_mc_batch_size)
-            x_decoded = self._decoder_model.predict(
-                z_mean, batch_size=g_mc_batch_size)
-            x_[missing] = x_decoded[missing]
-
-        y = np.full((predict_len,), np.nan, dtype=float)
-        y_low = np.full((predict_len,), np.nan, dtype=float)
-        y_high = np.full((predict_len,), np.nan, dtype=float)
-        no_missing_point = np.full((g_mc_count, self.W), False, dtype=bool)
-        for j, x in enumerate(x_):
-            y[j] = x[-1]
-            # MC integration
-            _, _, Z = self._encoder_model.predict(
-                [np.tile(x, [g_mc_count, 1]), no_missing_point],
-                batch_size=g_mc_batch_size,
+        with self._keras_scope():
+            # MCMC
+            for _ in range(g_mcmc_count):
+                z_mean, _, _ = self._encoder_model.predict(
+                    [x_, missing], batch_size=g_mc_batch_size)
+                x_decoded = self._decoder_model.predict(
+                    z_mean, batch_size=g_mc_batch_size)
+                x_[missing] = x_decoded[missing]
+
+            y = np.full((predict_len,), np.nan, dtype=x_.dtype)
+            y_low = np.full((predict_len,), np.nan, dtype=x_.dtype)
+            y_high = np.full((predict_len,), np.nan, dtype=x_.dtype)
+            nb_windows = len(x_)
+            # uncertainty
+            std, mc_samples = self._get_std(
+                x_,
+                np.full(x_.shape, False, dtype=bool),
+                mc_memory_mb,
             )
-            x_decoded = self._decoder_model.predict(
-                Z, batch_size=g_mc_batch_size)
-            std = np.std(x_decoded[:, -1])
-            y_low[j] = x[-1] - 3 * std
-            y_high[j] = x[-1] + 3 * std
+        y[:nb_windows] = x_[:, -1]
+        y_low[:nb_windows] = x_[:, -1] - 3 * std
+        y_high[:nb_windows] = x_[:, -1] + 3 * std
 
-        y = self.unscale_dataset(y)
-        y_low = self.unscale_dataset(y_low)
-        y_high = self.unscale_dataset(y_high)
+        # results are returned in double precision
+        y = self.unscale_dataset(y.astype(float))
+        y_low = self.unscale_dataset(y_low.astype(float))
+        y_high = self.unscale_dataset(y_high.astype(float))
 
         # Build final result
-        timestamps = X[_window:]
-
         shape = (predict_len, len(self.features))
         observed = np.full(shape, np.nan, dtype=float)
-        observed = real[_window:]
+        observed = real[_window:].astype(float)
         self.apply_defaults(observed)
         self.apply_defaults(y)
 
-        return TimeSeriesPrediction(
+        prediction = TimeSeriesPrediction(
             self,
             timestamps=timestamps,
             observed=observed,
@@ -1312,6 +2666,54 @@ class DonutModel(Model):
             lower=y_low,
             upper=y_high,
         )
+        if mc_samples is not None:
+            prediction.mc_samples = np.zeros((predict_len,), dtype=int)
+            prediction.mc_samples[:nb_windows] = mc_samples
+        return prediction
+
+    def _get_std(self, x, missing, mc_memory_mb=None):
+        """
+        Estimate the uncertainty of the last point of each window with the
+        method set in the model settings
+
+        Return the standard deviation of each window, and the number of
+        Monte Carlo samples of each window in adaptive mode (None
+        otherwise).
+        """
+        global g_mc_count
+        global g_mc_memory_mb
+
+        if self.bounds == 'unscented':
+            std = _ut_std(
+                self._encoder_model,
+                self._decoder_model,
+                x,
+                missing,
+            )
+            return std, None
+
+        memory_mb = mc_memory_mb or g_mc_memory_mb
+        if self.mc_tolerance > 0:
+            return _mc_std_adaptive(
+                self._encoder_model,
+                self._decoder_model,
+                x,
+                missing,
+                self.mc_min_samples,
+                self.mc_max_samples,
+                self.mc_tolerance,
+                memory_mb,
+            )
+
+        std = _mc_std(
+            self._encoder_model,
+            self._decoder_model,
+            x,
+            missing,
+            g_mc_count,
+            memory_mb,
+        )
+        return std, None
 
     def generate_fake_prediction(self):
         now_ts = datetime.datetime.now().timestamp()
@@ -1339,10 +2741,14 @@ class DonutModel(Model):
         percent_noise=0,
         num_cpus=1,
         num_gpus=0,
+        mc_memory_mb=None,
+        backend='keras',
+        precision='float32',
     ):
         global g_mcmc_count
         global g_mc_count
         global g_mc_batch_size
+        global g_mc_memory_mb
 
         period = DateRange.build_date_range(
             from_date, to_date, self.bucket_interval)
@@ -1353,7 +2759,7 @@ class DonutModel(Model):
 
         logging.info("forecast(%s) range=%s", self.name, period)
 
-        self.load(num_cpus, num_gpus)
+        self.load(num_cpus, num_gpus, backend)
 
         # Build history time range
         # Extra data are required to predict first buckets
@@ -1366,6 +2772,8 @@ class DonutModel(Model):
 
         # Prepare dataset
         nb_buckets = int((hist.to_ts - hist.from_ts) / self.bucket_interval)
+        # Raw values are kept in double precision: series with a large
+        # offset would lose their variations in single precision
         dataset = np.full((nb_buckets,), np.nan, dtype=float)
         X = []
 
@@ -1404,7 +2812,7 @@ class DonutModel(Model):
 
         real = np.copy(dataset)
 
-        norm_dataset = self.scale_dataset(dataset)
+        norm_dataset = self.scale_dataset(dataset).astype(precision)
         _, X_test = self._format_dataset(norm_dataset[:X_until])
         if len(X_test) == 0:
             raise errors.LoudMLException("not enough data for prediction")
@@ -1416,56 +2824,76 @@ class DonutModel(Model):
         missing = np.full((self._window,), False, dtype=bool)
         # force last col to missing
         missing[-1] = True
-        y = np.full((forecast_len,), np.nan, dtype=float)
-        y_low = np.full((forecast_len,), np.nan, dtype=float)
-        y_high = np.full((forecast_len,), np.nan, dtype=float)
+        y = np.full((forecast_len,), np.nan, dtype=precision)
+        y_low = np.full((forecast_len,), np.nan, dtype=precision)
+        y_high = np.full((forecast_len,), np.nan, dtype=precision)
+        mc_samples = None
+        if self.forecast_particles == 0 and self.bounds == 'mc' \
+                and self.mc_tolerance > 0:
+            mc_samples = np.zeros((forecast_len,), dtype=int)
         x = x_[0]
         noise = percent_noise * float(self.bucket_interval) / (24*3600)
-        for j, _ in enumerate(x_):
-            # MCMC
-            for _ in range(g_mcmc_count):
-                z_mean, _, _ = self._encoder_model.predict(
-                    [np.array([x]), np.array([missing])],
-                    batch_size=g_mc_batch_size,
+        if self.forecast_particles > 0:
+            with self._keras_scope():
+                mean, std = _forecast_particles(
+                    self._encoder_model,
+                    self._decoder_model,
+                    x,
+                    len(x_),
+                    self.forecast_particles,
+                    noise,
                 )
-                x_decoded = self._decoder_model.predict(
-                    z_mean, batch_size=g_mc_batch_size)
-                x[missing] = x_decoded[0][missing]
-
-            # uncertainty is modeled using a random uniform noise distribution
-            # that increases over time
-            expand = np.random.uniform(-noise * j, noise * j, len(x))
-            x *= 1 + expand
-            # MC integration
-            _, _, Z = self._encoder_model.predict(
-                [np.tile(x, [g_mc_count, 1]), np.tile(
-                    missing, [g_mc_count, 1])],
-                batch_size=g_mc_batch_size,
-            )
-            x_decoded = self._decoder_model.predict(
-                Z, batch_size=g_mc_batch_size)
-            std = np.std(x_decoded[:, -1])
-            y_low[j] = x[-1] - p * std
-            y_high[j] = x[-1] + p * std
-            y[j] = x[-1]
-            x = np.roll(x, -1)
-            # set missing point to zero
-            x[-1] = 0
-
-        y = self.unscale_dataset(y)
-        y_low = self.unscale_dataset(y_low)
-        y_high = self.unscale_dataset(y_high)
+            y[:len(x_)] = mean
+            y_low[:len(x_)] = mean - p * std
+            y_high[:len(x_)] = mean + p * std
+        else:
+            with self._keras_scope():
+                for j, _ in enumerate(x_):
+                    # MCMC
+                    for _ in range(g_mcmc_count):
+                        z_mean, _, _ = self._encoder_model.predict(
+                            [np.array([x]), np.array([missing])],
+                            batch_size=g_mc_batch_size,
+                        )
+                        x_decoded = self._decoder_model.predict(
+                            z_mean, batch_size=g_mc_batch_size)
+                        x[missing] = x_decoded[0][missing]
+
+                    # uncertainty is modeled using a random uniform
+                    # noise distribution that increases over time
+                    expand = np.random.uniform(-noise * j, noise * j, len(x))
+                    x *= 1 + expand
+                    # uncertainty
+                    std, samples = self._get_std(
+                        np.array([x]),
+                        np.array([missing]),
+                        mc_memory_mb,
+                    )
+                    if samples is not None:
+                        mc_samples[j] = samples[0]
+                    std = std[0]
+                    y_low[j] = x[-1] - p * std
+                    y_high[j] = x[-1] + p * std
+                    y[j] = x[-1]
+                    x = np.roll(x, -1)
+                    # set missing point to zero
+                    x[-1] = 0
+
+        # results are returned in double precision
+        y = self.unscale_dataset(y.astype(float))
+        y_low = self.unscale_dataset(y_low.astype(float))
+        y_high = self.unscale_dataset(y_high.astype(float))
 
         # Build final result
         timestamps = X[_window:]
 
         shape = (forecast_len, len(self.features))
         observed = np.full(shape, np.nan, dtype=float)
-        observed = real[_window:]
+        observed = real[_window:].astype(float)
         self.apply_defaults(observed)
         self.apply_defaults(y)
 
-        return TimeSeriesPrediction(
+        forecast = TimeSeriesPrediction(
             self,
             timestamps=timestamps,
             observed=observed,
@@ -1473,109 +2901,119 @@ class DonutModel(Model):
             lower=y_low,
             upper=y_high,
         )
+        if mc_samples is not None:
+            forecast.mc_samples = mc_samples[:len(timestamps)]
+        return forecast
 
     def detect_anomalies(self, prediction, hooks=[]):
         """
         Detect anomalies on observed data by comparing them to the values
         predicted by the model
+
+        Thresholds are applied to all the buckets at once. The buckets are
+        then walked anomaly by anomaly: only the start and the end of
+        anomalies are processed one at a time.
         """
 
         prediction.stat()
-        stats = []
-        anomaly_indices = []
-
-        for i, ts in enumerate(prediction.timestamps):
-            last_anomaly_ts = self._state.get('last_anomaly_ts', 0)
-
-            in_grace_period = (ts - last_anomaly_ts) < self.grace_period
-
-            dt = ts_to_datetime(ts)
-            date_str = datetime_to_str(dt)
-            is_anomaly = False
-            anomalies = {}
-
-            predicted = prediction.predicted[i]
-            observed = prediction.observed[i]
-
-            score = prediction.scores[i]
-            mse = prediction.mses[i]
-
-            max_score = 0
-            feature = self.features[0]
-            max_score = max(max_score, score)
-
-            if (not in_grace_period) and score >= self.max_threshold:
-                anomalies[feature.name] = {
-                    'type': 'low' if observed < predicted else 'high',
-                    'score': score,
-                }
 
-            if len(anomalies):
-                is_anomaly = True
-                anomaly_indices.append(i)
+        timestamps = prediction.timestamps
+        ts = np.asarray(timestamps, dtype=float)
+        scores = prediction.scores
+        nb_buckets = len(ts)
+        above_max = scores >= self.max_threshold
+        below_min = scores < self.min_threshold
+        is_anomaly = np.full((nb_buckets,), False, dtype=bool)
 
+        i = 0
+        while i < nb_buckets:
+            last_anomaly_ts = self._state.get('last_anomaly_ts', 0)
+            in_grace_period = (ts[i:] - last_anomaly_ts) < self.grace_period
+            abnormal = above_max[i:] & ~in_grace_period
             anomaly = self._state.get('anomaly')
 
             if anomaly is None:
-                if is_anomaly:
-                    # This is a new anomaly
+                starts = np.flatnonzero(abnormal)
+                if len(starts) == 0:
+                    break
+
+                # This is a new anomaly
+                i += starts[0]
+                is_anomaly[i] = True
+                prediction.anomaly_mask = is_anomaly
+                score = max(0, scores[i])
+                dt = ts_to_datetime(timestamps[i])
+
+                # TODO have a Model.logger to prefix all logs with model name
+                logging.warning(
+                    "detected anomaly for model '%s' at %s (score = %.1f)",
+                    self.name, datetime_to_str(dt), score,
+                )
 
-                    # TODO have a Model.logger to prefix all logs with model name
-                    logging.warning(
-                        "detected anomaly for model '%s' at %s (score = %.1f)",
-                        self.name, date_str, max_score,
-                    )
+                self._state['anomaly'] = {
+                    'start_ts': timestamps[i],
+                    'max_score': score,
+                }
 
-                    self._state['anomaly'] = {
-                        'start_ts': ts,
-                        'max_score': max_score,
-                    }
-
-                    for hook in hooks:
-                        logging.debug("notifying '%s' hook", hook.name)
-                        data = prediction.format_bucket_data(i)
-
-                        try:
-                            hook.on_anomaly_start(
-                                dt=dt,
-                                score=max_score,
-                                predicted=data['predicted'],
-                                observed=data['observed'],
-                                anomalies=anomalies,
-                            )
-                        except Exception as exn:
-                            # XXX: catch all the exception to avoid
-                            # interruption
-                            logging.exception(exn)
-            else:
-                if is_anomaly:
-                    anomaly['max_score'] = max(anomaly['max_score'], max_score)
+                for hook in hooks:
+                    logging.debug("notifying '%s' hook", hook.name)
+                    data = prediction.format_bucket_data(i)
+
+                    try:
+                        hook.on_anomaly_start(
+                            dt=dt,
+                            score=score,
+                            predicted=data['predicted'],
+                            observed=data['observed'],
+                            anomalies=prediction.get_bucket_stats(i)[
+                                'anomalies'],
+                        )
+                    except Exception as exn:
+                        # XXX: catch all the exception to avoid
+                        # interruption
+                        logging.exception(exn)
+                i += 1
+                continue
+
+            ends = np.flatnonzero(~abnormal & below_min[i:])
+            end = i + ends[0] if len(ends) else nb_buckets
+            run = abnormal[:end - i]
+            is_anomaly[i:end] = run
+            if np.any(run):
+                anomaly['max_score'] = max(
+                    anomaly['max_score'],
+                    np.max(scores[i:end][run]),
+                )
+
+            if end == nb_buckets:
+                if np.any(run):
+                    last = i + np.flatnonzero(run)[-1]
                     logging.warning(
-                        "anomaly still in progress for model '%s' at %s (score = %.1f)",
-                        self.name, date_str, max_score,
-                    )
-                elif score < self.min_threshold:
-                    logging.info(
-                        "anomaly ended for model '%s' at %s (score = %.1f)",
-                        self.name, date_str, max_score,
+                        "anomaly still in progress for model '%s' at %s "
+                        "(score = %.1f)",
+                        self.name,
+                        datetime_to_str(ts_to_datetime(timestamps[last])),
+                        max(0, scores[last]),
                     )
+                break
 
-                    for hook in hooks:
-                        logging.debug("notifying '%s' hook", hook.name)
-                        hook.on_anomaly_end(dt, max_score)
+            score = max(0, scores[end])
+            dt = ts_to_datetime(timestamps[end])
+            logging.info(
+                "anomaly ended for model '%s' at %s (score = %.1f)",
+                self.name, datetime_to_str(dt), score,
+            )
 
-                    self._state['anomaly'] = None
-                    self._state['last_anomaly_ts'] = ts
+            for hook in hooks:
+                logging.debug("notifying '%s' hook", hook.name)
+                hook.on_anomaly_end(dt, score)
 
-            stats.append({
-                'mse': nan_to_none(mse),
-                'score': max_score,
-                'anomaly': is_anomaly,
-                'anomalies': anomalies,
-            })
+            self._state['anomaly'] = None
+            self._state['last_anomaly_ts'] = timestamps[end]
+            i = end + 1
 
-        prediction.stats = stats
-        prediction.anomaly_indices = anomaly_indices
+        prediction.anomaly_mask = is_anomaly
+        prediction.anomaly_indices = np.flatnonzero(is_anomaly).tolist()
 
     def predict2(
         self,
@@ -1585,15 +3023,107 @@ class DonutModel(Model):
         _state={},
         num_cpus=1,
         num_gpus=0,
+        mc_memory_mb=None,
+        backend='keras',
+        precision='float32',
+        incremental=False,
     ):
-        return self.predict(
-            bucket,
-            from_date,
-            to_date,
-            num_cpus=num_cpus,
-            num_gpus=num_gpus,
+        """
+        Predict and keep track of the running state
+
+        In incremental mode, the last W-1 values seen are kept in _state so
+        that only new buckets are fetched on the next call. None is returned
+        if no new bucket is available.
+        """
+        if not incremental:
+            return self.predict(
+                bucket,
+                from_date,
+                to_date,
+                num_cpus=num_cpus,
+                num_gpus=num_gpus,
+                mc_memory_mb=mc_memory_mb,
+                backend=backend,
+                precision=precision,
+            )
+
+        period = DateRange.build_date_range(
+            from_date, to_date, self.bucket_interval)
+        _window = self._window - 1
+
+        history = _state.get('history')
+        if history is not None and (
+            len(history['values']) != _window
+            or history['ts'] < period.from_ts - _window * self.bucket_interval
+        ):
+            # The model changed, or the history is too old to be useful
+            history = None
+
+        if history is None:
+            from_ts = period.from_ts - _window * self.bucket_interval
+            dataset = []
+        else:
+            from_ts = history['ts']
+            dataset = [
+                np.nan if val is None else val
+                for val in history['values']
+            ]
+            if from_ts >= period.to_ts:
+                logging.info("predict(%s) no new bucket", self.name)
+                return None
+
+        logging.info(
+            "predict(%s) range=%s incremental=%s",
+            self.name,
+            DateRange(from_ts, period.to_ts),
+            history is not None,
         )
 
+        self.load(num_cpus, num_gpus, backend)
+
+        X = []
+        data = bucket.get_times_data(
+            bucket_interval=self.bucket_interval,
+            features=self.features,
+            from_date=from_ts,
+            to_date=period.to_ts,
+        )
+        for _, val, timeval in data:
+            ts = make_ts(timeval)
+            if ts < period.to_ts:
+                dataset.append(val[0])
+                X.append(ts)
+
+        if len(X) == 0:
+            if history is None:
+                raise errors.NoData(
+                    "no data found for time range {}".format(period))
+            logging.info("predict(%s) no new bucket", self.name)
+            return None
+
+        dataset = np.array(dataset, dtype=float)
+        self.apply_defaults(dataset)
+
+        if history is None:
+            X = X[_window:]
+
+        prediction = self._predict_dataset(
+            dataset,
+            X,
+            len(dataset) - _window,
+            mc_memory_mb,
+            precision,
+        )
+
+        _state['history'] = {
+            'ts': X[-1] + self.bucket_interval,
+            'values': [
+                None if np.isnan(val) else float(val)
+                for val in dataset[len(dataset) - _window:]
+            ],
+        }
+        return prediction
+
     def plot_results(
         self,
         bucket,
@@ -1678,8 +3208,9 @@ class DonutModel(Model):
             raise errors.LoudMLException("not enough data for prediction")
 
         # display a 2D plot of the digit classes in the latent space
-        z_mean, _, _ = self._encoder_model.predict([X_test, X_miss_val],
-                                                   batch_size=g_mc_batch_size)
+        with self._keras_scope():
+            z_mean, _, _ = self._encoder_model.predict(
+                [X_test, X_miss_val], batch_size=g_mc_batch_size)
 
         if x_dim < 0 or y_dim < 0:
             mses = []
@@ -9,6 +9,10 @@ import logging
 import os
 import shutil
 import tempfile
+import time
+import uuid
+
+import numpy as np
 
 from voluptuous import (
     Length,
@@ -20,12 +24,18 @@ from . import (
     schemas,
 )
 
+from .misc import (
+    load_hook,
+)
 from .storage import (
     Storage,
 )
 
 from dictdiffer import diff
 
+# Alignment of arrays in weight files
+WEIGHTS_ALIGN = 64
+
 OBJECT_KEY_SCHEMA = schemas.All(
     str,
     Length(min=1),
@@ -42,6 +52,8 @@ class FileStorage(Storage):
         self.path = path
         self.model_dir = os.path.join(path, 'models')
         self.template_dir = os.path.join(path, 'templates')
+        # Hook definitions by model name, with the identity of their files
+        self._hooks_cache = {}
 
         try:
             os.makedirs(self.model_dir, exist_ok=True)
@@ -122,6 +134,59 @@ class FileStorage(Storage):
         settings.pop('name', None)
         self._write_json(os.path.join(model_path, "settings.json"), settings)
 
+    def _weights_path(self, state_path):
+        return os.path.splitext(os.path.realpath(state_path))[0] + ".weights"
+
+    def _write_weights(self, path, weights):
+        """
+        Write arrays to a binary file and return their index
+        """
+        index = {}
+        offset = 0
+        for name in sorted(weights):
+            array = np.ascontiguousarray(weights[name])
+            index[name] = {
+                'offset': offset,
+                'shape': list(array.shape),
+                'dtype': array.dtype.str,
+            }
+            offset += -(-array.nbytes // WEIGHTS_ALIGN) * WEIGHTS_ALIGN
+
+        if all(
+            isinstance(array, np.memmap) and array.filename == path
+            for array in weights.values()
+        ):
+            # Weights are mapped from this file and cannot be modified
+            return index
+
+        tmp_fd, tmp_path = tempfile.mkstemp(prefix=path + ".")
+        with os.fdopen(tmp_fd, 'wb') as fd:
+            for name in sorted(weights):
+                fd.seek(index[name]['offset'])
+                fd.write(np.ascontiguousarray(weights[name]).tobytes())
+            fd.truncate(offset)
+            os.fsync(fd)
+        os.chmod(tmp_path, 0o660)
+        os.rename(tmp_path, path)
+        return index
+
+    def _read_weights(self, path, index):
+        """
+        Map arrays from a binary file
+        """
+        if not index:
+            return {}
+
+        buf = np.memmap(path, dtype=np.uint8, mode='r')
+        weights = {}
+        for name, desc in index.items():
+            dtype = np.dtype(desc['dtype'])
+            nbytes = int(np.prod(desc['shape'])) * dtype.itemsize
+            offset = desc['offset']
+            weights[name] = buf[offset:offset + nbytes].view(dtype).reshape(
+                desc['shape'])
+        return weights
+
     def _write_model_state(self, model_path, state=None, ckpt_name=None):
         if ckpt_name is None:
             try:
@@ -136,12 +201,20 @@ class FileStorage(Storage):
         else:
             state_path = os.path.join(model_path, "{}.ckpt".format(ckpt_name))
 
+        weights_path = self._weights_path(state_path)
         if state is None:
-            try:
-                os.unlink(state_path)
-            except FileNotFoundError:
-                pass
+            for path in [state_path, weights_path]:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
         else:
+            weights = state.get('weights')
+            if isinstance(weights, dict):
+                # Keep weights in a binary file that can be memory-mapped
+                state = dict(state)
+                state['weights_index'] = self._write_weights(
+                    weights_path, state.pop('weights'))
             self._write_json(state_path, state)
 
     def _write_model(
@@ -235,7 +308,19 @@ class FileStorage(Storage):
         except OSError:
             return None
 
+    def get_model_version(self, name):
+        model_path = self.model_path(name)
+        versions = [self.get_current_ckpt(name)]
+        for filename in ["settings.json", "state.json"]:
+            try:
+                versions.append(
+                    os.stat(os.path.join(model_path, filename)).st_mtime_ns)
+            except FileNotFoundError:
+                versions.append(None)
+        return tuple(versions)
+
     def delete_model(self, name):
+        self._hooks_cache.pop(name, None)
         try:
             shutil.rmtree(self.model_path(name))
         except FileNotFoundError:
@@ -292,7 +377,7 @@ class FileStorage(Storage):
             state_path = os.path.join(model_path, "{}.ckpt".format(ckpt_name))
 
         try:
-            return self._load_json(state_path)
+            state = self._load_json(state_path)
         except ValueError as exn:
             raise errors.Invalid(
                 "invalid model state file: {}: {}".format(
@@ -304,6 +389,21 @@ class FileStorage(Storage):
             # Model is not trained yet
             return None
 
+        if 'weights_index' in state:
+            try:
+                state['weights'] = self._read_weights(
+                    self._weights_path(state_path),
+                    state.pop('weights_index'),
+                )
+            except (OSError, ValueError) as exn:
+                raise errors.Invalid(
+                    "invalid model weights file: {}: {}".format(
+                        state_path,
+                        str(exn),
+                    )
+                )
+        return state
+
     def get_model_data(self, name, ckpt_name=None):
         model_path = self.model_path(name)
         settings = self._get_model_settings(model_path, name)
@@ -375,6 +475,53 @@ class FileStorage(Storage):
         """
         return os.path.join(self.model_path(model_name), "hooks")
 
+    def _read_model_hooks(self, model_name):
+        """
+        Read the hook definitions of a model
+
+        Definitions are cached until the hook files change. Files are
+        replaced on write, so a change is detected by a new inode even
+        within the resolution of the modification time.
+        """
+        hooks_dir = self.model_hooks_dir(model_name)
+
+        key = []
+        try:
+            entries = list(os.scandir(hooks_dir))
+        except FileNotFoundError:
+            entries = []
+        for entry in entries:
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            key.append((entry.name, stat.st_ino, stat.st_mtime_ns,
+                        stat.st_size))
+        key.sort()
+
+        cached = self._hooks_cache.get(model_name)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        hooks = {}
+        complete = True
+        for filename, _, _, _ in key:
+            hook_name = os.path.splitext(filename)[0]
+            try:
+                hooks[hook_name] = self._load_json(
+                    os.path.join(hooks_dir, filename))
+            except ValueError as exn:
+                hooks[hook_name] = errors.Invalid(
+                    "invalid model hook file: %s", str(exn))
+            except FileNotFoundError:
+                complete = False
+
+        if complete:
+            self._hooks_cache[model_name] = (key, hooks)
+        return hooks
+
     def list_model_hooks(self, model_name):
         """List model hooks"""
 
@@ -389,15 +536,38 @@ class FileStorage(Storage):
     def get_model_hook(self, model_name, hook_name):
         """Get model hook"""
 
-        hooks_dir = self.model_hooks_dir(model_name)
-        hook_path = self._hook_path(hooks_dir, hook_name)
+        schemas.validate(schemas.key, hook_name)
+        hook_data = self._read_model_hooks(model_name).get(hook_name)
 
-        try:
-            return self._load_json(hook_path)
-        except ValueError as exn:
-            raise errors.Invalid("invalid model hook file: %s", str(exn))
-        except FileNotFoundError:
+        if hook_data is None:
             raise errors.NotFound("hook not found")
+        if isinstance(hook_data, errors.Invalid):
+            raise hook_data
+        return copy.deepcopy(hook_data)
+
+    def load_model_hooks(self, model, source):
+        """Load all model hooks"""
+
+        hooks = []
+
+        model_name = model['name']
+
+        # One scan of the hooks directory for all the hooks
+        definitions = self._read_model_hooks(model_name)
+        for hook_name, hook_data in sorted(definitions.items()):
+            try:
+                if isinstance(hook_data, errors.Invalid):
+                    raise hook_data
+                hook = load_hook(hook_name, copy.deepcopy(hook_data), model,
+                                 self, source)
+            except errors.LoudMLException as exn:
+                logging.error("cannot load hook '%s/%s': %s",
+                              model_name, hook_name, str(exn))
+                continue
+
+            hooks.append(hook)
+
+        return hooks
 
     def set_model_hook(self, model_name, hook_name, hook_type, config):
         """Set model hook"""
@@ -467,6 +637,118 @@ class FileStorage(Storage):
         except FileNotFoundError:
             raise KeyError("model object not found")
 
+    def _outbox_path(self, model_name):
+        return os.path.join(self.model_path(model_name), "outbox")
+
+    def _hook_event_path(self, model_name, event_id):
+        schemas.validate(schemas.key, event_id)
+        return os.path.join(self._outbox_path(model_name),
+                            event_id + ".json")
+
+    def add_hook_events(self, model_name, events):
+        path = self._outbox_path(model_name)
+        try:
+            os.makedirs(path, exist_ok=True)
+        except OSError as exn:
+            raise errors.LoudMLException(str(exn))
+
+        # Identifiers sort in insertion order
+        prefix = "{:016d}".format(int(time.time() * 1e6))
+        for i, event in enumerate(events):
+            event_id = "{}-{:06d}-{}".format(prefix, i, uuid.uuid4().hex[:8])
+            self._write_json(self._hook_event_path(model_name, event_id),
+                             event)
+
+    def list_hook_events(self, model_name, limit=None):
+        path = self._outbox_path(model_name)
+        try:
+            filenames = sorted(
+                filename for filename in os.listdir(path)
+                if filename.endswith(".json")
+            )
+        except FileNotFoundError:
+            return []
+
+        events = []
+        for filename in filenames[:limit]:
+            event_id = filename[:-len(".json")]
+            try:
+                events.append((event_id, self._load_json(
+                    os.path.join(path, filename))))
+            except FileNotFoundError:
+                continue
+            except ValueError as exn:
+                logging.error("invalid hook event %s: %s", event_id, exn)
+        return events
+
+    def set_hook_event(self, model_name, event_id, event):
+        self._write_json(self._hook_event_path(model_name, event_id), event)
+
+    def delete_hook_event(self, model_name, event_id):
+        try:
+            os.unlink(self._hook_event_path(model_name, event_id))
+        except FileNotFoundError:
+            pass
+
+    def _training_path(self, model_name):
+        return os.path.join(self.model_path(model_name), "training")
+
+    def save_training_progress(self, model_name, progress, weights=None):
+        path = self._training_path(model_name)
+        progress_path = os.path.join(path, "progress.json")
+        try:
+            os.makedirs(path, exist_ok=True)
+        except OSError as exn:
+            raise errors.LoudMLException(str(exn))
+
+        try:
+            index = self._load_json(progress_path)['weights_index']
+        except (OSError, ValueError, KeyError):
+            index = {}
+
+        for name, arrays in (weights or {}).items():
+            if arrays is None:
+                index.pop(name, None)
+                continue
+            # Weights are written to new files, so that the saved progress
+            # stays consistent if the job is interrupted
+            filename = "{}-{}.weights".format(name, uuid.uuid4().hex)
+            index[name] = {
+                'file': filename,
+                'arrays': self._write_weights(
+                    os.path.join(path, filename), arrays),
+            }
+
+        self._write_json(progress_path, dict(progress, weights_index=index))
+
+        files = {entry['file'] for entry in index.values()}
+        for filename in os.listdir(path):
+            if filename.endswith(".weights") and filename not in files:
+                try:
+                    os.unlink(os.path.join(path, filename))
+                except FileNotFoundError:
+                    pass
+
+    def load_training_progress(self, model_name):
+        path = self._training_path(model_name)
+        try:
+            progress = self._load_json(os.path.join(path, "progress.json"))
+        except FileNotFoundError:
+            return None
+        except ValueError as exn:
+            logging.error("invalid training progress: %s", exn)
+            return None
+
+        weights = {
+            name: self._read_weights(
+                os.path.join(path, entry['file']), entry['arrays'])
+            for name, entry in progress.pop('weights_index', {}).items()
+        }
+        return progress, weights
+
+    def delete_training_progress(self, model_name):
+        shutil.rmtree(self._training_path(model_name), ignore_errors=True)
+
 
 class TempStorage(FileStorage):
     """
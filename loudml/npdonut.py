@@ -0,0 +1,155 @@
+"""
+Loud ML NumPy inference engine for Donut models
+
+The encoder, the sampling layer and the decoder of a trained Donut
+model are evaluated with plain matrix products. TensorFlow is not
+required at inference time.
+"""
+
+import base64
+import io
+
+import numpy as np
+
+ENCODER_LAYERS = ['encoder_dense_0', 'encoder_dense_1']
+LATENT_LAYERS = ['z_mean', 'z_log_var']
+DECODER_LAYERS = ['decoder_dense_0', 'decoder_dense_1', 'decoder_dense_2']
+
+
+def _relu(x):
+    return np.maximum(x, 0)
+
+
+def _dense(weights, name, x):
+    return np.dot(x, weights[name + '/kernel']) + weights[name + '/bias']
+
+
+def _name_weights(layers):
+    """
+    Index the kernel and the bias of Dense layers by their Donut name
+
+    `layers` is a list of (layer name, [kernel, bias]) in graph order
+    """
+    named = LATENT_LAYERS + DECODER_LAYERS
+    # Encoder hidden layers were not named in older models. They are the
+    # first Dense layers of the graph.
+    hidden = [arrays for name, arrays in layers if name not in named]
+    arrays_by_name = dict(layers)
+    arrays_by_name.update(zip(ENCODER_LAYERS, hidden))
+
+    weights = {}
+    for name in ENCODER_LAYERS + named:
+        weights[name + '/kernel'], weights[name + '/bias'] = \
+            arrays_by_name[name]
+
+    return weights
+
+
+def export_weights(keras_model):
+    """
+    Export the Dense layer weights of a Keras Donut model
+
+    Returns a dict of numpy arrays indexed by `<layer>/kernel` and
+    `<layer>/bias`
+    """
+    return _name_weights([
+        (layer.name, layer.get_weights())
+        for layer in keras_model.layers
+        if len(layer.get_weights()) == 2
+    ])
+
+
+def import_h5_weights(model_b64):
+    """
+    Read the Dense layer weights of a Keras Donut model saved in HDF5
+    format and encoded in base64
+
+    TensorFlow is not required.
+    """
+    import h5py
+
+    def _decode(names):
+        return [
+            name.decode('utf-8') if isinstance(name, bytes) else name
+            for name in names
+        ]
+
+    buf = io.BytesIO(base64.b64decode(model_b64.encode('utf-8')))
+    with h5py.File(buf, mode='r') as h5:
+        group = h5['model_weights'] if 'model_weights' in h5 else h5
+        layers = []
+        for layer_name in _decode(group.attrs['layer_names']):
+            layer = group[layer_name]
+            weight_names = _decode(layer.attrs['weight_names'])
+            if len(weight_names) == 2:
+                layers.append((
+                    layer_name,
+                    [np.array(layer[name]) for name in weight_names],
+                ))
+
+    return _name_weights(layers)
+
+
+def serialize_weights(weights):
+    """
+    Serialize weights to a string
+    """
+    buf = io.BytesIO()
+    np.savez(buf, **weights)
+    return base64.b64encode(buf.getvalue()).decode('utf-8')
+
+
+def deserialize_weights(weights_b64):
+    """
+    Deserialize weights from a string
+    """
+    buf = io.BytesIO(base64.b64decode(weights_b64.encode('utf-8')))
+    with np.load(buf) as npz:
+        return {name: npz[name] for name in npz.files}
+
+
+class Encoder:
+    """
+    Donut encoder
+
+    Same interface as the Keras encoder model
+    """
+
+    def __init__(self, weights):
+        self.weights = weights
+
+    def predict(self, inputs, batch_size=None):
+        """
+        Return z_mean, z_log_var and z sampled from Q(z|X)
+        """
+        # Missing flags only contribute to the training loss
+        x, _ = inputs
+        for name in ENCODER_LAYERS:
+            x = _relu(_dense(self.weights, name, x))
+
+        z_mean = _dense(self.weights, 'z_mean', x)
+        z_log_var = _dense(self.weights, 'z_log_var', x)
+
+        # reparameterization trick
+        epsilon = np.random.normal(size=z_mean.shape).astype(z_mean.dtype)
+        z = z_mean + np.exp(0.5 * z_log_var) * epsilon
+        return z_mean, z_log_var, z
+
+
+class Decoder:
+    """
+    Donut decoder
+
+    Same interface as the Keras decoder model
+    """
+
+    def __init__(self, weights):
+        self.weights = weights
+
+    def predict(self, z, batch_size=None):
+        """
+        Return decoded windows
+        """
+        x = _relu(_dense(self.weights, 'decoder_dense_0', z))
+        x = _relu(_dense(self.weights, 'decoder_dense_1', x))
+        return _dense(self.weights, 'decoder_dense_2', x)
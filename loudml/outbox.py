@@ -0,0 +1,319 @@
+"""
+Loud ML hook outbox
+
+Inference jobs do not call model hooks: the anomaly events that they
+detect are appended to an outbox, kept per model in the storage. The
+server process delivers them to the hooks in the background, so that
+slow or failing hooks do not delay inference jobs, and events that
+could not be delivered yet are not lost if the server restarts.
+"""
+
+import logging
+import threading
+import time
+
+import numpy as np
+
+import loudml.bucket
+from . import (
+    errors,
+)
+from .misc import (
+    ts_to_datetime,
+)
+
+
+def _to_json(data):
+    """
+    Convert NumPy scalars to JSON serializable values
+    """
+    if isinstance(data, dict):
+        return {key: _to_json(val) for key, val in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [_to_json(val) for val in data]
+    if isinstance(data, np.generic):
+        return data.item()
+    return data
+
+
+class HookOutbox:
+    """
+    Record hook calls as outbox events
+
+    Same interface as `loudml.api.Hook`. The hooks will get the bucket
+    named `bucket_name` as source.
+    """
+
+    name = 'outbox'
+
+    def __init__(self, bucket_name):
+        self.bucket_name = bucket_name
+        self.events = []
+
+    def _add(self, event_type, dt, **kwargs):
+        self.events.append({
+            'type': event_type,
+            'bucket': self.bucket_name,
+            'timestamp': dt.timestamp(),
+            'kwargs': _to_json(kwargs),
+            # Hooks that did not get the event yet. Set on first delivery
+            'hooks': None,
+            'attempts': 0,
+            'retry_ts': 0,
+        })
+
+    def on_anomaly_start(
+        self,
+        dt,
+        score,
+        predicted,
+        observed,
+        anomalies,
+        *args,
+        **kwargs
+    ):
+        self._add(
+            'anomaly_start',
+            dt,
+            score=score,
+            predicted=predicted,
+            observed=observed,
+            anomalies=anomalies,
+        )
+
+    def on_anomaly_end(self, dt, score, *args, **kwargs):
+        self._add('anomaly_end', dt, score=score)
+
+    def save(self, storage, model_name):
+        """
+        Append the recorded events to the model outbox. Return their number
+        """
+        count = len(self.events)
+        if count:
+            storage.add_hook_events(model_name, self.events)
+            self.events = []
+        return count
+
+
+class HookDispatcher:
+    """
+    Deliver outbox events to model hooks
+
+    The events of a model are delivered in order, by batches of at most
+    `batch_size` events. Hooks are loaded once per batch. An event goes to
+    the hooks that exist when it is first delivered.
+
+    If a hook fails, it gets the event again after `retry_delay` seconds,
+    doubled after each attempt up to `max_retry_delay`, and the next events
+    of the model wait. The event is dropped after `max_attempts` attempts.
+
+    All the models are scanned once at startup. Then only the models that
+    were notified or that wait for a retry are dispatched.
+    """
+
+    def __init__(
+        self,
+        config,
+        storage,
+        batch_size=100,
+        max_attempts=10,
+        retry_delay=1,
+        max_retry_delay=300,
+        interval=5,
+    ):
+        self.config = config
+        self.storage = storage
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.interval = interval
+        self.delivered = 0
+        self.dropped = 0
+        # Next dispatch time of the models that may have events
+        self._pending = {}
+        self._sweep = True
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _load_hooks(self, model_name, bucket_name):
+        """
+        Load model hooks, indexed by name
+        """
+        model = self.storage.load_model(model_name)
+        bucket = loudml.bucket.load_bucket(
+            self.config.get_bucket(bucket_name))
+        return {
+            hook.name: hook
+            for hook in self.storage.load_model_hooks(model.settings, bucket)
+        }
+
+    def _call(self, hook, event):
+        callback = getattr(hook, 'on_' + event['type'])
+        callback(dt=ts_to_datetime(event['timestamp']), **event['kwargs'])
+
+    def _retry_delay(self, attempts):
+        return min(self.max_retry_delay,
+                   self.retry_delay * 2 ** (attempts - 1))
+
+    def dispatch_model(self, model_name, now=None):
+        """
+        Deliver a batch of events of a model. Return the number of events
+        removed from the outbox
+        """
+        if now is None:
+            now = time.time()
+
+        events = self.storage.list_hook_events(model_name, self.batch_size)
+        hooks_by_bucket = {}
+        done = 0
+
+        for event_id, event in events:
+            if event['retry_ts'] > now:
+                break
+
+            hooks = hooks_by_bucket.get(event['bucket'])
+            if hooks is None:
+                hooks = self._load_hooks(model_name, event['bucket'])
+                hooks_by_bucket[event['bucket']] = hooks
+
+            if event['hooks'] is None:
+                event['hooks'] = sorted(hooks)
+
+            pending = []
+            for hook_name in event['hooks']:
+                hook = hooks.get(hook_name)
+                if hook is None:
+                    # Deleted in the meantime
+                    continue
+                try:
+                    self._call(hook, event)
+                except Exception as exn:
+                    # XXX: catch all the exceptions, hooks are plug-ins
+                    logging.error(
+                        "hook '%s/%s' failed: %s", model_name, hook_name, exn)
+                    pending.append(hook_name)
+
+            if not pending:
+                self.storage.delete_hook_event(model_name, event_id)
+                self.delivered += 1
+                done += 1
+                continue
+
+            event['hooks'] = pending
+            event['attempts'] += 1
+            if event['attempts'] >= self.max_attempts:
+                logging.error(
+                    "dropping %s event of model '%s' after %d attempts",
+                    event['type'], model_name, event['attempts'],
+                )
+                self.storage.delete_hook_event(model_name, event_id)
+                self.dropped += 1
+                done += 1
+                continue
+
+            event['retry_ts'] = now + self._retry_delay(event['attempts'])
+            self.storage.set_hook_event(model_name, event_id, event)
+            break
+
+        return done
+
+    def _schedule(self, model_name, ts):
+        with self._lock:
+            self._pending[model_name] = min(
+                ts, self._pending.get(model_name, ts))
+
+    def _dispatch_all(self, model_name, now):
+        """
+        Deliver the events of a model that are due. Return when the next
+        events are due, or None if the outbox is empty
+        """
+        try:
+            while self.dispatch_model(model_name, now) == self.batch_size:
+                pass
+            events = self.storage.list_hook_events(model_name, 1)
+        except errors.LoudMLException as exn:
+            logging.error(
+                "cannot deliver events of model '%s': %s",
+                model_name, exn,
+            )
+            return now + self.max_retry_delay
+
+        if not events:
+            return None
+        _, event = events[0]
+        return max(now, event['retry_ts'])
+
+    def dispatch(self, now=None):
+        """
+        Deliver the events of the models that are due. Return when the next
+        events are due, or None if no events are pending
+        """
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            if self._sweep:
+                self._sweep = False
+                for model_name in self.storage.list_models():
+                    self._pending.setdefault(model_name, now)
+            due = [
+                model_name
+                for model_name, ts in self._pending.items()
+                if ts <= now
+            ]
+            for model_name in due:
+                del self._pending[model_name]
+
+        for model_name in due:
+            next_ts = self._dispatch_all(model_name, now)
+            if next_ts is not None:
+                self._schedule(model_name, next_ts)
+
+        with self._lock:
+            return min(self._pending.values(), default=None)
+
+    def notify(self, model_name=None):
+        """
+        Tell that new events are available for a model, or for all the
+        models if `model_name` is None
+        """
+        if model_name is None:
+            with self._lock:
+                self._sweep = True
+        else:
+            self._schedule(model_name, 0)
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.clear()
+            timeout = self.interval
+            try:
+                next_ts = self.dispatch()
+                if next_ts is not None:
+                    timeout = min(timeout, max(0, next_ts - time.time()))
+            except Exception as exn:
+                logging.exception(exn)
+            self._wakeup.wait(timeout)
+
+    def start(self):
+        """
+        Deliver events in a background thread, when notified or when
+        retries are due, waiting at most `interval` seconds
+        """
+        self._thread = threading.Thread(
+            target=self._run,
+            name="hook-dispatcher",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -4,13 +4,13 @@ Loud ML server
 
 import copy
 import argparse
+import bisect
 import concurrent.futures
 from datetime import datetime, timedelta
 import logging
 import multiprocessing
 import pebble
 import pkg_resources
-import queue
 import schedule
 import sys
 import uuid
@@ -26,7 +26,9 @@ import loudml.model
 import loudml.worker
 
 from threading import (
-    Timer,
+    Event,
+    Lock,
+    Thread,
 )
 
 from flask import (
@@ -58,6 +60,7 @@ from loudml.metrics import (
 )
 from loudml.misc import (
     clear_fields,
+    hash_dict,
     make_bool,
     my_host_id,
     make_ts,
@@ -66,6 +69,9 @@ from loudml.misc import (
     parse_expression,
     find_undeclared_variables,
 )
+from loudml.outbox import (
+    HookDispatcher,
+)
 from loudml.requests import (
     perform_request,
 )
@@ -84,7 +90,9 @@ g_training_pool = None
 g_pool = None
 g_nice = 0
 g_queue = None
-g_timer = None
+g_reader = None
+g_scheduler = None
+g_dispatcher = None
 
 # Do not change: pid file to ensure we're running single instance
 APP_INSTALL_PATHS = [
@@ -212,6 +220,7 @@ def daemon_exec_scheduled_job(job_id):
 
 def add_new_scheduled_job(desc):
     global g_scheduled_jobs
+    global g_scheduler
     scheduled_job_name = desc['name']
     scheduled_event = get_schedule(
         cnt=desc['every'].get('count', 1),
@@ -223,6 +232,7 @@ def add_new_scheduled_job(desc):
         daemon_exec_scheduled_job, scheduled_job_name).tag(
         'scheduled_job:{}'.format(scheduled_job_name),
         'scheduled_job')
+    g_scheduler.wakeup()
     return scheduled_job_name
 
 
@@ -240,24 +250,168 @@ def del_scheduled_job(scheduled_job_name):
         return
 
 
-class RepeatingTimer(object):
-    def __init__(self, interval, cb, *args, **kwargs):
-        self.interval = interval
-        self.cb = cb
-        self.args = args
-        self.kwargs = kwargs
-        self.timer = None
+class Scheduler:
+    """
+    Run scheduled jobs in a thread
 
-    def callback(self):
-        self.cb(*self.args, **self.kwargs)
-        self.start()
+    The thread sleeps until the next job is due, or until it is woken up
+    because jobs were added.
+    """
 
-    def cancel(self):
-        self.timer.cancel()
+    def __init__(self):
+        self._wakeup = Event()
+        self._stopped = False
+        self._thread = None
+
+    def _idle_seconds(self):
+        if not schedule.jobs:
+            return None
+        return max(0, schedule.idle_seconds())
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.clear()
+            try:
+                schedule.run_pending()
+            except Exception as exn:
+                logging.exception(exn)
+            self._wakeup.wait(self._idle_seconds())
+
+    def wakeup(self):
+        """
+        Take new jobs into account
+        """
+        self._wakeup.set()
+
+    def start(self):
+        self._thread = Thread(target=self._run, name="scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+        self._thread.join()
+
+
+class MessageReader:
+    """
+    Read messages from subprocesses in a thread, and handle them as soon
+    as they arrive
+
+    The thread blocks on the queue, not the gevent hub.
+    """
+
+    def __init__(self, msg_queue):
+        self._msg_queue = msg_queue
+        self._thread = None
+
+    def _run(self):
+        while True:
+            msg = self._msg_queue.get()
+            if msg is None:
+                break
+            try:
+                handle_message(msg)
+            except Exception as exn:
+                logging.exception(exn)
 
     def start(self):
-        self.timer = Timer(self.interval, self.callback)
-        self.timer.start()
+        self._thread = Thread(
+            target=self._run,
+            name="message-reader",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._msg_queue.put(None)
+        self._thread.join()
+
+
+class AffinityPool:
+    """
+    Pool of workers that sends the jobs of a model to the same worker, so
+    that the worker state, e.g. the model cache, is reused
+
+    `pools` are pools of one process each. Keys are mapped to workers by
+    consistent hashing: adding or removing workers only moves a fraction
+    of the keys. A job goes to an idle worker instead if its worker has
+    `max_backlog` jobs or more, waiting or running. Jobs without a key go
+    to the least loaded worker.
+    """
+
+    def __init__(self, pools, replicas=64, max_backlog=1):
+        self.pools = pools
+        self.max_backlog = max_backlog
+        self.backlog = [0] * len(pools)
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+
+        ring = sorted(
+            (self._hash("{}:{}".format(i, replica)), i)
+            for i in range(len(pools))
+            for replica in range(replicas)
+        )
+        self._ring_hashes = [h for h, _ in ring]
+        self._ring_workers = [i for _, i in ring]
+
+    @staticmethod
+    def _hash(key):
+        return int(hash_dict(key)[:16], 16)
+
+    def get_worker(self, key):
+        """
+        Return the index of the worker assigned to a key
+        """
+        i = bisect.bisect(self._ring_hashes, self._hash(key))
+        return self._ring_workers[i % len(self._ring_workers)]
+
+    def _least_loaded(self):
+        return min(range(len(self.pools)), key=lambda i: self.backlog[i])
+
+    def _done(self, i):
+        with self._lock:
+            self.backlog[i] -= 1
+
+    @property
+    def hit_rate(self):
+        """
+        Ratio of jobs with a key that went to the worker of the key
+        """
+        total = self.hits + self.misses
+        return self.hits / total if total else None
+
+    def schedule(self, function, args=None, kwargs=None, key=None):
+        """
+        Submit job and return its future
+        """
+        with self._lock:
+            if key is None:
+                i = self._least_loaded()
+            else:
+                i = self.get_worker(key)
+                if self.backlog[i] >= self.max_backlog:
+                    idle = self._least_loaded()
+                    if self.backlog[idle] == 0:
+                        i = idle
+                if i == self.get_worker(key):
+                    self.hits += 1
+                else:
+                    self.misses += 1
+            self.backlog[i] += 1
+
+        future = self.pools[i].schedule(function, args=args, kwargs=kwargs)
+        future.add_done_callback(lambda _: self._done(i))
+        return future
+
+    def stop(self):
+        for pool in self.pools:
+            pool.stop()
+
+    def join(self):
+        for pool in self.pools:
+            pool.join()
 
 
 class Job:
@@ -267,6 +421,8 @@ class Job:
     func = None
     job_type = None
     debug = False
+    # Send the jobs of a model to the same worker
+    affinity = False
 
     def __init__(self):
         self.id = str(uuid.uuid4())
@@ -341,6 +497,7 @@ class Job:
             loudml.worker.run,
             args=[self.id, 0, self.func, config] + self.args,
             kwargs=self.kwargs,
+            key=self.model_name if self.affinity else None,
         )
         self._future.add_done_callback(self._done_cb)
         g_jobs[self.id] = self
@@ -425,25 +582,20 @@ def set_job_state(job_id, state, progress=None):
     job.progress = progress
 
 
-def read_messages():
+def handle_message(msg):
     """
-    Read messages from subprocesses
+    Handle a message from a subprocess
     """
-    global g_queue
-
-    while True:
-        schedule.run_pending()
-        try:
-            msg = g_queue.get(block=False)
+    global g_dispatcher
 
-            if msg['type'] == 'job_state':
-                set_job_state(
-                    msg['job_id'],
-                    msg['state'],
-                    progress=msg.get('progress'),
-                )
-        except queue.Empty:
-            break
+    if msg['type'] == 'job_state':
+        set_job_state(
+            msg['job_id'],
+            msg['state'],
+            progress=msg.get('progress'),
+        )
+    elif msg['type'] == 'hook_events':
+        g_dispatcher.notify(msg.get('model_name'))
 
 
 @app.errorhandler(errors.LoudMLException)
@@ -913,7 +1065,12 @@ def model_train(model_name):
     g_storage.load_model(model_name)
     kwargs = {}
 
-    kwargs['from_date'] = get_date_arg('from', is_mandatory=True)
+    resume = get_bool_arg('resume')
+    if resume:
+        kwargs['resume'] = True
+
+    # The date range of a resumed training is saved with its progress
+    kwargs['from_date'] = get_date_arg('from', is_mandatory=not resume)
     kwargs['to_date'] = get_date_arg('to', default="now")
 
     bucket = request.args.get('input')
@@ -928,6 +1085,12 @@ def model_train(model_name):
     if epochs is not None:
         kwargs['num_epochs'] = epochs
 
+    if get_bool_arg('force'):
+        kwargs['force'] = True
+
+    if get_bool_arg('incremental'):
+        kwargs['incremental'] = True
+
     job = TrainingJob(model_name, **kwargs)
     job.start(g_config)
 
@@ -1021,7 +1184,7 @@ def hook_test(model_name, hook_name):
     model = g_storage.load_model(model_name)
     hook = g_storage.load_model_hook(model.settings, hook_name)
 
-    model.load()
+    model.load(backend=g_config.inference['backend'])
     prediction = model.generate_fake_prediction()
     model.detect_anomalies(prediction, [hook])
 
@@ -1520,6 +1683,7 @@ class PredictionJob(Job):
     """
     func = 'predict'
     job_type = 'prediction'
+    affinity = True
 
     def __init__(self, model_name, **kwargs):
         super().__init__()
@@ -1541,6 +1705,7 @@ class ForecastJob(Job):
     """
     func = 'forecast'
     job_type = 'forecast'
+    affinity = True
 
     def __init__(self, model_name, **kwargs):
         super().__init__()
@@ -1585,9 +1750,11 @@ def model_eval(model_name):
     global g_storage
     global g_config
 
+    incremental = get_bool_arg('incremental', default=False)
     job = PredictionJob(
         model_name,
-        save_run_state=False,
+        save_run_state=incremental,
+        incremental=incremental,
         from_date=get_date_arg('from', is_mandatory=True),
         to_date=get_date_arg('to', is_mandatory=True),
         save_prediction=get_bool_arg('save_output_data', default=False),
@@ -1634,6 +1801,7 @@ def model_start(model_name):
         'save_output_data': get_bool_arg('save_output_data'),
         'output_bucket': request.args.get('output_bucket'),
         'flag_abnormal_data': get_bool_arg('flag_abnormal_data'),
+        'incremental': get_bool_arg('incremental'),
     }
 
     model = g_storage.load_model(model_name)
@@ -1850,7 +2018,9 @@ def g_app_init(path):
     global g_pool
     global g_queue
     global g_storage
-    global g_timer
+    global g_reader
+    global g_scheduler
+    global g_dispatcher
 
     g_config = loudml.config.load_config(path)
     g_storage = FileStorage(g_config.storage['path'])
@@ -1862,14 +2032,29 @@ def g_app_init(path):
         initializer=loudml.worker.init_worker,
         initargs=[g_queue],
     )
-    g_pool = pebble.ProcessPool(
-        max_workers=g_config.server.get('workers', 1),
-        max_tasks=g_config.server.get('maxtasksperchild', 1),
-        initializer=loudml.worker.init_worker,
-        initargs=[g_queue],
+    g_pool = AffinityPool([
+        pebble.ProcessPool(
+            max_workers=1,
+            max_tasks=g_config.server.get('maxtasksperchild', 1),
+            initializer=loudml.worker.init_worker,
+            initargs=[g_queue],
+        )
+        for _ in range(g_config.server.get('workers', 1))
+    ])
+    hooks = g_config.hooks
+    g_dispatcher = HookDispatcher(
+        g_config,
+        g_storage,
+        batch_size=hooks['batch_size'],
+        max_attempts=hooks['max_attempts'],
+        retry_delay=hooks['retry_delay'],
+        max_retry_delay=hooks['max_retry_delay'],
     )
-    g_timer = RepeatingTimer(1, read_messages)
-    g_timer.start()
+    g_dispatcher.start()
+    g_reader = MessageReader(g_queue)
+    g_reader.start()
+    g_scheduler = Scheduler()
+    g_scheduler.start()
 
     @catch_exceptions(cancel_on_failure=False)
     def daemon_send_metrics():
@@ -1894,26 +2079,45 @@ def g_app_init(path):
 
     schedule.every().minute.do(daemon_clear_jobs)
 
+    @catch_exceptions(cancel_on_failure=False)
+    def daemon_report_affinity():
+        hit_rate = g_pool.hit_rate
+        if hit_rate is not None:
+            logging.info(
+                "worker affinity: %d hits, %d misses, hit rate %.1f%%",
+                g_pool.hits, g_pool.misses, 100 * hit_rate,
+            )
+
+    schedule.every(10).minutes.do(daemon_report_affinity)
+    g_scheduler.wakeup()
+
 
 def g_app_stop():
-    global g_timer
+    global g_reader
+    global g_scheduler
     global g_pool
     global g_training_pool
     global g_config
     global g_nice
     global g_queue
+    global g_dispatcher
 
     schedule.clear('bg')
-    g_timer.cancel()
+    g_scheduler.stop()
+    g_dispatcher.stop()
     g_pool.stop()
     g_pool.join()
     g_training_pool.stop()
     g_training_pool.join()
+    # Messages sent by the workers before they stopped are handled
+    g_reader.stop()
     g_config = None
     g_nice = 0
     g_pool = None
     g_queue = None
-    g_timer = None
+    g_reader = None
+    g_scheduler = None
+    g_dispatcher = None
 
 
 def main():
@@ -72,6 +72,13 @@ class Storage(metaclass=ABCMeta):
     def get_current_ckpt(self, model_name):
         """Get active checkpoint name"""
 
+    def get_model_version(self, name):
+        """
+        Get a value that changes whenever the model settings or the active
+        state are modified. None if the storage cannot tell.
+        """
+        return None
+
     def load_model(self, name, ckpt_name=None):
         """Load model"""
         model_data = self.get_model_data(name, ckpt_name)
@@ -166,3 +173,128 @@ class Storage(metaclass=ABCMeta):
     def delete_model_object(self, model_name, key):
         """Delete model object"""
         raise NotImplementedError()
+
+    def add_hook_events(self, model_name, events):
+        """
+        Append events to the hook outbox of a model
+        """
+        raise NotImplementedError()
+
+    def list_hook_events(self, model_name, limit=None):
+        """
+        List the events of the hook outbox of a model, oldest first, as
+        (event_id, event) pairs. Return at most `limit` events
+        """
+        raise NotImplementedError()
+
+    def set_hook_event(self, model_name, event_id, event):
+        """Update an event of the hook outbox of a model"""
+        raise NotImplementedError()
+
+    def delete_hook_event(self, model_name, event_id):
+        """Delete an event of the hook outbox of a model"""
+        raise NotImplementedError()
+
+    def save_training_progress(self, model_name, progress, weights=None):
+        """
+        Save the progress of a training job
+
+        `weights` maps names to sets of weights to save with the progress.
+        Sets that are not given are kept, sets mapped to None are removed.
+        """
+        raise NotImplementedError()
+
+    def load_training_progress(self, model_name):
+        """
+        Load the progress of a training job and its sets of weights.
+        Return None if there is none
+        """
+        raise NotImplementedError()
+
+    def delete_training_progress(self, model_name):
+        """Delete the progress of a training job"""
+        raise NotImplementedError()
+
+
+class TrainingCheckpoint:
+    """
+    Progress of a training job, saved in a storage so that the job can be
+    resumed if it is interrupted
+
+    The progress holds the job parameters, the completed trials of the
+    hyperparameter search, the weights of the best trial and the weights
+    of the running trial, saved at the end of each epoch.
+    """
+
+    def __init__(self, storage, model_name):
+        self.storage = storage
+        self.model_name = model_name
+        self.progress = None
+        self.weights = {}
+
+    def load(self):
+        """
+        Load the saved progress. Return False if there is none
+        """
+        loaded = self.storage.load_training_progress(self.model_name)
+        if loaded is None:
+            return False
+        self.progress, self.weights = loaded
+        return True
+
+    def start(self, job):
+        """
+        Start a new training job. `job` holds its parameters
+        """
+        self.progress = {
+            'job': job,
+            'trials': [],
+            'best': None,
+            'running': None,
+        }
+        self.weights = {}
+        self.storage.delete_training_progress(self.model_name)
+        self._save()
+
+    def add_trial(self, params, loss, weights=None):
+        """
+        Record a completed trial. Its weights are kept if the trial is the
+        best one so far
+        """
+        self.progress['trials'].append({'params': params, 'loss': loss})
+        self.progress['running'] = None
+        updates = {'running': None}
+        best = self.progress['best']
+        if weights is not None and loss is not None and \
+           (best is None or loss < best['loss']):
+            self.progress['best'] = {'params': params, 'loss': loss}
+            updates['best'] = weights
+        self._save(updates)
+
+    def add_epoch(self, params, epochs, weights):
+        """
+        Record the weights of the running trial after `epochs` epochs
+        """
+        self.progress['running'] = {'params': params, 'epochs': epochs}
+        self._save({'running': weights})
+
+    def _save(self, weights=None):
+        weights = weights or {}
+        for name, arrays in weights.items():
+            if arrays is None:
+                self.weights.pop(name, None)
+            else:
+                self.weights[name] = arrays
+        self.storage.save_training_progress(
+            self.model_name,
+            self.progress,
+            weights,
+        )
+
+    def clear(self):
+        """
+        Delete the saved progress
+        """
+        self.progress = None
+        self.weights = {}
+        self.storage.delete_training_progress(self.model_name)
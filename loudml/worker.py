@@ -2,6 +2,8 @@
 Loud ML worker
 """
 
+import collections
+import copy
 import logging
 import signal
 import os
@@ -9,18 +11,129 @@ import os
 import loudml.config
 import loudml.bucket
 import loudml.model
-from loudml.misc import make_ts
+from loudml.misc import (
+    make_ts,
+    parse_timedelta,
+)
 from loudml import (
     errors,
 )
 
+from loudml.datacache import (
+    CachedBucket,
+    DataCache,
+)
 from loudml.filestorage import (
     FileStorage,
 )
+from loudml.outbox import (
+    HookOutbox,
+)
+from loudml.storage import (
+    TrainingCheckpoint,
+)
 
 g_worker = None
 
 
+def _get_rss_mb():
+    """
+    Return the resident set size of the current process in MiB
+    """
+    try:
+        with open('/proc/self/statm') as fd:
+            resident = int(fd.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return 0
+    return resident * os.sysconf('SC_PAGE_SIZE') / 2**20
+
+
+def _copy_state(state):
+    """
+    Deep copy model state. Weights are shared: they are never modified in
+    place, and may be memory-mapped.
+    """
+    memo = {}
+    if state is not None and isinstance(state.get('weights'), dict):
+        memo[id(state['weights'])] = state['weights']
+    return copy.deepcopy(state, memo)
+
+
+class ModelCache:
+    """
+    LRU cache of loaded models
+
+    Entries are indexed by model name and tagged with the model version
+    returned by the storage. An entry is only used if the version did not
+    change, i.e. the active checkpoint, the state and the settings are
+    the same as when it was put in the cache.
+    """
+
+    def __init__(self, max_models=8, max_rss_mb=0):
+        self.max_models = max_models
+        self.max_rss_mb = max_rss_mb
+        self.hits = 0
+        self.misses = 0
+        self._models = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._models)
+
+    def get(self, name, version):
+        """
+        Return cached model, or None if missing or outdated
+        """
+        entry = self._models.get(name)
+        if entry is None or version is None or entry[0] != version:
+            self.misses += 1
+            if entry is not None:
+                self._evict(name)
+            return None
+
+        self.hits += 1
+        self._models.move_to_end(name)
+        _, model, state = entry
+        # Restore the state as it was saved. Inference may have modified it
+        # without persisting the changes.
+        model._state = _copy_state(state)
+        return model
+
+    def put(self, name, version, model):
+        """
+        Add model to the cache and evict the least recently used ones
+        """
+        if version is None or self.max_models <= 0:
+            return
+
+        entry = self._models.get(name)
+        if entry is not None and entry[1] is not model:
+            self._evict(name)
+
+        self._models[name] = (version, model, _copy_state(model._state))
+        self._models.move_to_end(name)
+
+        while len(self._models) > self.max_models:
+            self._evict(next(iter(self._models)))
+        # Freed memory is not always given back to the system: evict one
+        # model per call rather than emptying the cache on a stale RSS
+        if len(self._models) > 1 and self.max_rss_mb > 0 \
+                and _get_rss_mb() > self.max_rss_mb:
+            self._evict(next(iter(self._models)))
+
+    def _evict(self, name):
+        _, model, _ = self._models.pop(name)
+        unload = getattr(model, 'unload', None)
+        if unload is not None:
+            unload()
+
+    def clear(self):
+        """
+        Evict all models
+        """
+        for name in list(self._models):
+            self._evict(name)
+
+
 class Worker:
     """
     Loud ML worker
@@ -28,8 +141,11 @@ class Worker:
 
     def __init__(self, msg_queue):
         self.storage = None
+        # Kept across jobs, for its cache of hook definitions
+        self._storage = None
         self._msg_queue = msg_queue
         self.job_id = None
+        self.model_cache = None
         signal.signal(signal.SIGINT, signal.SIG_IGN)
 
     def run(self, job_id, nice, func_name, config, *args, **kwargs):
@@ -45,7 +161,15 @@ class Worker:
         logging.info("job[%s] starting, nice=%d", job_id, nice)
         self.job_id = job_id
         self.config = config
-        self.storage = FileStorage(config.storage['path'])
+        if self._storage is None or \
+           self._storage.path != config.storage['path']:
+            self._storage = FileStorage(config.storage['path'])
+        self.storage = self._storage
+        if self.model_cache is None:
+            self.model_cache = ModelCache(
+                max_models=config.inference['model_cache_size'],
+                max_rss_mb=config.inference['model_cache_max_rss_mb'],
+            )
         curnice = os.nice(0)
         os.nice(int(nice) - curnice)
 
@@ -57,32 +181,107 @@ class Worker:
             logging.exception(exn)
             raise exn
         finally:
+            logging.info(
+                "job[%s] model cache: %d models, %d hits, %d misses",
+                job_id,
+                len(self.model_cache),
+                self.model_cache.hits,
+                self.model_cache.misses,
+            )
             self.job_id = None
             self.config = None
             self.storage = None
 
         return res
 
-    def train(self, model_name, bucket=None, **kwargs):
+    def _get_inference_kwargs(self):
+        """
+        Return inference settings to pass to the model
+        """
+        return {
+            'num_cpus': self.config.inference['num_cpus'],
+            'num_gpus': self.config.inference['num_gpus'],
+            'mc_memory_mb': self.config.inference['mc_memory_mb'],
+            'backend': self.config.inference['backend'],
+            'precision': self.config.inference['precision'],
+        }
+
+    def _load_model(self, model_name):
+        """
+        Load model from the cache, or from the storage on cache miss
+        """
+        # Read the version first: if the model changes in the meantime,
+        # the cached entry will be outdated, not stale.
+        version = self.storage.get_model_version(model_name)
+        model = self.model_cache.get(model_name, version)
+        if model is None:
+            model = self.storage.load_model(model_name)
+            self.model_cache.put(model_name, version, model)
+        return model
+
+    def train(self, model_name, bucket=None, resume=False, **kwargs):
         """
         Train model
+
+        The progress of the training is saved in the storage. With
+        `resume`, an interrupted training is continued with its saved
+        date range and parameters.
         """
 
         model = self.storage.load_model(model_name)
 
+        checkpoint = TrainingCheckpoint(self.storage, model_name)
+        if resume and checkpoint.load():
+            job = checkpoint.progress['job']
+            kwargs.update(
+                from_date=job['from_ts'],
+                to_date=job['to_ts'],
+                max_evals=job['max_evals'],
+                num_epochs=job['num_epochs'],
+            )
+        elif kwargs.get('from_date') is None:
+            raise errors.Invalid("no training to resume")
+
         bucket_name = bucket or model.default_bucket
         bucket_settings = self.config.get_bucket(bucket_name)
         bucket = loudml.bucket.load_bucket(bucket_settings)
 
-        def progress_cb(current_eval, max_evals):
+        if self.config.training['data_cache_max_mb'] > 0:
+            data_cache = DataCache(
+                os.path.join(self.storage.path, 'cache'),
+                settle=parse_timedelta(
+                    self.config.training['data_cache_settle']).total_seconds(),
+                max_size_mb=self.config.training['data_cache_max_mb'],
+            )
+            # Buckets within the model offset may still receive data
+            bucket = CachedBucket(
+                bucket,
+                data_cache,
+                settle=getattr(model, 'offset', 0),
+            )
+
+        def progress_cb(current_eval, max_evals, **stats):
+            """
+            Report progress. `stats` may include the training throughput
+            (batches_per_sec), the mean epoch duration in seconds
+            (epoch_time), the number of training windows (windows) and
+            the number of pruned trials (pruned)
+            """
+            progress = {
+                'eval': current_eval,
+                'max_evals': max_evals,
+                'rss_mb': round(_get_rss_mb(), 1),
+            }
+            for key, value in stats.items():
+                if isinstance(value, float):
+                    value = round(value, 2)
+                if value is not None:
+                    progress[key] = value
             self._msg_queue.put({
                 'type': 'job_state',
                 'job_id': self.job_id,
                 'state': 'running',
-                'progress': {
-                    'eval': current_eval,
-                    'max_evals': max_evals,
-                },
+                'progress': progress,
             })
         windows = bucket.list_anomalies(
             kwargs['from_date'],
@@ -90,7 +289,7 @@ class Worker:
             tags={'model': model_name},
         )
         num_epochs = kwargs.pop('num_epochs', self.config.training['epochs'])
-        model.train(
+        result = model.train(
             bucket,
             batch_size=self.config.training['batch_size'],
             num_epochs=num_epochs,
@@ -98,9 +297,13 @@ class Worker:
             num_gpus=self.config.training['num_gpus'],
             progress_cb=progress_cb,
             windows=windows,
+            checkpoint=checkpoint,
             **kwargs
         )
-        self.storage.save_model(model)
+        if not result.get('skipped'):
+            self.storage.save_model(model)
+        checkpoint.clear()
+        return result
 
     def _save_timeseries_prediction(
         self,
@@ -215,6 +418,30 @@ class Worker:
 
         bucket.commit()
 
+    def _detect_anomalies(self, model, prediction, bucket):
+        """
+        Detect anomalies and notify the model hooks
+
+        With the hook outbox, the hooks are not called: the events are
+        saved and the server delivers them.
+        """
+        outbox = None
+        if not self.storage.list_model_hooks(model.name):
+            hooks = []
+        elif self.config.hooks['outbox']:
+            outbox = HookOutbox(bucket.name)
+            hooks = [outbox]
+        else:
+            hooks = self.storage.load_model_hooks(model.settings, bucket)
+
+        model.detect_anomalies(prediction, hooks)
+
+        if outbox is not None and outbox.save(self.storage, model.name):
+            self._msg_queue.put({
+                'type': 'hook_events',
+                'model_name': model.name,
+            })
+
     def predict(
         self,
         model_name,
@@ -222,45 +449,51 @@ class Worker:
         save_prediction=False,
         detect_anomalies=False,
         output_bucket=None,
+        incremental=False,
         **kwargs
     ):
         """
         Ask model for a prediction
         """
 
-        model = self.storage.load_model(model_name)
+        model = self._load_model(model_name)
         bucket_settings = self.config.get_bucket(model.default_bucket)
         bucket = loudml.bucket.load_bucket(bucket_settings)
 
         if model.type in ['timeseries', 'donut']:
             _state = model.get_run_state()
-            if detect_anomalies:
+            if detect_anomalies or incremental:
                 prediction = model.predict2(
                     bucket,
                     _state=_state,
-                    num_cpus=self.config.inference['num_cpus'],
-                    num_gpus=self.config.inference['num_gpus'],
+                    incremental=incremental,
+                    **self._get_inference_kwargs(),
                     **kwargs
                 )
             else:
                 prediction = model.predict(
                     bucket,
-                    num_cpus=self.config.inference['num_cpus'],
-                    num_gpus=self.config.inference['num_gpus'],
+                    **self._get_inference_kwargs(),
                     **kwargs
                 )
 
+            if prediction is None:
+                logging.info("job[%s] no new data, prediction skipped",
+                             self.job_id)
+                return None
+
             logging.info("job[%s] predicted values for %d time buckets",
                          self.job_id, len(prediction.timestamps))
             if detect_anomalies:
-                hooks = self.storage.load_model_hooks(
-                    model.settings,
-                    bucket,
-                )
-                model.detect_anomalies(prediction, hooks)
+                self._detect_anomalies(model, prediction, bucket)
             if save_run_state:
                 model.set_run_state(_state)
                 self.storage.save_state(model)
+                self.model_cache.put(
+                    model.name,
+                    self.storage.get_model_version(model.name),
+                    model,
+                )
             if save_prediction:
                 self._save_timeseries_prediction(
                     model,
@@ -292,7 +525,7 @@ class Worker:
         Ask model for a forecast
         """
 
-        model = self.storage.load_model(model_name)
+        model = self._load_model(model_name)
         bucket_settings = self.config.get_bucket(model.default_bucket)
         bucket = loudml.bucket.load_bucket(bucket_settings)
 
@@ -300,8 +533,7 @@ class Worker:
 
         forecast = model.forecast(
             bucket,
-            num_cpus=self.config.inference['num_cpus'],
-            num_gpus=self.config.inference['num_gpus'],
+            **self._get_inference_kwargs(),
             **kwargs
         )
 
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Benchmark model state loading
+
+Compare the legacy state format, where the Keras model is stored in the
+JSON state as a base64 encoded HDF5 file, with the weight file format,
+where arrays are memory-mapped from a binary file next to the checkpoint.
+
+Keras is not required: the time needed to build the TensorFlow graph is
+the same for both formats and is not measured.
+"""
+
+import argparse
+import base64
+import io
+import os
+import time
+
+import h5py
+import numpy as np
+
+from loudml import npdonut
+from loudml.donut import DonutModel
+from loudml.filestorage import TempStorage
+
+
+def make_weights(span, intermediate_dim, latent_dim):
+    shapes = {
+        'encoder_dense_0': (span, intermediate_dim),
+        'encoder_dense_1': (intermediate_dim, intermediate_dim),
+        'z_mean': (intermediate_dim, latent_dim),
+        'z_log_var': (intermediate_dim, latent_dim),
+        'decoder_dense_0': (latent_dim, intermediate_dim),
+        'decoder_dense_1': (intermediate_dim, intermediate_dim),
+        'decoder_dense_2': (intermediate_dim, span),
+    }
+    weights = {}
+    for name, shape in shapes.items():
+        weights[name + '/kernel'] = np.random.normal(
+            size=shape).astype(np.float32)
+        weights[name + '/bias'] = np.random.normal(
+            size=shape[1:]).astype(np.float32)
+    return weights
+
+
+def make_h5(weights):
+    """
+    Write weights with the layout of a Keras HDF5 file
+    """
+    names = npdonut.ENCODER_LAYERS + npdonut.LATENT_LAYERS + \
+        npdonut.DECODER_LAYERS
+    buf = io.BytesIO()
+    with h5py.File(buf, mode='w') as h5:
+        group = h5.create_group('model_weights')
+        group.attrs['layer_names'] = [name.encode('utf-8') for name in names]
+        for name in names:
+            layer = group.create_group(name)
+            weight_names = [name + '/kernel:0', name + '/bias:0']
+            layer.attrs['weight_names'] = [
+                weight_name.encode('utf-8') for weight_name in weight_names
+            ]
+            layer[weight_names[0]] = weights[name + '/kernel']
+            layer[weight_names[1]] = weights[name + '/bias']
+    return base64.b64encode(buf.getvalue()).decode('utf-8')
+
+
+def bench(storage, name, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        model = storage.load_model(name)
+        weights = model._get_weights()
+        # make sure that mapped pages are read
+        sum(float(np.sum(array)) for array in weights.values())
+    return (time.perf_counter() - start) / repeat
+
+
+def state_size(storage, name):
+    model_path = storage.model_path(name)
+    ckpt = storage.get_current_ckpt(name)
+    size = 0
+    for ext in ['.ckpt', '.weights']:
+        path = os.path.join(model_path, ckpt + ext)
+        if os.path.exists(path):
+            size += os.stat(path).st_size
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--span', type=int, default=100)
+    parser.add_argument('--intermediate-dim', type=int, default=233)
+    parser.add_argument('--latent-dim', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=100)
+    args = parser.parse_args()
+
+    storage = TempStorage(prefix='bench-')
+    weights = make_weights(args.span, args.intermediate_dim, args.latent_dim)
+    state = {
+        'best_params': {
+            'span': args.span,
+            'intermediate_dim': args.intermediate_dim,
+            'latent_dim': args.latent_dim,
+            'optimizer': 'adam',
+        },
+        'means': [0.0],
+        'stds': [1.0],
+        'loss': 0.0,
+    }
+
+    for name, fmt in [('legacy', {'h5py': make_h5(weights)}),
+                      ('weights', {'weights': weights})]:
+        model = DonutModel(dict(
+            name=name,
+            offset=30,
+            span=args.span,
+            bucket_interval=60,
+            interval=60,
+            features=[{
+                'name': 'avg_foo',
+                'metric': 'avg',
+                'field': 'foo',
+            }],
+        ), state=dict(state, **fmt))
+        storage.create_model(model)
+        storage.save_model(model)
+
+        elapsed = bench(storage, name, args.repeat)
+        print("{:8s} state={:8.1f} KiB load={:8.3f} ms".format(
+            name,
+            state_size(storage, name) / 1024,
+            elapsed * 1000,
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+from loudml.datacache import (
+    CachedBucket,
+    DataCache,
+)
+from loudml.membucket import MemBucket
+from loudml.model import Feature
+
+import os
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+FEATURES = [
+    Feature(name='avg_foo', metric='avg', field='foo'),
+]
+
+
+class CountingBucket(MemBucket):
+    def __init__(self):
+        super().__init__()
+        self.requests = []
+
+    def get_times_data(
+        self,
+        bucket_interval,
+        features,
+        from_date=None,
+        to_date=None,
+    ):
+        self.requests.append((from_date, to_date))
+        return super().get_times_data(
+            bucket_interval,
+            features,
+            from_date,
+            to_date,
+        )
+
+
+class TestDataCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory(prefix='loudml-')
+        self.cache = DataCache(os.path.join(self.tmp.name, 'cache'))
+        self.source = CountingBucket()
+        for ts in range(0, 3600, 60):
+            # missing bucket
+            if ts == 600:
+                continue
+            self.source.insert_times_data({
+                'timestamp': ts,
+                'foo': ts / 60,
+            })
+        self.source.commit()
+        self.bucket = CachedBucket(self.source, self.cache)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _values(self, bucket, from_ts, to_ts):
+        data = bucket.get_times_data(
+            bucket_interval=60,
+            features=FEATURES,
+            from_date=from_ts,
+            to_date=to_ts,
+        )
+        return [val[0] for _, val, _ in data]
+
+    def _check_range(self, from_ts, to_ts):
+        cached = self._values(self.bucket, from_ts, to_ts)
+        requests = list(self.source.requests)
+        expected = self._values(self.source, from_ts, to_ts)
+        self.source.requests = requests
+        np.testing.assert_array_equal(cached, expected)
+
+    def test_cache(self):
+        self._check_range(600, 1800)
+        self.assertEqual(self.source.requests, [(600, 1800)])
+
+        # cached
+        self._check_range(900, 1200)
+        self.assertEqual(self.source.requests, [(600, 1800)])
+
+        # only missing ranges are fetched
+        self._check_range(0, 2400)
+        self.assertEqual(self.source.requests, [
+            (600, 1800),
+            (0, 600),
+            (1800, 2400),
+        ])
+
+        # disjoint ranges replace the cached series
+        self._check_range(3000, 4200)
+        self.assertEqual(self.source.requests[-1], (3000, 4200))
+        self._check_range(0, 600)
+        self.assertEqual(self.source.requests[-1], (0, 600))
+
+    def test_settle(self):
+        # buckets after 1200 may still change
+        self.cache.settle = time.time() - 1230
+        self._check_range(0, 1800)
+        self._check_range(0, 1800)
+        self.assertEqual(self.source.requests, [(0, 1800), (1200, 1800)])
+        self._check_range(0, 1200)
+        self.assertEqual(len(self.source.requests), 2)
+
+        # the cached tail within a longer settle delay is fetched again
+        bucket = CachedBucket(
+            self.source, self.cache, settle=time.time() - 630)
+        self._values(bucket, 0, 1200)
+        self.assertEqual(self.source.requests[-1], (600, 1200))
+        self._check_range(0, 1200)
+        self.assertEqual(self.source.requests[-1], (600, 1200))
+        self.assertEqual(len(self.source.requests), 4)
+
+    def test_max_size(self):
+        self.cache.max_size_mb = 1 / 1024
+        other = Feature(name='max_foo', metric='max', field='foo')
+        self._check_range(0, 3600)
+        self._values(self.bucket, 0, 3600)
+        self.bucket.get_times_data(60, [other], 0, 3600)
+        self.assertEqual(os.listdir(self.cache.path), [
+            self.cache.get_key(self.source, 60, [other]),
+        ])
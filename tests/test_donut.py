@@ -3,10 +3,23 @@ from loudml.misc import (
     make_ts,
 )
 from loudml.filestorage import TempStorage
+from loudml.storage import TrainingCheckpoint
 from loudml.membucket import MemBucket
+from loudml import npdonut
 from loudml.donut import (
     DonutModel,
+    _find_spans,
+    _fingerprint,
+    _forecast_particles,
     _format_windows,
+    _mc_std,
+    _mc_std_adaptive,
+    _ut_std,
+    generator,
+    g_mcmc_count,
+    RunningStats,
+    SuccessiveHalving,
+    TimeSeriesPrediction,
 )
 from randevents import (
     FlatEventGenerator,
@@ -21,6 +34,7 @@ import random
 import unittest
 
 import numpy as np
+from scipy.stats import norm
 
 
 def f1_score(testy, yhat):
@@ -167,6 +181,169 @@ class TestTimes(unittest.TestCase):
         self._require_training()
         self.assertTrue(self.model.is_trained)
 
+    def test_train_parallel(self):
+        evals = []
+        model = DonutModel(dict(self.model.settings, max_evals=4))
+        model.train(
+            self.source,
+            self.from_date,
+            self.to_date,
+            batch_size=32,
+            num_cpus=2,
+            progress_cb=lambda current_eval, *args, **kwargs:
+                evals.append(current_eval),
+        )
+        self.assertTrue(model.is_trained)
+        self.assertEqual(max(evals), 4)
+
+    def test_train_resume(self):
+        storage = TempStorage()
+        model = DonutModel(dict(self.model.settings, max_evals=3))
+        storage.create_model(model)
+
+        class Interrupted(Exception):
+            pass
+
+        def progress_cb(current_eval, max_evals, **kwargs):
+            if current_eval == 2:
+                raise Interrupted()
+
+        checkpoint = TrainingCheckpoint(storage, model.name)
+        with self.assertRaises(Interrupted):
+            model.train(
+                self.source,
+                self.from_date,
+                self.to_date,
+                batch_size=32,
+                progress_cb=progress_cb,
+                checkpoint=checkpoint,
+            )
+
+        checkpoint = TrainingCheckpoint(storage, model.name)
+        self.assertTrue(checkpoint.load())
+        self.assertEqual(len(checkpoint.progress['trials']), 2)
+        self.assertIsNotNone(checkpoint.progress['best'])
+        self.assertIn('best', checkpoint.weights)
+
+        evals = []
+        model = storage.load_model(model.name)
+        model.train(
+            self.source,
+            self.from_date,
+            self.to_date,
+            batch_size=32,
+            progress_cb=lambda current_eval, *args, **kwargs:
+                evals.append(current_eval),
+            checkpoint=checkpoint,
+        )
+        self.assertTrue(model.is_trained)
+        # completed trials are not run again
+        self.assertEqual(len(model.state['trials']), 3)
+        self.assertNotIn(1, evals)
+        self.assertEqual(evals[-1], 3)
+
+    def test_train_unchanged(self):
+        model = DonutModel(dict(self.model.settings, max_evals=1))
+        model.train(self.source, self.from_date, self.to_date, batch_size=32)
+        state = model.state
+        self.assertIn('fingerprint', state)
+
+        result = model.train(
+            self.source, self.from_date, self.to_date, batch_size=32)
+        self.assertEqual(result, {'skipped': 'unchanged'})
+        self.assertIs(model.state, state)
+
+        result = model.train(
+            self.source, self.from_date, self.to_date, batch_size=32,
+            force=True,
+        )
+        self.assertNotIn('skipped', result)
+        self.assertIsNot(model.state, state)
+        self.assertEqual(model.state['fingerprint'], state['fingerprint'])
+
+    def test_train_incremental(self):
+        model = DonutModel(dict(self.model.settings, max_evals=1))
+        to_date = self.to_date - 3600 * 24 * 3
+        model.train(self.source, self.from_date, to_date, batch_size=32)
+        means = model.state['means']
+        stds = model.state['stds']
+        self.assertEqual(model.state['trained_until'], to_date)
+        count = model.state['stats']['count'][0]
+
+        result = model.train(
+            self.source,
+            self.from_date,
+            self.to_date,
+            batch_size=32,
+            incremental=True,
+        )
+        self.assertEqual(model.state['trained_until'], self.to_date)
+        # the scale of the model does not change
+        self.assertEqual(model.state['means'], means)
+        self.assertEqual(model.state['stds'], stds)
+        # only new buckets are added to the statistics
+        self.assertEqual(
+            model.state['stats']['count'][0],
+            count + 3600 * 24 * 3 / model.bucket_interval,
+        )
+        self.assertFalse(result['drift']['detected'])
+
+        result = model.train(
+            self.source,
+            self.from_date,
+            self.to_date,
+            batch_size=32,
+            incremental=True,
+        )
+        self.assertEqual(result, {'skipped': 'unchanged'})
+
+    def test_numpy_backend(self):
+        self._require_training()
+
+        x = np.random.normal(size=(10, self.model._window))
+        missing = np.full(x.shape, False, dtype=bool)
+
+        self.model.load(backend='keras')
+        z_mean, z_log_var, _ = self.model._encoder_model.predict(
+            [x, missing])
+        x_decoded = self.model._decoder_model.predict(z_mean)
+        self.model.unload()
+
+        self.model.load(backend='numpy')
+        self.assertIsInstance(self.model._encoder_model, npdonut.Encoder)
+        np_z_mean, np_z_log_var, _ = self.model._encoder_model.predict(
+            [x, missing])
+        np_x_decoded = self.model._decoder_model.predict(np_z_mean)
+        self.model.unload()
+
+        np.testing.assert_allclose(np_z_mean, z_mean, rtol=1e-4, atol=1e-5)
+        np.testing.assert_allclose(
+            np_z_log_var, z_log_var, rtol=1e-4, atol=1e-5)
+        np.testing.assert_allclose(
+            np_x_decoded, x_decoded, rtol=1e-4, atol=1e-5)
+
+    def test_legacy_weights(self):
+        weights = {
+            'foo/kernel': np.random.normal(size=(5, 3)),
+            'foo/bias': np.random.normal(size=(3,)),
+        }
+        model = DonutModel(dict(
+            name='test',
+            offset=30,
+            span=5,
+            bucket_interval=20 * 60,
+            interval=60,
+            features=FEATURES,
+            max_threshold=70,
+            min_threshold=60,
+        ), state={
+            'weights': npdonut.serialize_weights(weights),
+        })
+        converted = model._get_weights()
+        self.assertIs(model.state['weights'], converted)
+        for name, array in weights.items():
+            np.testing.assert_array_equal(converted[name], array)
+
     def test_format_windows(self):
         from_date = 100
         to_date = 200
@@ -293,6 +470,568 @@ class TestTimes(unittest.TestCase):
             [10.0, 12.0, 0.0],
         ])
 
+        # windows are views of the series
+        missing, x = model._format_dataset(dataset)
+        self.assertFalse(x.flags.writeable)
+        self.assertEqual(x.strides, (x.itemsize, x.itemsize))
+
+        missing, x = model._format_dataset(dataset[:2])
+        self.assertEqual(missing.shape, (0, 3))
+        self.assertEqual(x.shape, (0, 3))
+
+    def test_generator(self):
+        W = 4
+        batch_size = 8
+        x = np.arange(10 * W, dtype=float).reshape((10, W))
+        missing = np.zeros((10, W), dtype=bool)
+        missing[:, -1] = True
+
+        class VAE:
+            calls = 0
+
+            def predict(self, inputs, batch_size):
+                VAE.calls += 1
+                _x, _missing = inputs
+                return np.full(_x.shape, -1.0), None
+
+        # 16 * W * 8 bytes per batch: 2 batches per chunk
+        gen = generator(
+            x, missing, batch_size, VAE(),
+            memory_mb=2 * 16 * W * batch_size / 2**20,
+        )
+        for _ in range(4):
+            (batch_x, batch_missing), _ = next(gen)
+            self.assertEqual(batch_x.shape, (batch_size, W))
+            self.assertEqual(batch_missing.shape, (batch_size, W))
+            self.assertTrue(np.all(batch_missing[:, -1] == 1))
+            self.assertTrue(np.all(batch_x[batch_missing > 0] == -1.0))
+            observed = batch_x[batch_missing == 0]
+            self.assertTrue(np.all(observed >= 0))
+
+        self.assertEqual(VAE.calls, 2 * g_mcmc_count)
+
+        # Chunks do not span several epochs
+        VAE.calls = 0
+        gen = generator(x, missing, batch_size, VAE(), steps_per_epoch=1)
+        for _ in range(3):
+            next(gen)
+        self.assertEqual(VAE.calls, 3 * g_mcmc_count)
+
+    def test_sample_windows(self):
+        dataset = np.arange(20, dtype=float)
+        dataset[[2, 3, 4, 10]] = np.nan
+        model = DonutModel(dict(
+            name='test_sample',
+            offset=30,
+            span=4,
+            bucket_interval=20 * 60,
+            interval=60,
+            features=[
+                FEATURE_COUNT_FOO,
+            ],
+            window_stride=2,
+        ))
+        all_missing, all_x = model._format_dataset(dataset)
+
+        missing, x = model._sample_windows(all_missing, all_x)
+        self.assertEqual(x[:, 0].tolist(), [0, 0, 0, 6, 8, 0, 12, 14, 16])
+        self.assertTrue(np.shares_memory(x, all_x))
+
+        model.max_missing_ratio = 0.25
+        missing, x = model._sample_windows(all_missing, all_x)
+        self.assertEqual(x[:, 0].tolist(), [0, 6, 8, 0, 12, 14, 16])
+        self.assertTrue(np.all(missing.mean(axis=1) <= 0.25))
+
+        model.window_stride = 1
+        model.max_missing_ratio = 0.5
+        missing, x = model._sample_windows(all_missing, all_x)
+        self.assertEqual(x[:, -1].tolist(), [
+            0, 6, 7, 8, 9, 0, 11, 12, 13, 14, 15, 16, 17, 18, 19,
+        ])
+
+        # one window in each third of the range
+        missing, x = model._sample_windows(all_missing, all_x, max_windows=3)
+        self.assertEqual(len(x), 3)
+        self.assertIn(x[0, -1], [0, 6, 7, 8, 9])
+        self.assertIn(x[1, -1], [0, 11, 12, 13, 14])
+        self.assertIn(x[2, -1], [15, 16, 17, 18, 19])
+
+    def test_fingerprint(self):
+        dataset = np.array([1.0, np.nan, 3.0, 4.0])
+        abnormal = np.array([False, False, True, False])
+        fingerprint = _fingerprint(dataset, abnormal, span=5, max_evals=None)
+        self.assertEqual(
+            _fingerprint(dataset.copy(), abnormal, max_evals=None, span=5),
+            fingerprint,
+        )
+
+        changed = dataset.copy()
+        changed[0] = 2.0
+        self.assertNotEqual(
+            _fingerprint(changed, abnormal, span=5, max_evals=None),
+            fingerprint,
+        )
+        self.assertNotEqual(
+            _fingerprint(dataset, ~abnormal, span=5, max_evals=None),
+            fingerprint,
+        )
+        self.assertNotEqual(
+            _fingerprint(dataset[:3], abnormal, span=5, max_evals=None),
+            fingerprint,
+        )
+        self.assertNotEqual(
+            _fingerprint(dataset, abnormal, span=6, max_evals=None),
+            fingerprint,
+        )
+
+    def test_running_stats(self):
+        dataset = np.random.normal(5.0, 2.0, size=(1000,))
+        dataset[::7] = np.nan
+
+        stats = RunningStats.from_dataset(dataset[:10])
+        for i in range(10, 1000, 99):
+            stats.update(dataset[i:i + 99])
+        stats.update(np.full((5,), np.nan))
+
+        self.assertEqual(stats.count[0], np.sum(~np.isnan(dataset)))
+        self.assertAlmostEqual(stats.mean[0], np.nanmean(dataset))
+        self.assertAlmostEqual(stats.std[0], np.nanstd(dataset))
+
+        stats = RunningStats.from_dict(stats.to_dict())
+        self.assertAlmostEqual(stats.std[0], np.nanstd(dataset))
+
+        drift = stats.drift([np.nanmean(dataset)], [np.nanstd(dataset)])
+        self.assertAlmostEqual(drift['mean_shift'], 0.0)
+        self.assertAlmostEqual(drift['std_ratio'], 1.0)
+
+        stats.update(np.random.normal(50.0, 20.0, size=(1000,)))
+        drift = stats.drift([np.nanmean(dataset)], [np.nanstd(dataset)])
+        self.assertGreater(drift['mean_shift'], 1.0)
+        self.assertGreater(drift['std_ratio'], 2.0)
+
+        self.assertIsNone(
+            RunningStats.from_dataset(np.full((3,), np.nan)).drift([0], [1]))
+
+    def test_update_stats(self):
+        model = DonutModel(dict(
+            name='test_stats',
+            offset=30,
+            span=5,
+            bucket_interval=60,
+            interval=60,
+            features=FEATURES,
+        ))
+        history = np.random.normal(5.0, 2.0, size=(100000,))
+        model.stat_dataset(history)
+
+        # A short shifted batch is compared alone to the reference scale
+        drift = model.update_stats(np.random.normal(15.0, 2.0, size=(100,)))
+        self.assertTrue(drift['detected'])
+        self.assertGreater(drift['mean_shift'], 4.0)
+        self.assertEqual(model.stats.count[0], 100100)
+
+        drift = model.update_stats(np.random.normal(5.0, 2.0, size=(100,)))
+        self.assertFalse(drift['detected'])
+
+    def test_compute_scores(self):
+        def compute_bucket_scores(anomaly_type, y_true, y_pred, y_low,
+                                  y_high):
+            # scalar implementation of previous versions
+            diff = y_true - y_pred
+            mu = (y_low + y_high) / 2.0
+            std = (y_high - mu) / 3.0
+            score = 2 * norm.cdf(abs(y_true - mu), loc=0, scale=std) - 1
+            if diff < 0:
+                score *= -1
+            if anomaly_type == 'low':
+                score = -min(score, 0)
+            elif anomaly_type == 'high':
+                score = max(score, 0)
+            else:
+                score = abs(score)
+            return 100 * max(0, min(1, score)), diff ** 2
+
+        nb_buckets = 1000
+        observed = np.random.normal(10, 3, size=(nb_buckets,))
+        predicted = np.random.normal(10, 1, size=(nb_buckets,))
+        low = predicted - np.random.uniform(-1, 5, size=(nb_buckets,))
+        high = predicted + np.random.uniform(-1, 5, size=(nb_buckets,))
+        observed[::13] = np.nan
+        observed[::19] = predicted[::19]
+        low[::17] = high[::17]
+
+        for anomaly_type in ['low', 'high', 'low_high']:
+            model = DonutModel(dict(
+                name='test',
+                offset=30,
+                span=5,
+                bucket_interval=60,
+                interval=60,
+                features=[dict(FEATURES[0], anomaly_type=anomaly_type)],
+            ))
+            with np.errstate(invalid='ignore'):
+                expected = np.array([
+                    compute_bucket_scores(anomaly_type, *bucket)
+                    for bucket in zip(observed, predicted, low, high)
+                ])
+            scores, mses = model.compute_scores(
+                observed, predicted, low, high)
+            np.testing.assert_array_equal(scores, expected[:, 0])
+            np.testing.assert_allclose(mses, expected[:, 1], rtol=1e-15)
+
+            score, mse = model.compute_bucket_scores(
+                observed[1], predicted[1], low[1], high[1])
+            self.assertEqual(score, expected[1, 0])
+
+    def test_detect_anomalies_transitions(self):
+        model = DonutModel(dict(
+            name='test',
+            offset=30,
+            span=5,
+            bucket_interval=60,
+            interval=60,
+            features=FEATURES,
+            grace_period=180,
+            max_threshold=99.7,
+            min_threshold=68,
+        ), state={})
+
+        # buckets 2-4 are abnormal, 6 is in the grace period after the end
+        # of the anomaly at 5 and 9 starts a new one
+        abnormal = [2, 3, 4, 6, 9]
+        timestamps = [1000 + 60 * i for i in range(10)]
+        predicted = np.full((10,), 5.0)
+        observed = predicted.copy()
+        observed[abnormal] += 100
+        prediction = TimeSeriesPrediction(
+            model,
+            timestamps=timestamps,
+            observed=observed,
+            predicted=predicted,
+            lower=predicted - 2,
+            upper=predicted + 2,
+        )
+
+        hook = TestHook(model.settings, TempStorage())
+        model.detect_anomalies(prediction, hooks=[hook])
+
+        self.assertEqual(prediction.anomaly_indices, [2, 3, 4, 9])
+        self.assertEqual(
+            [(event['type'], event['dt'].timestamp())
+             for event in hook.events],
+            [('start', 1120), ('end', 1300), ('start', 1540)],
+        )
+        self.assertEqual(model.state['anomaly']['start_ts'], 1540)
+        self.assertEqual(model.state['last_anomaly_ts'], 1300)
+
+        stats = prediction.stats
+        self.assertEqual(len(stats), 10)
+        self.assertEqual(
+            [bucket['anomaly'] for bucket in stats],
+            [i in [2, 3, 4, 9] for i in range(10)],
+        )
+        self.assertEqual(stats[6]['score'], 100)
+        self.assertEqual(stats[3]['anomalies']['count_foo']['type'], 'high')
+        self.assertEqual(
+            prediction.format_buckets()[3]['stats'], stats[3])
+
+    def test_find_spans(self):
+        rng = np.random.RandomState(0)
+        t = np.arange(24 * 30)
+        x = np.sin(2 * np.pi * t / 24) + rng.normal(0, 0.1, len(t))
+        x[100:110] = np.nan
+
+        spans = _find_spans(x, 10, 100)
+        self.assertEqual(spans, [24, 48, 72])
+        self.assertEqual(_find_spans(x, 10, 100, count=1), [24])
+        self.assertEqual(_find_spans(x, 30, 60), [48])
+
+        # no periodicity
+        self.assertEqual(_find_spans(rng.normal(0, 1, len(t)), 10, 100), [])
+        self.assertEqual(_find_spans(np.full(100, np.nan), 10, 100), [])
+
+    def test_successive_halving(self):
+        halving = SuccessiveHalving(min_epochs=2, eta=2)
+        self.assertEqual(
+            [epochs for epochs in range(1, 20) if halving.is_rung(epochs)],
+            [2, 4, 8, 16],
+        )
+
+        # not enough losses to compare
+        self.assertTrue(halving.report(2, 1.0))
+        # best half
+        self.assertTrue(halving.report(2, 0.5))
+        self.assertFalse(halving.report(2, 2.0))
+        self.assertTrue(halving.report(2, 0.7))
+        self.assertFalse(halving.report(2, 0.8))
+        self.assertEqual(halving.rungs, {2: [1.0, 0.5, 2.0, 0.7, 0.8]})
+
+        other = SuccessiveHalving(min_epochs=2, eta=2, rungs={4: [0.1]})
+        self.assertFalse(other.report(4, 0.2))
+        halving.merge({4: [0.1, 0.2]})
+        self.assertEqual(halving.rungs[4], [0.1, 0.2])
+
+    def test_trials_history(self):
+        from hyperopt import Trials, hp
+
+        model = DonutModel(dict(
+            name='test',
+            offset=30,
+            span='auto',
+            min_span=10,
+            max_span=20,
+            bucket_interval=20 * 60,
+            interval=60,
+            features=FEATURES,
+        ))
+        latent_dims = [3, 5, 8]
+        neurons = [100]
+        space = hp.choice('case', [
+            {
+                'span': model.get_hp_span('span'),
+                'latent_dim': hp.choice('latent_dim', latent_dims),
+                'intermediate_dim': hp.choice('i1', neurons),
+                'optimizer': hp.choice('optimizer', ['adam']),
+            }
+        ])
+        history = [
+            {
+                'params': {
+                    'span': 12,
+                    'latent_dim': 5,
+                    'intermediate_dim': 100,
+                    'optimizer': 'adam',
+                },
+                'loss': 0.5,
+            },
+            {
+                'params': {
+                    'span': 15,
+                    'latent_dim': 3,
+                    'intermediate_dim': 100,
+                    'optimizer': 'adam',
+                },
+                'loss': 0.25,
+            },
+            # not in the search space
+            {
+                'params': {
+                    'span': 30,
+                    'latent_dim': 3,
+                    'intermediate_dim': 100,
+                    'optimizer': 'adam',
+                },
+                'loss': 0.1,
+            },
+            {
+                'params': {
+                    'span': 15,
+                    'latent_dim': 3,
+                    'intermediate_dim': 233,
+                    'optimizer': 'adam',
+                },
+                'loss': 0.1,
+            },
+        ]
+
+        trials = Trials()
+        model._load_trials(trials, history, latent_dims, neurons)
+        self.assertEqual(len(trials), 2)
+        self.assertEqual(trials.argmin['span'], 5)
+        self.assertEqual(model._dump_trials(trials.trials, space),
+                         history[:2])
+
+    def test_span_scores(self):
+        from hyperopt import Trials, hp
+        from loudml.donut import MAX_TRIALS_HISTORY
+
+        model = DonutModel(dict(
+            name='test',
+            offset=30,
+            span='auto',
+            min_span=10,
+            max_span=100,
+            bucket_interval=20 * 60,
+            interval=60,
+            features=FEATURES,
+        ))
+        latent_dims = [3, 5, 8]
+        neurons = [100]
+        spans = [24, 48, 72]
+        space = hp.choice('case', [
+            {
+                'span': model.get_hp_span('span', spans),
+                'latent_dim': hp.choice('latent_dim', latent_dims),
+                'intermediate_dim': hp.choice('i1', neurons),
+                'optimizer': hp.choice('optimizer', ['adam']),
+            }
+        ])
+
+        def make_entry(span, loss):
+            return {
+                'params': {
+                    'span': span,
+                    'latent_dim': 3,
+                    'intermediate_dim': 100,
+                    'optimizer': 'adam',
+                },
+                'loss': loss,
+            }
+
+        # Warm start from a full history
+        trials = Trials()
+        model._load_trials(trials, [
+            make_entry(spans[i % 3], 0.01) for i in range(MAX_TRIALS_HISTORY)
+        ], latent_dims, neurons, spans)
+        nb_loaded = len(trials)
+        self.assertEqual(nb_loaded, MAX_TRIALS_HISTORY)
+
+        # Trials of the new search
+        model._load_trials(trials, [
+            make_entry(24, 0.5),
+            make_entry(72, 0.4),
+            make_entry(24, 0.3),
+        ], latent_dims, neurons, spans)
+
+        self.assertEqual(
+            model._get_span_scores(trials.trials[nb_loaded:], space, spans),
+            [
+                {'span': 24, 'loss': 0.3},
+                {'span': 48, 'loss': None},
+                {'span': 72, 'loss': 0.4},
+            ],
+        )
+        self.assertEqual(
+            len(model._dump_trials(trials.trials, space)),
+            MAX_TRIALS_HISTORY,
+        )
+
+    def test_mc_std(self):
+        mc_count = 100
+
+        class Encoder:
+            calls = 0
+
+            def predict(self, inputs, batch_size):
+                Encoder.calls += 1
+                x, _ = inputs
+                return x, x, x
+
+        class Decoder:
+            def predict(self, z, batch_size):
+                # samples of one window are spread over [0, mc_count[
+                x_decoded = np.copy(z)
+                x_decoded[:, -1] += np.arange(len(z)) % mc_count
+                return x_decoded
+
+        x = np.random.rand(50, 8)
+        missing = np.full(x.shape, False, dtype=bool)
+
+        # one chunk
+        std = _mc_std(Encoder(), Decoder(), x, missing, mc_count, 64)
+        self.assertEqual(Encoder.calls, 1)
+        self.assertEqual(std.shape, (50,))
+        np.testing.assert_allclose(std, np.std(np.arange(mc_count)))
+
+        # several chunks
+        Encoder.calls = 0
+        std = _mc_std(Encoder(), Decoder(), x, missing, mc_count, 0.5)
+        self.assertGreater(Encoder.calls, 1)
+        np.testing.assert_allclose(std, np.std(np.arange(mc_count)))
+
+    def test_mc_std_adaptive(self):
+        class Encoder:
+            def predict(self, inputs, batch_size):
+                x, _ = inputs
+                return x, x, x
+
+        class Decoder:
+            def predict(self, z, batch_size):
+                # samples take values 0 and 1, except for the first window
+                x_decoded = np.copy(z)
+                x_decoded[:, -1] = np.arange(len(z)) % 2 * z[:, 0]
+                return x_decoded
+
+        x = np.ones((10, 8))
+        x[0, 0] = 0
+        missing = np.full(x.shape, False, dtype=bool)
+
+        # std does not change after the second increment
+        std, count = _mc_std_adaptive(
+            Encoder(), Decoder(), x, missing, 50, 1000, 0.01, 64)
+        np.testing.assert_allclose(std, [0] + [0.5] * 9)
+        self.assertEqual(count.tolist(), [100] * 10)
+
+        # the tolerance cannot be reached
+        x[0, 0] = 1
+        std, count = _mc_std_adaptive(
+            Encoder(), Decoder(), x, missing, 50, 120, -1, 64)
+        np.testing.assert_allclose(std, 0.5)
+        self.assertEqual(count.tolist(), [120] * 10)
+
+    def test_ut_std(self):
+        latent_dim = 3
+        z_std = np.array([0.5, 1.0, 2.0])
+        a = np.array([1.0, -2.0, 3.0])
+
+        class Encoder:
+            def predict(self, inputs, batch_size):
+                x, _ = inputs
+                z_mean = x[:, :latent_dim]
+                z_log_var = np.tile(np.log(z_std ** 2), (len(x), 1))
+                return z_mean, z_log_var, z_mean
+
+        class Decoder:
+            calls = 0
+
+            def predict(self, z, batch_size):
+                Decoder.calls += 1
+                x_decoded = np.zeros((len(z), 8))
+                x_decoded[:, -1] = np.dot(z, a)
+                return x_decoded
+
+        x = np.random.normal(size=(20, 8))
+        missing = np.full(x.shape, False, dtype=bool)
+        std = _ut_std(Encoder(), Decoder(), x, missing)
+
+        # exact for a linear decoder
+        self.assertEqual(Decoder.calls, 1)
+        self.assertEqual(std.shape, (20,))
+        np.testing.assert_allclose(std, np.sqrt(np.sum((a * z_std) ** 2)))
+
+    def test_forecast_particles(self):
+        particles = 100
+
+        class Encoder:
+            calls = 0
+            batch_sizes = set()
+
+            def predict(self, inputs, batch_size):
+                Encoder.calls += 1
+                x, _ = inputs
+                Encoder.batch_sizes.add(len(x))
+                return x, x, x
+
+        class Decoder:
+            def predict(self, z, batch_size):
+                # each path drifts by its own index
+                x_decoded = np.copy(z)
+                x_decoded[:, -1] += np.arange(len(z))
+                return x_decoded
+
+        x = np.zeros((8,))
+        mean, std = _forecast_particles(
+            Encoder(), Decoder(), x, 5, particles, 0)
+        self.assertEqual(Encoder.calls, 5)
+        self.assertEqual(Encoder.batch_sizes, {particles})
+        self.assertEqual(mean.shape, (5,))
+        # the new point starts from the previous one (persistence)
+        steps = np.arange(1, 6)
+        np.testing.assert_allclose(mean, steps * np.mean(np.arange(particles)))
+        np.testing.assert_allclose(std, steps * np.std(np.arange(particles)))
+        # input window is left untouched
+        self.assertEqual(x.tolist(), [0] * 8)
+
     def test_train_abnormal(self):
         source = MemBucket()
         from_date = '1970-01-01T00:00:00.000Z'
@@ -448,6 +1187,158 @@ class TestTimes(unittest.TestCase):
                 delta=2,
             )
 
+    def test_predict_incremental(self):
+        self._require_training()
+
+        to_date = self.to_date
+        from_date = to_date - 24 * 3600
+        _state = {}
+
+        prediction = self.model.predict2(
+            self.source,
+            from_date,
+            to_date - 12 * 3600,
+            _state=_state,
+            incremental=True,
+        )
+        self.assertEqual(len(prediction.timestamps), 36)
+        self.assertEqual(_state['history']['ts'], to_date - 12 * 3600)
+        self.assertEqual(
+            len(_state['history']['values']),
+            self.model._window - 1,
+        )
+
+        # Only new buckets are predicted
+        prediction = self.model.predict2(
+            self.source,
+            from_date,
+            to_date,
+            _state=_state,
+            incremental=True,
+        )
+        self.assertEqual(len(prediction.timestamps), 36)
+        self.assertEqual(prediction.timestamps[0], to_date - 12 * 3600)
+        self.assertEqual(_state['history']['ts'], to_date)
+
+        expected = self.model.predict(
+            self.source,
+            to_date - 12 * 3600,
+            to_date,
+        )
+        self.assertEqual(prediction.timestamps, expected.timestamps)
+        np.testing.assert_allclose(
+            prediction.observed, expected.observed)
+        np.testing.assert_allclose(
+            prediction.predicted, expected.predicted, rtol=1e-5, atol=1e-6)
+
+        # No new bucket
+        prediction = self.model.predict2(
+            self.source,
+            from_date,
+            to_date,
+            _state=_state,
+            incremental=True,
+        )
+        self.assertIsNone(prediction)
+
+    def test_predict_precision(self):
+        self._require_training()
+
+        to_date = self.to_date
+        from_date = to_date - 24 * 3600
+
+        prediction32 = self.model.predict(
+            self.source, from_date, to_date, precision='float32')
+        prediction64 = self.model.predict(
+            self.source, from_date, to_date, precision='float64')
+
+        self.assertEqual(prediction32.predicted.dtype, np.float64)
+        self.assertEqual(prediction32.timestamps, prediction64.timestamps)
+        np.testing.assert_allclose(
+            prediction32.observed, prediction64.observed, rtol=1e-6)
+        np.testing.assert_allclose(
+            prediction32.predicted, prediction64.predicted,
+            rtol=1e-3, atol=1e-3)
+
+    def test_predict_precision_large_offset(self):
+        span = 5
+        shapes = {
+            'encoder_dense_0': (span, 8),
+            'encoder_dense_1': (8, 8),
+            'z_mean': (8, 3),
+            'z_log_var': (8, 3),
+            'decoder_dense_0': (3, 8),
+            'decoder_dense_1': (8, 8),
+            'decoder_dense_2': (8, span),
+        }
+        weights = {}
+        for name, shape in shapes.items():
+            weights[name + '/kernel'] = np.random.normal(
+                0, 0.1, size=shape).astype(np.float32)
+            weights[name + '/bias'] = np.random.normal(
+                0, 0.1, size=shape[1:]).astype(np.float32)
+
+        # Counter-like series: large offset, small variations
+        model = DonutModel(dict(
+            name='test',
+            offset=30,
+            span=span,
+            bucket_interval=60,
+            interval=60,
+            features=[FEATURE_AVG_FOO],
+            max_threshold=70,
+            min_threshold=60,
+        ), state={
+            'best_params': {
+                'span': span,
+                'intermediate_dim': 8,
+                'latent_dim': 3,
+                'optimizer': 'adam',
+            },
+            'means': [1e9],
+            'stds': [10.0],
+            'loss': 0.0,
+            'weights': weights,
+        })
+        source = MemBucket()
+        values = 1e9 + np.random.normal(0, 10, 100).round(3)
+        for i, value in enumerate(values):
+            source.insert_times_data({
+                'timestamp': 6000 + i * 60,
+                'foo': float(value),
+            })
+
+        predictions = {}
+        for precision in ['float32', 'float64']:
+            np.random.seed(0)
+            predictions[precision] = model.predict(
+                source,
+                6000 + (span - 1) * 60,
+                6000 + 100 * 60,
+                backend='numpy',
+                precision=precision,
+            )
+
+        np.testing.assert_array_equal(
+            predictions['float32'].observed, values[span - 1:])
+        np.testing.assert_allclose(
+            predictions['float32'].predicted,
+            predictions['float64'].predicted,
+            rtol=0, atol=1e-5)
+
+    def test_scale_precision(self):
+        self.model.means = np.array([10.0])
+        self.model.stds = np.array([2.0])
+
+        for dtype in [np.float32, np.float64]:
+            dataset = np.array([8.0, 10.0, np.nan, 14.0], dtype=dtype)
+            scaled = self.model.scale_dataset(dataset)
+            self.assertEqual(scaled.dtype, dtype)
+            np.testing.assert_array_equal(scaled, [-1.0, 0.0, np.nan, 2.0])
+            unscaled = self.model.unscale_dataset(scaled)
+            self.assertEqual(unscaled.dtype, dtype)
+            np.testing.assert_array_equal(unscaled, dataset)
+
     def test_predict_with_nan(self):
         source = MemBucket()
         storage = TempStorage()
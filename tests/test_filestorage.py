@@ -1,11 +1,16 @@
 from loudml.filestorage import FileStorage
+from loudml.storage import TrainingCheckpoint
 from loudml.donut import DonutModel
+from loudml.membucket import MemBucket
 from loudml import (
     errors,
 )
 import logging
+import numpy as np
+import os
 import tempfile
 import unittest
+from unittest import mock
 
 logging.getLogger('tensorflow').disabled = True
 
@@ -69,3 +74,255 @@ class TestFileStorage(unittest.TestCase):
             self.assertEqual(model.type, 'donut')
             self.assertEqual(model.name, 'test-2')
             self.assertEqual(model.offset, 56)
+
+    def test_model_version(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = FileStorage(tmp)
+            model = DonutModel(dict(
+                name='test-1',
+                offset=30,
+                span=300,
+                bucket_interval=3,
+                interval=60,
+                features=FEATURES,
+                max_threshold=70,
+                min_threshold=60,
+            ))
+            storage.create_model(model)
+            version = storage.get_model_version('test-1')
+            self.assertEqual(version, storage.get_model_version('test-1'))
+
+            model._state = {'foo': 'bar'}
+            storage.save_model(model)
+            ckpt = storage.get_current_ckpt('test-1')
+            self.assertNotEqual(storage.get_model_version('test-1'), version)
+            version = storage.get_model_version('test-1')
+
+            model._state = {'foo': 'baz'}
+            storage.save_model(model)
+            self.assertNotEqual(storage.get_model_version('test-1'), version)
+            version = storage.get_model_version('test-1')
+
+            storage.set_current_ckpt('test-1', ckpt)
+            self.assertNotEqual(storage.get_model_version('test-1'), version)
+
+    def test_weights_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = FileStorage(tmp)
+            model = DonutModel(dict(
+                name='test-1',
+                offset=30,
+                span=300,
+                bucket_interval=3,
+                interval=60,
+                features=FEATURES,
+                max_threshold=70,
+                min_threshold=60,
+            ))
+            storage.create_model(model)
+
+            weights = {
+                'foo/kernel': np.random.normal(size=(5, 3)).astype('f4'),
+                'foo/bias': np.random.normal(size=(3,)).astype('f4'),
+            }
+            model._state = {'weights': weights, 'loss': 0.5}
+            storage.save_model(model)
+            ckpt = storage.get_current_ckpt('test-1')
+            weights_path = os.path.join(
+                storage.model_path('test-1'), ckpt + '.weights')
+            self.assertTrue(os.path.exists(weights_path))
+
+            model = storage.load_model('test-1')
+            self.assertEqual(model.state['loss'], 0.5)
+            self.assertEqual(set(model.state['weights']), set(weights))
+            for name, array in model.state['weights'].items():
+                self.assertIsInstance(array, np.memmap)
+                np.testing.assert_array_equal(array, weights[name])
+
+            # Unchanged weights are not written again
+            inode = os.stat(weights_path).st_ino
+            model._state['loss'] = 0.1
+            storage.save_state(model)
+            self.assertEqual(os.stat(weights_path).st_ino, inode)
+            model = storage.load_model('test-1')
+            self.assertEqual(model.state['loss'], 0.1)
+            np.testing.assert_array_equal(
+                model.state['weights']['foo/bias'], weights['foo/bias'])
+
+            # New checkpoint
+            storage.save_model(model)
+            self.assertNotEqual(storage.get_current_ckpt('test-1'), ckpt)
+            model = storage.load_model('test-1')
+            np.testing.assert_array_equal(
+                model.state['weights']['foo/kernel'], weights['foo/kernel'])
+
+    def test_training_checkpoint(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = FileStorage(tmp)
+            model = DonutModel(dict(
+                name='test-1',
+                offset=30,
+                span=300,
+                bucket_interval=3,
+                interval=60,
+                features=FEATURES,
+                max_threshold=70,
+                min_threshold=60,
+            ))
+            storage.create_model(model)
+            self.assertIsNone(storage.load_training_progress('test-1'))
+
+            def make_weights():
+                return {
+                    'foo/kernel': np.random.normal(size=(5, 3)).astype('f4'),
+                    'foo/bias': np.random.normal(size=(3,)).astype('f4'),
+                }
+
+            params = {'span': 10, 'latent_dim': 3}
+            job = {'from_ts': 0, 'to_ts': 3600, 'max_evals': 3}
+            checkpoint = TrainingCheckpoint(storage, 'test-1')
+            self.assertFalse(checkpoint.load())
+            checkpoint.start(job)
+
+            running = make_weights()
+            checkpoint.add_epoch(params, 1, make_weights())
+            checkpoint.add_epoch(params, 2, running)
+
+            checkpoint = TrainingCheckpoint(storage, 'test-1')
+            self.assertTrue(checkpoint.load())
+            self.assertEqual(checkpoint.progress['job'], job)
+            self.assertEqual(checkpoint.progress['running'], {
+                'params': params,
+                'epochs': 2,
+            })
+            self.assertEqual(set(checkpoint.weights), {'running'})
+            for name, array in checkpoint.weights['running'].items():
+                np.testing.assert_array_equal(array, running[name])
+
+            best = make_weights()
+            checkpoint.add_trial(params, 0.5, best)
+            checkpoint.add_trial(dict(params, span=20), 0.7, make_weights())
+            checkpoint.add_trial(dict(params, span=30), None)
+
+            checkpoint = TrainingCheckpoint(storage, 'test-1')
+            self.assertTrue(checkpoint.load())
+            self.assertEqual(
+                [trial['loss'] for trial in checkpoint.progress['trials']],
+                [0.5, 0.7, None],
+            )
+            self.assertIsNone(checkpoint.progress['running'])
+            self.assertEqual(checkpoint.progress['best'], {
+                'params': params,
+                'loss': 0.5,
+            })
+            self.assertEqual(set(checkpoint.weights), {'best'})
+            for name, array in checkpoint.weights['best'].items():
+                np.testing.assert_array_equal(array, best[name])
+
+            # Only the weight files in use are kept
+            path = os.path.join(storage.model_path('test-1'), 'training')
+            self.assertEqual(len([
+                filename for filename in os.listdir(path)
+                if filename.endswith('.weights')
+            ]), 1)
+
+            # A new job starts over
+            checkpoint.start(dict(job, max_evals=5))
+            checkpoint = TrainingCheckpoint(storage, 'test-1')
+            self.assertTrue(checkpoint.load())
+            self.assertEqual(checkpoint.progress['trials'], [])
+            self.assertEqual(checkpoint.weights, {})
+
+            checkpoint.clear()
+            self.assertIsNone(storage.load_training_progress('test-1'))
+
+    def test_model_hooks(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = FileStorage(tmp)
+            model = DonutModel(dict(
+                name='test-1',
+                offset=30,
+                span=300,
+                bucket_interval=3,
+                interval=60,
+                features=FEATURES,
+                max_threshold=70,
+                min_threshold=60,
+            ))
+            storage.create_model(model)
+            self.assertEqual(storage.list_model_hooks('test-1'), [])
+
+            storage.set_model_hook('test-1', 'foo', 'annotations', {'a': 1})
+            self.assertEqual(storage.list_model_hooks('test-1'), ['foo'])
+            hook = storage.get_model_hook('test-1', 'foo')
+            self.assertEqual(hook['config'], {'a': 1})
+
+            # Definitions returned to the caller are copies
+            hook['config']['a'] = 3
+            self.assertEqual(
+                storage.get_model_hook('test-1', 'foo')['config'], {'a': 1})
+
+            # Changes on disk are seen by the other storage instances
+            other = FileStorage(tmp)
+            other.set_model_hook('test-1', 'foo', 'annotations', {'a': 2})
+            self.assertEqual(
+                storage.get_model_hook('test-1', 'foo')['config'], {'a': 2})
+
+            # Unchanged definitions are not read again
+            with mock.patch.object(storage, '_load_json') as load_json:
+                storage.get_model_hook('test-1', 'foo')
+                self.assertEqual(storage.list_model_hooks('test-1'), ['foo'])
+            load_json.assert_not_called()
+
+            other.delete_model_hook('test-1', 'foo')
+            self.assertEqual(storage.list_model_hooks('test-1'), [])
+            with self.assertRaises(errors.NotFound):
+                storage.get_model_hook('test-1', 'foo')
+
+            # The hook definitions are read once for all the hooks
+            for hook_name in ['foo', 'bar']:
+                storage.set_model_hook(
+                    'test-1', hook_name, 'annotations', {'type': 'foo'})
+            with mock.patch.object(
+                storage,
+                '_read_model_hooks',
+                wraps=storage._read_model_hooks,
+            ) as read_hooks:
+                hooks = storage.load_model_hooks(model.settings, MemBucket())
+            self.assertEqual([hook.name for hook in hooks], ['bar', 'foo'])
+            self.assertEqual(read_hooks.call_count, 1)
+
+    def test_hook_events(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = FileStorage(tmp)
+            model = DonutModel(dict(
+                name='test-1',
+                offset=30,
+                span=300,
+                bucket_interval=3,
+                interval=60,
+                features=FEATURES,
+                max_threshold=70,
+                min_threshold=60,
+            ))
+            storage.create_model(model)
+            self.assertEqual(storage.list_hook_events('test-1'), [])
+
+            storage.add_hook_events('test-1', [{'i': i} for i in range(3)])
+            storage.add_hook_events('test-1', [{'i': 3}])
+            events = storage.list_hook_events('test-1')
+            self.assertEqual([event for _, event in events],
+                             [{'i': i} for i in range(4)])
+            self.assertEqual(len(storage.list_hook_events('test-1', 2)), 2)
+
+            event_id = events[0][0]
+            storage.set_hook_event('test-1', event_id, {'i': 0, 'j': 1})
+            self.assertEqual(storage.list_hook_events('test-1')[0],
+                             (event_id, {'i': 0, 'j': 1}))
+
+            storage.delete_hook_event('test-1', event_id)
+            self.assertEqual(
+                [event['i'] for _, event in storage.list_hook_events(
+                    'test-1')],
+                [1, 2, 3],
+            )
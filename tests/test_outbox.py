@@ -0,0 +1,186 @@
+from loudml.config import Config
+from loudml.donut import DonutModel
+from loudml.filestorage import FileStorage
+from loudml.misc import ts_to_datetime
+from loudml.outbox import (
+    HookDispatcher,
+    HookOutbox,
+)
+
+import json
+import numpy as np
+import tempfile
+import unittest
+from unittest import mock
+
+
+FEATURES = [
+    {
+        'name': 'avg_foo',
+        'metric': 'avg',
+        'field': 'foo',
+        'default': 0,
+    },
+]
+
+
+class FakeHook:
+    def __init__(self, name, failures=0):
+        self.name = name
+        self.failures = failures
+        self.calls = []
+
+    def _call(self, event_type, dt, score):
+        if self.failures > 0:
+            self.failures -= 1
+            raise Exception("hook failure")
+        self.calls.append((event_type, dt.timestamp(), score))
+
+    def on_anomaly_start(self, dt, score, *args, **kwargs):
+        self._call('start', dt, score)
+
+    def on_anomaly_end(self, dt, score, *args, **kwargs):
+        self._call('end', dt, score)
+
+
+class FakeDispatcher(HookDispatcher):
+    def __init__(self, hooks, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.hooks = hooks
+        self.loads = 0
+
+    def _load_hooks(self, model_name, bucket_name):
+        self.loads += 1
+        return {hook.name: hook for hook in self.hooks}
+
+
+class TestOutbox(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.storage = FileStorage(self.tmp.name)
+        self.storage.create_model(DonutModel(dict(
+            name='test-1',
+            offset=30,
+            span=300,
+            bucket_interval=3,
+            interval=60,
+            features=FEATURES,
+            max_threshold=70,
+            min_threshold=60,
+        )))
+        self.config = Config({})
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def add_events(self, count):
+        outbox = HookOutbox('my-bucket')
+        for i in range(count):
+            outbox.on_anomaly_start(
+                dt=ts_to_datetime(i * 60),
+                score=np.float32(80 + i),
+                predicted={'avg_foo': np.float32(1.5)},
+                observed={'avg_foo': 3.0},
+                anomalies={'avg_foo': {'type': 'high', 'score': 80 + i}},
+            )
+            outbox.on_anomaly_end(ts_to_datetime(i * 60 + 30), 10.0)
+        self.assertEqual(outbox.save(self.storage, 'test-1'), 2 * count)
+        self.assertEqual(outbox.events, [])
+
+    def test_record(self):
+        self.add_events(1)
+        events = [event for _, event in self.storage.list_hook_events(
+            'test-1')]
+        self.assertEqual([event['type'] for event in events],
+                         ['anomaly_start', 'anomaly_end'])
+        self.assertEqual(events[0]['bucket'], 'my-bucket')
+        self.assertEqual(events[0]['timestamp'], 0)
+        self.assertEqual(events[0]['kwargs']['predicted'], {'avg_foo': 1.5})
+        json.dumps(events)
+
+    def test_dispatch(self):
+        self.add_events(3)
+        hooks = [FakeHook('foo'), FakeHook('bar')]
+        dispatcher = FakeDispatcher(hooks, self.config, self.storage,
+                                    batch_size=4)
+
+        dispatcher.dispatch()
+        self.assertEqual(self.storage.list_hook_events('test-1'), [])
+        self.assertEqual(dispatcher.delivered, 6)
+        # Hooks are loaded once per batch
+        self.assertEqual(dispatcher.loads, 2)
+        for hook in hooks:
+            self.assertEqual(hook.calls, [
+                ('start', 0, 80),
+                ('end', 30, 10),
+                ('start', 60, 81),
+                ('end', 90, 10),
+                ('start', 120, 82),
+                ('end', 150, 10),
+            ])
+
+    def test_retry(self):
+        self.add_events(1)
+        foo = FakeHook('foo')
+        bar = FakeHook('bar', failures=2)
+        dispatcher = FakeDispatcher([foo, bar], self.config, self.storage,
+                                    retry_delay=10)
+
+        self.assertEqual(dispatcher.dispatch_model('test-1', now=1000), 0)
+        self.assertEqual(foo.calls, [('start', 0, 80)])
+        self.assertEqual(bar.calls, [])
+        _, event = self.storage.list_hook_events('test-1')[0]
+        self.assertEqual(event['hooks'], ['bar'])
+        self.assertEqual(event['retry_ts'], 1010)
+
+        # Next events wait for the failed one
+        self.assertEqual(dispatcher.dispatch_model('test-1', now=1005), 0)
+        self.assertEqual(dispatcher.dispatch_model('test-1', now=1010), 0)
+        _, event = self.storage.list_hook_events('test-1')[0]
+        self.assertEqual(event['retry_ts'], 1030)
+
+        self.assertEqual(dispatcher.dispatch_model('test-1', now=1030), 2)
+        self.assertEqual(foo.calls, [('start', 0, 80), ('end', 30, 10)])
+        self.assertEqual(bar.calls, [('start', 0, 80), ('end', 30, 10)])
+
+    def test_drop(self):
+        self.add_events(1)
+        hook = FakeHook('foo', failures=3)
+        dispatcher = FakeDispatcher([hook], self.config, self.storage,
+                                    max_attempts=3, retry_delay=0)
+
+        for _ in range(2):
+            self.assertEqual(dispatcher.dispatch_model('test-1'), 0)
+
+        # The next events are delivered once the event is dropped
+        self.assertEqual(dispatcher.dispatch_model('test-1'), 2)
+        self.assertEqual(dispatcher.dropped, 1)
+        self.assertEqual(dispatcher.delivered, 1)
+        self.assertEqual(hook.calls, [('end', 30, 10)])
+        self.assertEqual(self.storage.list_hook_events('test-1'), [])
+
+    def test_pending(self):
+        self.add_events(1)
+        foo = FakeHook('foo')
+        bar = FakeHook('bar', failures=1)
+        dispatcher = FakeDispatcher([foo, bar], self.config, self.storage,
+                                    retry_delay=10)
+
+        # All the models are scanned at startup
+        self.assertEqual(dispatcher.dispatch(now=1000), 1010)
+        self.assertEqual(foo.calls, [('start', 0, 80)])
+
+        # Then only the models that wait for a retry or were notified
+        with mock.patch.object(self.storage, 'list_models') as list_models:
+            self.assertEqual(dispatcher.dispatch(now=1005), 1010)
+            self.assertEqual(dispatcher.loads, 1)
+            self.assertIsNone(dispatcher.dispatch(now=1010))
+            self.assertEqual(dispatcher.delivered, 2)
+
+            self.add_events(1)
+            self.assertIsNone(dispatcher.dispatch(now=1020))
+            self.assertEqual(dispatcher.delivered, 2)
+            dispatcher.notify('test-1')
+            self.assertIsNone(dispatcher.dispatch(now=1020))
+            self.assertEqual(dispatcher.delivered, 4)
+        list_models.assert_not_called()
@@ -1,4 +1,9 @@
+import concurrent.futures
+import multiprocessing
 import os
+import schedule
+import threading
+import time
 import unittest
 from unittest import mock
 
@@ -31,3 +36,92 @@ class TestServer(unittest.TestCase):
         self.assertTrue(rv.is_json)
         data = rv.get_json()
         self.assertIn('tagline', data)
+
+    def test_message_reader(self):
+        job = server.Job()
+        server.g_jobs[job.id] = job
+        msg_queue = multiprocessing.Queue()
+        reader = server.MessageReader(msg_queue)
+        reader.start()
+        try:
+            msg_queue.put({
+                'type': 'job_state',
+                'job_id': job.id,
+                'state': 'running',
+                'progress': {'eval': 1, 'max_evals': 2},
+            })
+            deadline = time.time() + 5
+            while job.state != 'running' and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(job.state, 'running')
+            self.assertEqual(job.progress, {'eval': 1, 'max_evals': 2})
+        finally:
+            reader.stop()
+            del server.g_jobs[job.id]
+
+    def test_scheduler(self):
+        schedule.clear()
+        scheduler = server.Scheduler()
+        scheduler.start()
+        try:
+            # Without jobs, the scheduler sleeps until it is woken up
+            done = threading.Event()
+            schedule.every(1).seconds.do(done.set)
+            scheduler.wakeup()
+            self.assertTrue(done.wait(5))
+        finally:
+            scheduler.stop()
+            schedule.clear()
+
+
+class FakePool:
+    def __init__(self):
+        self.futures = []
+
+    def schedule(self, function, args=None, kwargs=None):
+        future = concurrent.futures.Future()
+        self.futures.append(future)
+        return future
+
+
+class TestAffinityPool(unittest.TestCase):
+    def test_consistent_hashing(self):
+        keys = ["model-{}".format(i) for i in range(100)]
+        pool = server.AffinityPool([FakePool() for _ in range(4)])
+        workers = {key: pool.get_worker(key) for key in keys}
+        self.assertEqual(set(workers.values()), {0, 1, 2, 3})
+
+        # Removing a worker only moves its keys
+        pool = server.AffinityPool([FakePool() for _ in range(3)])
+        for key, i in workers.items():
+            if i != 3:
+                self.assertEqual(pool.get_worker(key), i)
+
+    def test_schedule(self):
+        pools = [FakePool() for _ in range(2)]
+        pool = server.AffinityPool(pools)
+        preferred = pool.get_worker('foo')
+        other = 1 - preferred
+
+        first = pool.schedule(print, key='foo')
+        self.assertIs(pools[preferred].futures[-1], first)
+
+        # The preferred worker is busy: use the idle one
+        second = pool.schedule(print, key='foo')
+        self.assertIs(pools[other].futures[-1], second)
+        self.assertEqual((pool.hits, pool.misses), (1, 1))
+
+        # No idle worker
+        pool.schedule(print, key='foo')
+        self.assertEqual(len(pools[preferred].futures), 2)
+        self.assertEqual(pool.backlog[preferred], 2)
+
+        first.set_result(None)
+        second.set_result(None)
+        self.assertEqual(pool.backlog, [
+            1 if i == preferred else 0 for i in range(2)])
+
+        # Jobs without key go to the least loaded worker
+        pool.schedule(print)
+        self.assertEqual(len(pools[other].futures), 2)
+        self.assertEqual(pool.hit_rate, 2 / 3)
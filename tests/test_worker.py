@@ -0,0 +1,105 @@
+from loudml.config import Config
+from loudml.worker import (
+    ModelCache,
+    Worker,
+)
+
+import multiprocessing
+import signal
+import tempfile
+import unittest
+from unittest import mock
+
+
+class FakeModel:
+    def __init__(self, state=None):
+        self._state = state or {}
+        self.loaded = True
+
+    def unload(self):
+        self.loaded = False
+
+
+class TestModelCache(unittest.TestCase):
+    def test_hit_and_miss(self):
+        cache = ModelCache(max_models=2)
+        model = FakeModel({'run': {'foo': 1}})
+
+        self.assertIsNone(cache.get('test-1', 1))
+        cache.put('test-1', 1, model)
+        self.assertIs(cache.get('test-1', 1), model)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 1)
+
+        # Changes that are not saved are discarded
+        model._state['run']['foo'] = 2
+        self.assertEqual(cache.get('test-1', 1)._state['run']['foo'], 1)
+
+        # New version
+        self.assertIsNone(cache.get('test-1', 2))
+        self.assertFalse(model.loaded)
+        self.assertEqual(len(cache), 0)
+
+        # Unknown version
+        cache.put('test-1', None, model)
+        self.assertEqual(len(cache), 0)
+
+    def test_lru(self):
+        cache = ModelCache(max_models=2)
+        models = [FakeModel() for _ in range(3)]
+
+        cache.put('test-0', 1, models[0])
+        cache.put('test-1', 1, models[1])
+        cache.get('test-0', 1)
+        cache.put('test-2', 1, models[2])
+
+        self.assertEqual(len(cache), 2)
+        self.assertTrue(models[0].loaded)
+        self.assertFalse(models[1].loaded)
+        self.assertIsNone(cache.get('test-1', 1))
+        self.assertIs(cache.get('test-2', 1), models[2])
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertFalse(models[0].loaded)
+
+    @mock.patch('loudml.worker._get_rss_mb', return_value=50)
+    def test_max_rss(self, get_rss_mb):
+        cache = ModelCache(max_models=8, max_rss_mb=100)
+        models = [FakeModel() for _ in range(5)]
+        for i in range(3):
+            cache.put('test-{}'.format(i), 1, models[i])
+        self.assertEqual(len(cache), 3)
+
+        # One least recently used model evicted per call
+        get_rss_mb.return_value = 200
+        cache.put('test-3', 1, models[3])
+        self.assertEqual(len(cache), 3)
+        self.assertFalse(models[0].loaded)
+        self.assertTrue(models[1].loaded)
+
+        cache.put('test-4', 1, models[4])
+        self.assertEqual(len(cache), 3)
+        self.assertFalse(models[1].loaded)
+        self.assertIs(cache.get('test-4', 1), models[4])
+
+
+class TestWorker(unittest.TestCase):
+    def test_storage(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            config = Config({'storage': {'path': tmp}})
+            handler = signal.getsignal(signal.SIGINT)
+            self.addCleanup(signal.signal, signal.SIGINT, handler)
+            worker = Worker(multiprocessing.Queue())
+            worker.get_storage = lambda: worker.storage
+
+            # The storage and its caches are kept across jobs
+            storage = worker.run('job-1', 0, 'get_storage', config)
+            self.assertIs(worker.run('job-2', 0, 'get_storage', config),
+                          storage)
+
+            with tempfile.TemporaryDirectory() as other:
+                config = Config({'storage': {'path': other}})
+                other_storage = worker.run('job-3', 0, 'get_storage', config)
+                self.assertIsNot(other_storage, storage)
+                self.assertEqual(other_storage.path, other)